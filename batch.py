@@ -0,0 +1,176 @@
+"""
+Run many independent matches in parallel, using every core of the machine.
+
+Usage:
+    python batch.py [level] [--matches N] [--ticks N] [--workers N]
+        [--set NAME=VALUE ...]
+"""
+from __future__ import division, print_function
+
+import argparse
+import random
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import headless
+from headless import ScriptedInput
+from player import Player
+import levels
+import constants as c
+
+
+Match = namedtuple('Match', 'level seed scripts ticks constants')
+Match.__new__.__defaults__ = (None, c.physics_fps * 60, None)
+Match.__doc__ = """
+A match to simulate.
+
+level is the name of a level in the levels module. scripts is a list with a
+script for each player's ScriptedInput. If it is None, random scripts are made
+from the seed instead. constants is a dictionary of overrides for the
+constants module during the match.
+"""
+
+MatchOutcome = namedtuple(
+    'MatchOutcome',
+    'match winner death_tick total_damage damage ticks',
+)
+MatchOutcome.__doc__ = """
+The result of a match.
+
+The match ends on the first death, or after its number of ticks. winner is the
+number of the only player left alive, or None if there is no single survivor.
+death_tick is the tick on which the first player died, or None.
+"""
+
+
+def random_script(rand, ticks, min_hold=10, max_hold=90):
+    """Make a script of random controls, each held for a random time."""
+    script = []
+    tick = 0
+    while tick < ticks:
+        script.append((tick, dict(
+            thrust=rand.random() < 0.7,
+            brake=rand.random() < 0.2,
+            turn_direction=rand.choice([-1, 0, 0, 1]),
+        )))
+        tick += rand.randint(min_hold, max_hold)
+    return script
+
+def run_match(match):
+    """Simulate a single match and return its MatchOutcome."""
+    level = getattr(levels, match.level)
+    num_players = sum(1 for cls, _ in level if issubclass(cls, Player))
+    scripts = match.scripts
+    if scripts is None:
+        rand = random.Random(match.seed)
+        scripts = [random_script(rand, match.ticks) for _ in range(num_players)]
+    inputs = [ScriptedInput(script) for script in scripts]
+
+    # Override constants for the length of the match. The objects of the level
+    # are made after the overrides, so their defaults use them too.
+    overrides = match.constants or {}
+    saved = dict((name, getattr(c, name)) for name in overrides)
+    try:
+        for name, value in overrides.items():
+            setattr(c, name, value)
+        result = headless.run(
+            level,
+            inputs,
+            ticks=match.ticks,
+            stop_on_death=True,
+        )
+    finally:
+        for name, value in saved.items():
+            setattr(c, name, value)
+
+    players = result.env.players
+    alive = [p for p in players if not p.dead]
+    death_ticks = [p.death_tick for p in players if p.dead]
+    damage = [p.damage for p in players]
+    return MatchOutcome(
+        match=match,
+        winner=alive[0].number if len(alive) == 1 and len(players) > 1 else None,
+        death_tick=min(death_ticks) if death_ticks else None,
+        total_damage=sum(damage),
+        damage=damage,
+        ticks=result.ticks,
+    )
+
+def run_matches(matches, max_workers=None, chunksize=16):
+    """
+    Simulate many matches across a pool of processes.
+
+    Returns a list of MatchOutcome in the same order as the matches. The
+    number of processes defaults to the number of cores.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_match, matches, chunksize=chunksize))
+
+
+# Constants that overriding would not change anything for, and why. Some are
+# only used to compute others when the constants module loads.
+ineffective_constants = {
+    'physics_fps': 'override physics_tick_ms instead',
+    'player_start_turn_rate': 'override player_start_turn_rate_radians instead',
+    'player_turn_rate': 'override player_turn_rate_radians instead',
+    'restitution_bumper': 'bumpers take the restitution of particles',
+}
+
+def parse_override(text):
+    name, value = text.split('=', 1)
+    if not hasattr(c, name):
+        raise argparse.ArgumentTypeError('Unknown constant {!r}'.format(name))
+    if name in ineffective_constants:
+        raise argparse.ArgumentTypeError(
+            'Overriding {!r} has no effect, {}'.format(name, ineffective_constants[name])
+        )
+    if not isinstance(getattr(c, name), (int, float)):
+        raise argparse.ArgumentTypeError('Constant {!r} is not a number'.format(name))
+    return name, float(value)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('level', nargs='?', default='versus')
+    parser.add_argument('--matches', type=int, default=100)
+    parser.add_argument('--ticks', type=int, default=c.physics_fps * 60)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument(
+        '--set',
+        type=parse_override,
+        action='append',
+        default=[],
+        metavar='NAME=VALUE',
+        help='Override a value in the constants module.',
+    )
+    args = parser.parse_args()
+
+    matches = [
+        Match(args.level, seed, ticks=args.ticks, constants=dict(args.set))
+        for seed in range(args.matches)
+    ]
+    start = time.time()
+    outcomes = run_matches(matches, max_workers=args.workers)
+    seconds = time.time() - start
+
+    print('{} matches in {:.2f} seconds, {:.1f} matches per second'.format(
+        len(outcomes), seconds, len(outcomes) / seconds,
+    ))
+    wins = {}
+    for outcome in outcomes:
+        wins[outcome.winner] = wins.get(outcome.winner, 0) + 1
+    for winner, count in sorted(wins.items(), key=lambda item: str(item[0])):
+        if winner is None:
+            print('no winner: {}'.format(count))
+        else:
+            print('player {} wins: {}'.format(winner + 1, count))
+    death_ticks = [o.death_tick for o in outcomes if o.death_tick is not None]
+    if death_ticks:
+        print('mean death tick: {:.0f}'.format(sum(death_ticks) / len(death_ticks)))
+    print('mean total damage: {:.1f}'.format(
+        sum(o.total_damage for o in outcomes) / len(outcomes),
+    ))
+
+
+if __name__ == '__main__':
+    main()
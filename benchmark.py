@@ -0,0 +1,249 @@
+"""
+Performance benchmarks.
+
+Usage:
+    python benchmark.py [tick] [vec] [snapshot] [--sizes N,N,...] [--json PATH]
+"""
+from __future__ import division, print_function
+
+import argparse
+import copy
+import json
+import math
+import platform
+import random
+import time
+import timeit
+
+import vec
+import vec2
+from environment import Environment, np
+from profiler import Profiler
+from particle import Particle
+from bumper import Bumper
+from wall import Wall
+import levels
+import constants as c
+
+
+def generated_level(num_particles, seed=0):
+    """
+    Make a level with the given number of particles, for benchmarks.
+
+    The particles move in random directions inside a square arena, sized so
+    that they cover about a tenth of it. There is a bumper for every fifty
+    particles, and a short wall for every twenty.
+    """
+    rand = random.Random(seed)
+    half = math.sqrt(35 * num_particles) / 2
+
+    def random_pos(margin):
+        return (
+            rand.uniform(-half + margin, half - margin),
+            rand.uniform(-half + margin, half - margin),
+        )
+
+    corners = [(-half, -half), (-half, half), (half, half), (half, -half)]
+    level = [
+        (Wall, [corners[i], corners[i - 1]])
+        for i in range(4)
+    ]
+    for _ in range(num_particles // 20):
+        start = random_pos(2)
+        angle = rand.uniform(0, 2 * math.pi)
+        length = rand.uniform(2, 6)
+        end = vec2.add(start, (length * math.cos(angle), length * math.sin(angle)))
+        level.append((Wall, [start, end]))
+    for _ in range(num_particles // 50):
+        level.append((Bumper, dict(pos=random_pos(3), radius=rand.uniform(1, 3))))
+    for _ in range(num_particles):
+        level.append((Particle, dict(
+            pos=random_pos(1),
+            velocity=(rand.uniform(-20, 20), rand.uniform(-20, 20)),
+            mass=rand.uniform(.25, 2),
+        )))
+    return level
+
+def time_ticks(env, ticks):
+    """
+    Run the environment for some ticks, and time each phase of the tick.
+
+    The phases are timed by a Profiler, the same way as in the game. Returns a
+    dictionary of the mean seconds per tick in each of Profiler.phases, in
+    other for the time outside of them, and in total.
+    """
+    saved = env.profiler
+    env.profiler = profiler = Profiler(window=ticks + 1)
+    try:
+        start = time.perf_counter()
+        for _ in range(ticks):
+            env.update(c.physics_tick_ms)
+        total = time.perf_counter() - start
+    finally:
+        env.profiler = saved
+
+    averages = profiler.averages()
+    times = dict((phase, averages[phase]) for phase in Profiler.phases)
+    times['total'] = total / ticks
+    times['other'] = times['total'] - sum(times[phase] for phase in Profiler.phases)
+    return times
+
+def tick_modes():
+    modes = [
+        dict(broadphase='brute_force'),
+        dict(broadphase='grid'),
+        dict(broadphase='sweep_and_prune'),
+    ]
+    if np is not None:
+        modes.append(dict(broadphase='grid', vectorized=True))
+    return modes
+
+def bench_tick(sizes=(10, 100, 1000, 10000), max_brute_force=1000):
+    """
+    Time Environment.update on generated levels of increasing size.
+
+    Every broadphase is timed, and vectorized physics if numpy is available.
+    The brute force broadphase is skipped for levels bigger than
+    max_brute_force, since it takes quadratic time.
+    """
+    results = []
+    columns = ['total'] + Profiler.phases + ['other']
+    print(('{:>6} {:<20}' + ' {:>10}' * len(columns)).format(
+        'size', 'mode', 'total (ms)', *columns[1:]
+    ))
+    for size in sizes:
+        level = generated_level(size)
+        # Aim for about the same amount of work at every size.
+        ticks = max(5, min(200, 20000 // size))
+        for mode in tick_modes():
+            if mode['broadphase'] == 'brute_force' and size > max_brute_force:
+                continue
+            env = Environment(**mode)
+            env.load_level(level)
+            # Warm up, so that the particles are spread out and moving.
+            for _ in range(max(1, ticks // 10)):
+                env.update(c.physics_tick_ms)
+            times = time_ticks(env, ticks)
+            mode_name = mode['broadphase'] + (' vectorized' if mode.get('vectorized') else '')
+            print(('{:>6} {:<20}' + ' {:>10.3f}' * len(columns)).format(
+                size,
+                mode_name,
+                *[times[phase] * 1000 for phase in columns]
+            ))
+            results.append(dict(
+                particles=size,
+                walls=len(env.walls),
+                ticks=ticks,
+                broadphase=mode['broadphase'],
+                vectorized=bool(mode.get('vectorized')),
+                seconds_per_tick=times,
+            ))
+    return results
+
+
+def bench_vec(number=100000):
+    """Compare the speed of the generic vec module with the 2D vec2 module."""
+    rand = random.Random(0)
+    a = (rand.uniform(-10, 10), rand.uniform(-10, 10))
+    b = (rand.uniform(-10, 10), rand.uniform(-10, 10))
+    cases = [
+        ('add', (a, b)),
+        ('vfrom', (a, b)),
+        ('dot', (a, b)),
+        ('mul', (a, 2.5)),
+        ('mag2', (a,)),
+        ('norm', (a,)),
+        ('proj', (a, b)),
+        ('perp', (a,)),
+    ]
+    print('{:<8} {:>12} {:>12} {:>8}'.format('function', 'vec (us)', 'vec2 (us)', 'speedup'))
+    results = []
+    for name, args in cases:
+        times = []
+        for module in [vec, vec2]:
+            func = getattr(module, name)
+            seconds = min(timeit.repeat(
+                lambda: func(*args),
+                number=number,
+                repeat=3,
+            ))
+            times.append(seconds / number * 1e6)
+        print('{:<8} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(
+            name, times[0], times[1], times[0] / times[1],
+        ))
+        results.append(dict(function=name, vec_us=times[0], vec2_us=times[1]))
+    return results
+
+
+def bench_snapshot(number=100):
+    """Compare Environment.snapshot and restore with a deep copy."""
+    rand = random.Random(0)
+    level = levels.versus + [
+        (Particle, dict(pos=(rand.uniform(-18, 18), rand.uniform(-18, 18))))
+        for _ in range(1000)
+    ]
+    print('{:<20} {:>12} {:>12}'.format('1000 particles', 'scalar (us)', 'numpy (us)'))
+    results = dict((name, []) for name in ['snapshot', 'restore', 'deepcopy'])
+    for vectorized in [False, True]:
+        env = Environment(vectorized=vectorized)
+        env.load_level(level)
+        snapshot = env.snapshot()
+        for name, func in [
+            ('snapshot', env.snapshot),
+            ('restore', lambda: env.restore(snapshot)),
+            ('deepcopy', lambda: copy.deepcopy(env)),
+        ]:
+            n = number if name != 'deepcopy' else max(number // 10, 1)
+            seconds = min(timeit.repeat(func, number=n, repeat=3))
+            results[name].append(seconds / n * 1e6)
+    for name, times in sorted(results.items()):
+        print('{:<20} {:>12.1f} {:>12.1f}'.format(name, *times))
+    return dict(
+        (name, dict(zip(['scalar_us', 'numpy_us'], times)))
+        for name, times in results.items()
+    )
+
+
+benchmarks = {
+    'tick': bench_tick,
+    'vec': bench_vec,
+    'snapshot': bench_snapshot,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*', help=', '.join(sorted(benchmarks)))
+    parser.add_argument(
+        '--sizes',
+        type=lambda text: [int(size) for size in text.split(',')],
+        default=None,
+        help='Comma separated particle counts for the tick benchmark.',
+    )
+    parser.add_argument('--json', metavar='PATH', help='Also write the results to a file.')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark {!r}'.format(name))
+
+    results = {}
+    for name in args.names or sorted(benchmarks):
+        print('## {}'.format(name))
+        if name == 'tick' and args.sizes:
+            results[name] = bench_tick(args.sizes)
+        else:
+            results[name] = benchmarks[name]()
+        print()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                numpy=np.__version__ if np is not None else None,
+                machine=platform.machine(),
+                results=results,
+            ), f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
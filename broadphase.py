@@ -0,0 +1,284 @@
+"""
+Broadphase collision detection.
+
+A broadphase takes the positions and radii of every particle and returns
+candidate pairs that might be touching, so that the narrowphase in
+collide_particles only runs on nearby particles.
+
+Pairs are returned as (i, j) index tuples with i > j, sorted in the same
+order that every_pair visits them. Collisions are resolved one pair at a time,
+so keeping this order means every broadphase gives identical results.
+"""
+from __future__ import division
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class PairArrays(object):
+    """Candidate pairs as two index arrays, which iterate as (i, j) tuples."""
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        pairs = np.array(pairs, dtype=int).reshape((len(pairs), 2))
+        return cls(pairs[:, 0].copy(), pairs[:, 1].copy())
+
+    def __len__(self):
+        return len(self.first)
+
+    def __iter__(self):
+        return zip(self.first.tolist(), self.second.tolist())
+
+
+class Broadphase(object):
+    def index_pair_arrays(self, positions, radii):
+        return PairArrays.from_pairs(
+            self.index_pairs(positions.tolist(), radii.tolist())
+        )
+
+    def reset(self):
+        pass
+
+
+class BruteForce(Broadphase):
+    """Reference broadphase, testing every pair of particles."""
+
+    def index_pairs(self, positions, radii):
+        return [
+            (i, j)
+            for i in range(len(positions))
+            for j in range(i)
+        ]
+
+
+class UniformGrid(Broadphase):
+    """
+    Spatial hash grid broadphase.
+
+    The cell size is the diameter of the largest particle, so two particles can
+    only touch if they are in the same cell or in adjacent cells. Each particle
+    is hashed into a single cell by its center, then checked against the
+    particles in its own cell and half of the surrounding cells.
+    """
+    # Half of the 3x3 neighborhood; the other half is covered when the
+    # neighboring cell does its own check.
+    neighbor_offsets = [(1, -1), (1, 0), (1, 1), (0, 1)]
+
+    def index_pairs(self, positions, radii):
+        if not positions:
+            return []
+        cell_size = 2 * max(radii)
+        if cell_size <= 0:
+            cell_size = 1.0
+
+        cells = {}
+        for i, (x, y) in enumerate(positions):
+            key = (int(math.floor(x / cell_size)), int(math.floor(y / cell_size)))
+            cells.setdefault(key, []).append(i)
+
+        pairs = []
+        for (cx, cy), members in cells.items():
+            for k, a in enumerate(members):
+                for b in members[:k]:
+                    pairs.append((a, b) if a > b else (b, a))
+            for dx, dy in self.neighbor_offsets:
+                others = cells.get((cx + dx, cy + dy))
+                if others is None:
+                    continue
+                for a in members:
+                    for b in others:
+                        pairs.append((a, b) if a > b else (b, a))
+        pairs.sort()
+        return pairs
+
+    def index_pair_arrays(self, positions, radii):
+        """Find the same pairs as index_pairs, with numpy."""
+        n = len(positions)
+        if n == 0:
+            return PairArrays(np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        cell_size = 2 * radii.max()
+        if cell_size <= 0:
+            cell_size = 1.0
+
+        cells = np.floor(positions / cell_size).astype(int)
+        cells -= cells.min(axis=0)
+        # Leave room in y for the neighbor offsets.
+        cells[:, 1] += 1
+        stride = cells[:, 1].max() + 2
+        codes = cells[:, 0] * stride + cells[:, 1]
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+
+        # The runs of sorted particles to pair each one with: those before it
+        # in its cell, and those in half of the neighboring cells.
+        runs = [(
+            np.searchsorted(sorted_codes, sorted_codes, side='left'),
+            np.arange(n),
+        )]
+        for dx, dy in self.neighbor_offsets:
+            neighbor = sorted_codes + (dx * stride + dy)
+            runs.append((
+                np.searchsorted(sorted_codes, neighbor, side='left'),
+                np.searchsorted(sorted_codes, neighbor, side='right'),
+            ))
+
+        a_parts = []
+        b_parts = []
+        for starts, ends in runs:
+            counts = ends - starts
+            total = counts.sum()
+            if total == 0:
+                continue
+            a_parts.append(np.repeat(order, counts))
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            b_parts.append(order[np.repeat(starts, counts) + offsets])
+        if not a_parts:
+            return PairArrays(np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        a = np.concatenate(a_parts)
+        b = np.concatenate(b_parts)
+        first = np.maximum(a, b)
+        second = np.minimum(a, b)
+        pair_order = np.lexsort((second, first))
+        return PairArrays(first[pair_order], second[pair_order])
+
+    def cross_pair_arrays(self, positions, radii, other_positions, other_radii):
+        """
+        Find the candidate pairs between two sets of particles, as a
+        PairArrays indexing the others in first, in no particular order.
+        """
+        empty = PairArrays(np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+        if len(positions) == 0 or len(other_positions) == 0:
+            return empty
+        cell_size = 2 * max(radii.max(), other_radii.max())
+        if cell_size <= 0:
+            cell_size = 1.0
+
+        cells = np.floor(positions / cell_size).astype(int)
+        other_cells = np.floor(other_positions / cell_size).astype(int)
+        low = np.minimum(cells.min(axis=0), other_cells.min(axis=0))
+        cells -= low
+        other_cells -= low
+        # Leave room for the neighbor offsets, as in index_pair_arrays.
+        cells[:, 1] += 1
+        other_cells[:, 1] += 1
+        stride = max(cells[:, 1].max(), other_cells[:, 1].max()) + 2
+        codes = cells[:, 0] * stride + cells[:, 1]
+        other_codes = other_cells[:, 0] * stride + other_cells[:, 1]
+        order = np.argsort(codes, kind='stable')
+        sorted_codes = codes[order]
+
+        a_parts = []
+        b_parts = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                neighbor = other_codes + (dx * stride + dy)
+                starts = np.searchsorted(sorted_codes, neighbor, side='left')
+                ends = np.searchsorted(sorted_codes, neighbor, side='right')
+                counts = ends - starts
+                total = counts.sum()
+                if total == 0:
+                    continue
+                a_parts.append(np.repeat(np.arange(len(other_codes)), counts))
+                offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+                b_parts.append(order[np.repeat(starts, counts) + offsets])
+        if not a_parts:
+            return empty
+        return PairArrays(np.concatenate(a_parts), np.concatenate(b_parts))
+
+
+class SweepAndPrune(Broadphase):
+    """
+    Sort and sweep broadphase along the x axis.
+
+    Each particle contributes a min and a max endpoint of its extent on the x
+    axis. The endpoint list is kept between ticks, and since particles only
+    move a little each frame, it is nearly sorted already, so re-sorting it
+    with an insertion sort is close to linear time. Sweeping through the
+    sorted endpoints then finds every pair of overlapping x extents, which are
+    also checked for overlap on the y axis.
+
+    The endpoint list refers to particles by index, so the environment must
+    call reset() whenever the list of particles changes.
+    """
+    def __init__(self):
+        self.endpoints = []
+
+    def index_pairs(self, positions, radii):
+        endpoints = self.endpoints
+        rebuilt = len(endpoints) != 2 * len(positions)
+        if rebuilt:
+            endpoints = self.endpoints = [
+                [0.0, is_max, i]
+                for i in range(len(positions))
+                for is_max in (0, 1)
+            ]
+
+        # Update endpoint values. Min endpoints sort before max endpoints
+        # with the same value, so that touching extents count as
+        # overlapping.
+        for e in endpoints:
+            _, is_max, i = e
+            if is_max:
+                e[0] = positions[i][0] + radii[i]
+            else:
+                e[0] = positions[i][0] - radii[i]
+
+        if rebuilt:
+            endpoints.sort()
+        else:
+            insertion_sort(endpoints)
+
+        pairs = []
+        active = []
+        for _, is_max, a in endpoints:
+            if is_max:
+                active.remove(a)
+                continue
+            ay = positions[a][1]
+            ar = radii[a]
+            for b in active:
+                if abs(positions[b][1] - ay) <= ar + radii[b]:
+                    pairs.append((a, b) if a > b else (b, a))
+            active.append(a)
+        pairs.sort()
+        return pairs
+
+    def reset(self):
+        self.endpoints = []
+
+
+def insertion_sort(items):
+    """Sort a list in place, in linear time if it is nearly sorted already."""
+    for k in range(1, len(items)):
+        item = items[k]
+        j = k - 1
+        while j >= 0 and items[j] > item:
+            items[j + 1] = items[j]
+            j -= 1
+        items[j + 1] = item
+
+
+broadphases = {
+    'brute_force': BruteForce,
+    'grid': UniformGrid,
+    'sweep_and_prune': SweepAndPrune,
+}
+
+def make_broadphase(name):
+    """Look up a broadphase by name, and return an instance of it."""
+    try:
+        return broadphases[name]()
+    except KeyError:
+        raise ValueError(
+            'Unknown broadphase {!r}, expected one of: {}'.format(
+                name,
+                ', '.join(sorted(broadphases)),
+            )
+        )
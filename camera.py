@@ -0,0 +1,108 @@
+from __future__ import division
+
+import math
+
+import vec2 as vec
+
+
+class Camera(object):
+    """
+    Decides which part of the world is shown on the screen.
+
+    The camera follows a set of targets, usually the players, keeping all of
+    them in view with a margin around them. It zooms out as they spread apart
+    and back in as they come together, between the given zoom limits, in
+    pixels per world unit. The center and zoom ease toward their targets, by
+    the smoothing fraction every frame, so the view doesn't jump.
+
+    The view itself moves in whole pixels, and zooms in steps of a fraction of
+    zoom_steps per doubling, so that small moves of the camera leave the
+    drawing of the static objects the same, only shifted.
+    """
+    def __init__(
+        self,
+        screen_size,
+        pixels_per_unit=15,
+        min_pixels_per_unit=3,
+        max_pixels_per_unit=15,
+        margin=8,
+        smoothing=0.1,
+        zoom_steps=16,
+    ):
+        self.screen_size = tuple(screen_size)
+        width, height = self.screen_size
+        self.screen_origin = (width // 2, height // 2)
+        self.center = (0, 0)
+        # The eased zoom, and the zoom step shown.
+        self.zoom = pixels_per_unit
+        self.pixels_per_unit = pixels_per_unit
+        self.min_pixels_per_unit = min_pixels_per_unit
+        self.max_pixels_per_unit = max_pixels_per_unit
+        self.margin = margin
+        self.smoothing = smoothing
+        self.zoom_steps = zoom_steps
+
+    def follow(self, targets, smoothing=None):
+        """Move toward the view that fits all the target positions."""
+        if not targets:
+            return
+        if smoothing is None:
+            smoothing = self.smoothing
+        xs = [x for x, _ in targets]
+        ys = [y for _, y in targets]
+        target_center = ((min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2)
+        width = max(xs) - min(xs) + 2 * self.margin
+        height = max(ys) - min(ys) + 2 * self.margin
+        screen_width, screen_height = self.screen_size
+        target_zoom = min(screen_width / width, screen_height / height)
+        target_zoom = min(max(target_zoom, self.min_pixels_per_unit), self.max_pixels_per_unit)
+
+        # Settle exactly once within a fraction of a pixel, so that a still
+        # view stays the same from frame to frame.
+        offset = vec.vfrom(self.center, target_center)
+        if vec.mag(offset) * self.pixels_per_unit < 0.25:
+            self.center = target_center
+        else:
+            self.center = vec.add(self.center, vec.mul(offset, smoothing))
+        if abs(target_zoom - self.zoom) < 0.01:
+            self.zoom = target_zoom
+        else:
+            self.zoom += (target_zoom - self.zoom) * smoothing
+        # Count the steps down from the closest zoom, so it is shown exactly.
+        steps = round(math.log(self.max_pixels_per_unit / self.zoom, 2) * self.zoom_steps)
+        self.pixels_per_unit = self.max_pixels_per_unit * 2 ** (-steps / self.zoom_steps)
+
+    @property
+    def center_pixels(self):
+        """The center of the view in world pixels, at the current zoom."""
+        cx, cy = self.center
+        return (
+            int(round(cx * self.pixels_per_unit)),
+            int(round(cy * self.pixels_per_unit)),
+        )
+
+    @property
+    def view(self):
+        """The zoom and position of the view, to tell when it has changed."""
+        return (self.pixels_per_unit, self.center_pixels)
+
+    def to_screen(self, pos):
+        """Convert a world position to integer screen coordinates."""
+        x, y = pos
+        ox, oy = self.screen_origin
+        cx, cy = self.center_pixels
+        return (
+            ox + int(math.floor(x * self.pixels_per_unit)) - cx,
+            oy + int(math.floor(y * self.pixels_per_unit)) - cy,
+        )
+
+    def view_bounds(self, padding=0):
+        """Find the area of the world on the screen, as (x1, y1, x2, y2)."""
+        half_width, half_height = vec.div(self.screen_origin, self.pixels_per_unit)
+        cx, cy = self.center
+        return (
+            cx - half_width - padding,
+            cy - half_height - padding,
+            cx + half_width + padding,
+            cy + half_height + padding,
+        )
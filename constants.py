@@ -2,6 +2,11 @@ from __future__ import division
 
 import math
 
+## Simulation
+
+physics_fps = 60
+physics_tick_ms = 1000 / physics_fps
+
 ## Global physics
 
 epsilon = 10**-10
@@ -13,6 +18,12 @@ drag_rate = 0.5
 restitution_wall = 0.6
 restitution_particle = 1.0
 restitution_bumper = 1.5
+# The most impacts between particles that continuous collision resolves for
+# one particle in a tick.
+max_impacts = 4
+# Particles slower than the sleep speed for the sleep time are put to sleep.
+sleep_speed = 0.01 # units / second
+sleep_time = 0.5 # seconds
 
 ## Player physics.
 player_rudder_strength = 5.0 # force / speed
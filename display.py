@@ -4,11 +4,13 @@ import pygame as pg
 
 import vec
 from graphics import Graphics
+from camera import Camera
 import constants as c
 
 # debug switches #
 SHOW_JOYSTICK = False
 SHOW_INFO = True
+FOLLOW_CAMERA = True
 
 # constants #
 FULLSCREEN = False
@@ -20,22 +22,50 @@ class Display(object):
     """
     The display manager owns the pygame screen object, and the translation
     between world coordinates and screen coordinates. It also dispatches to the
-    Graphics class to draw various kinds of objects.
+    Graphics class to draw various kinds of objects. Which part of the world is
+    shown is decided by the camera.
 
     Architecturally, the display manager looks at the environment, and shows it
     as it chooses, rather than having the environment tell the display manager
     how to show its various pieces.
     """
     def __init__(self, environment, screen_size):
-        self.environment = environment
         self.screen_size = screen_size
-        self.pixels_per_unit = 15 # TEMP, hardcoded zoom level.
-        flags = pg.HWSURFACE | pg.DOUBLEBUF
+        self.camera = Camera(screen_size)
+        # Only the changed parts of the screen are updated each frame, which
+        # needs a single buffered display.
+        flags = 0
         if FULLSCREEN:
             flags |= pg.FULLSCREEN
         self.screen = pg.display.set_mode(tuple(self.screen_size), flags)
 
-        self.screen_origin = vec.div(self.screen_size, 2)
+        self.fps = 0.0
+        # The TickScheduler running the physics, if any, to report on.
+        self.scheduler = None
+
+        # The background, with the static objects drawn on it. It covers a
+        # margin around the screen, so the view can pan that far before the
+        # background needs redrawing. The wall index and zoom it was drawn
+        # with, and its center, tell when it does, and the offset of the
+        # screen in it where the screen was last drawn from.
+        width, height = self.screen.get_size()
+        self.background_margin = (width // 4, height // 4)
+        margin_x, margin_y = self.background_margin
+        self.background = pg.Surface(
+            (width + 2 * margin_x, height + 2 * margin_y)).convert()
+        self.background_view = None
+        self.background_center = None
+        self.background_offset = None
+        # The parts of the screen drawn over in the last frame.
+        self.dirty_rects = []
+
+        self.set_environment(environment)
+
+        self.graphics = Graphics(self)
+
+    def set_environment(self, environment):
+        """Show a different environment, such as after seeking in a replay."""
+        self.environment = environment
 
         self.widgets = []
 
@@ -43,22 +73,86 @@ class Display(object):
             for i, inp in enumerate(self.environment.inputs):
                 self.widgets.append(JoystickWidget(self, inp, i))
         if SHOW_INFO:
-            self.fps = 0.0
             self.widgets.append(InfoWidget(self))
 
         self.widgets.append(HealthWidget(self, self.environment.players))
 
-        self.graphics = Graphics(self)
+    @property
+    def pixels_per_unit(self):
+        return self.camera.pixels_per_unit
 
-    def draw(self):
-        self.screen.fill(BG_COLOR)
+    def draw_background(self):
+        """Draw the static objects around the view into the background."""
+        self.background.fill(BG_COLOR)
+        margin_x, margin_y = self.background_margin
+        padding = max(margin_x, margin_y) / self.pixels_per_unit + 1
+        bounds = self.camera.view_bounds(padding=padding)
+        for w in self.environment.wall_index.query(bounds):
+            self.graphics.draw(w, self.background, self.background_margin)
 
+    def draw(self):
+        """
+        Draw a frame.
+
+        Static objects are drawn into the background once. Each frame, the
+        parts of the screen drawn over in the last frame are restored from the
+        background, then the moving objects and the widgets are drawn, and only
+        the parts of the screen that changed are updated. When the camera pans,
+        the whole screen is copied from a shifted part of the background, which
+        is only redrawn when the camera zooms or pans past its margin.
+        """
+        if FOLLOW_CAMERA:
+            self.camera.follow([
+                p.pos for p in self.environment.players
+                if not p.dead
+            ])
+        # Skip everything outside the view, padded for the widest lines drawn
+        # around objects.
+        x1, y1, x2, y2 = self.camera.view_bounds(padding=1)
+
+        # Find where the screen is in the background.
+        view = (self.environment.wall_index, self.pixels_per_unit)
+        margin_x, margin_y = self.background_margin
+        cx, cy = self.camera.center_pixels
+        if view == self.background_view:
+            bx, by = self.background_center
+            offset = (margin_x + cx - bx, margin_y + cy - by)
+        if (
+            view != self.background_view
+            or not 0 <= offset[0] <= 2 * margin_x
+            or not 0 <= offset[1] <= 2 * margin_y
+        ):
+            self.draw_background()
+            self.background_view = view
+            self.background_center = (cx, cy)
+            self.background_offset = None
+            offset = self.background_margin
+
+        full_update = offset != self.background_offset
+        if full_update:
+            self.screen.blit(
+                self.background, (0, 0), pg.Rect(offset, self.screen_size))
+            self.background_offset = offset
+        else:
+            for rect in self.dirty_rects:
+                self.screen.blit(self.background, rect, rect.move(offset))
+
+        rects = []
         for o in self.environment.objects:
-            self.graphics.draw(o)
+            if self.graphics.is_static(o):
+                continue
+            (x, y), r = o.pos, 2 * o.radius
+            if x + r < x1 or x - r > x2 or y + r < y1 or y - r > y2:
+                continue
+            rects.append(self.graphics.draw(o))
         for widget in self.widgets:
-            widget.draw(self.screen)
+            rects.append(widget.draw(self.screen))
 
-        pg.display.flip()
+        if full_update:
+            pg.display.flip()
+        else:
+            pg.display.update(self.dirty_rects + rects)
+        self.dirty_rects = rects
 
     def to_screen(self, pos):
         """Convert pos to screen coordinates.
@@ -66,27 +160,53 @@ class Display(object):
         Takes a tuple a world position, and returns a tuple for the
         screen position.
         """
-        x, y = vec.add(
-            self.screen_origin,
-            vec.mul(pos, self.pixels_per_unit),
-        )
-        return (int(x), int(y))
+        return self.camera.to_screen(pos)
 
     def set_fps(self, fps):
         self.fps = fps
 
 
+class TextCache(object):
+    """
+    Rendered lines of text, kept until they are needed again.
+
+    Most lines on the screen stay the same from one frame to the next, so
+    each line is only rendered the first time it is shown.
+    """
+    max_size = 256
+
+    def __init__(self, font, color):
+        self.font = font
+        self.color = color
+        self.surfaces = {}
+
+    def render(self, text):
+        surface = self.surfaces.get(text)
+        if surface is None:
+            if len(self.surfaces) >= self.max_size:
+                self.surfaces.clear()
+            surface = self.font.render(text, True, self.color)
+            self.surfaces[text] = surface
+        return surface
+
+
 class InfoWidget(object):
     text_color = (255, 255, 255)
 
     def __init__(self, display):
         self.display = display
         self.font = pg.font.SysFont(pg.font.get_default_font(), 20)
+        self.text_cache = TextCache(self.font, self.text_color)
 
     def text(self):
         lines = [
             '{:.0f} fps'.format(self.display.fps),
         ]
+        profiler = self.display.environment.profiler
+        if profiler is not None and profiler.recent is not None:
+            lines.extend(profiler.report(profiler.recent))
+        if self.display.scheduler is not None:
+            lines.extend(self.display.scheduler.report())
         for p in self.display.environment.players:
             lines.append(
                 'player {} speed: {:.1f}'.format(
@@ -99,15 +219,13 @@ class InfoWidget(object):
     def draw(self, screen):
         screen_width, _screen_height = self.display.screen_size
         y = 10
+        rects = []
         for line in self.text():
-            surface = self.font.render(
-                line,
-                True,
-                self.text_color,
-            )
+            surface = self.text_cache.render(line)
             x = screen_width - surface.get_width() - 10
-            screen.blit(surface, (x, y))
+            rects.append(screen.blit(surface, (x, y)))
             y += surface.get_height()
+        return rects[0].unionall(rects[1:])
 
 
 class JoystickWidget(object):
@@ -150,7 +268,7 @@ class JoystickWidget(object):
         _width, height = self.display.screen_size
         x = 10 + 30 * self.number
         y = height - self.surface.get_height() - 10
-        screen.blit(self.surface, (x, y))
+        return screen.blit(self.surface, (x, y))
 
 class HealthWidget(object):
     yellow = (255, 255, 0)
@@ -166,8 +284,21 @@ class HealthWidget(object):
         self.surface = pg.Surface(
             (self.bar_width * 2 + self.bar_separation, self.bar_height),
             pg.SRCALPHA, 32)
+        # The health shown on the bars, to only redraw them when it changes.
+        self.shown = None
 
     def draw(self, screen):
+        shown = [(p.player_health, p.damage) for p in self.players]
+        if shown != self.shown:
+            self.draw_bars()
+            self.shown = shown
+
+        screen_width, _screen_height = self.display.screen_size
+        x = screen_width // 2 - self.surface.get_width() // 2
+        y = 10
+        return screen.blit(self.surface, (x, y))
+
+    def draw_bars(self):
         self.surface.lock()
         if len(self.players) >= 2:
             # Bar 1
@@ -199,8 +330,3 @@ class HealthWidget(object):
                 (bar2_left + self.bar_width - fill, 0, fill, self.bar_height),
             )
         self.surface.unlock()
-
-        screen_width, _screen_height = self.display.screen_size
-        x = screen_width // 2 - self.surface.get_width() // 2
-        y = 10
-        screen.blit(self.surface, (x, y))
@@ -1,63 +1,735 @@
 from __future__ import division
 
-from player import Player
-from particle import Particle, collide_particles
-from wall import Wall
+import heapq
+import math
+import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from player import Player, heading_to_vector
+from particle import (
+    Particle, collide_particles, collide_particle_pairs, bounce_particles,
+    path_time_of_impact,
+)
+from wall import Wall, WallIndex, WallArrays, collide_walls_batch, swept_bounds
+from broadphase import make_broadphase
+from events import EventBus, KIND_NAMES, DAMAGE, DEATH
+from sleep import SleepTracker
+from levelfile import make_objects
+import levelfile
+import vec2 as vec
 import constants as c
 
 class Environment(object):
-    def __init__(self, inputs=None):
+    def __init__(
+        self,
+        inputs=None,
+        broadphase='grid',
+        vectorized=False,
+        continuous=True,
+        sleeping=True,
+        profiler=None,
+    ):
         if inputs is None:
             inputs = []
+        if vectorized and np is None:
+            raise ImportError('Vectorized physics requires numpy.')
         self.inputs = inputs
+        self.broadphase_name = broadphase
+        self.broadphase = make_broadphase(broadphase)
+        self.vectorized = vectorized
+        self.continuous = continuous
+        self.sleep_tracker = SleepTracker() if sleeping else None
+        self.profiler = profiler
+        self.store = None
+        # The particles that the broadphase was last run on, and their indices
+        # in the store.
+        self.simulated = None
+        self.simulated_index = None
+        self.tick = 0
+        self.recorder = None
+        # What happens in the simulation, for scoring, sound, effects and
+        # analytics to read. Deaths are found from the damage events.
+        self.events = EventBus()
+        self.damage_reader = self.events.reader([DAMAGE])
         self.objects = []
         self.players = []
         self.particles = []
         self.walls = []
+        self.wall_index = WallIndex(self.walls)
+        # The walls as arrays, for the vectorized physics.
+        self.wall_arrays = None
+        # Everything that was loaded, including players that have died since.
+        self.level_objects = []
+        self.level_particles = []
+
+    @property
+    def options(self):
+        """
+        The options that change how the simulation plays out, as keyword
+        arguments for a new Environment.
+        """
+        return dict(
+            broadphase=self.broadphase_name,
+            vectorized=self.vectorized,
+            continuous=self.continuous,
+            sleeping=self.sleep_tracker is not None,
+        )
 
     def load_level(self, level):
-        for object_class, args in level:
-            if isinstance(args, dict):
-                obj = object_class(**args)
-            else:
-                obj = object_class(*args)
-            self.objects.append(obj)
-            if isinstance(obj, Player):
-                self.players.append(obj)
-            if isinstance(obj, Particle):
-                self.particles.append(obj)
-            if isinstance(obj, Wall):
-                self.walls.append(obj)
+        self.add_objects(make_objects(level))
+        self.assign_inputs()
+
+    def load_level_file(self, path):
+        """
+        Load a level saved with levelfile.save().
 
+        For the vectorized physics, the ParticleStore is filled straight from
+        the arrays in the file.
+        """
+        level = levelfile.load(path)
+        walls = level.make_walls()
+        store = None
+        if self.vectorized:
+            columns = level.particle_columns()
+            n = len(columns['mass'])
+            # The particles are new, so they are awake and were last where
+            # they are now.
+            columns['last_pos'] = columns['pos']
+            columns['sleeping'] = np.zeros(n)
+            columns['idle_time'] = np.zeros(n)
+            columns['island'] = np.full(n, -1.0)
+            store = ParticleStore(level.make_particles(stored=True), columns)
+            particles = store.particles
+        else:
+            particles = level.make_particles()
+        self.add_objects(
+            particles + walls,
+            wall_index=level.make_wall_index(walls),
+            store=store,
+        )
+        self.assign_inputs()
+
+    def assign_inputs(self):
         for inp, p in zip(self.inputs, self.players):
             p.set_input(inp)
         for i, p in enumerate(self.players):
             p.number = i
 
+    def add_objects(self, objects, wall_index=None, store=None):
+        """
+        Add objects to the simulation, such as when a chunk of the world loads.
+
+        A prebuilt index of the walls can be given, which is used if it covers
+        exactly the walls of the environment afterward, and likewise a prebuilt
+        ParticleStore of the particles.
+        """
+        objects = list(objects)
+        particles = [o for o in objects if isinstance(o, Particle)]
+        players = [p for p in particles if isinstance(p, Player)]
+        for p in players:
+            p.events = self.events
+        self.objects.extend(objects)
+        self.level_objects.extend(objects)
+        self.players.extend(players)
+        self.particles.extend(particles)
+        self.level_particles.extend(particles)
+        self.walls.extend(o for o in objects if isinstance(o, Wall))
+
+        self.particles_changed(store)
+        if wall_index is not None and wall_index.walls == self.walls:
+            self.wall_index = wall_index
+        else:
+            self.wall_index = WallIndex(self.walls)
+        self.walls_changed()
+
+    def remove_objects(self, objects):
+        """Take objects out of the simulation, keeping their state."""
+        removed = set(objects)
+        for objs in [
+            self.objects,
+            self.level_objects,
+            self.players,
+            self.particles,
+            self.level_particles,
+            self.walls,
+        ]:
+            objs[:] = [o for o in objs if o not in removed]
+
+        self.particles_changed()
+        self.wall_index = WallIndex(self.walls)
+        self.walls_changed()
+
+    def walls_changed(self):
+        """Update internal state after the list of walls has changed."""
+        if self.vectorized:
+            self.wall_arrays = WallArrays(self.wall_index)
+
+    def particles_changed(self, store=None):
+        """
+        Update internal state after the list of particles has changed.
+
+        A prebuilt ParticleStore can be given, which is used if it holds
+        exactly the particles of the environment.
+        """
+        self.simulated = None
+        if self.vectorized:
+            if store is not None and store.particles != self.particles:
+                store.release()
+                store = None
+            if self.store is not None:
+                self.store.release()
+            if store is None:
+                store = ParticleStore(self.particles)
+            self.store = store
+        if self.sleep_tracker is not None:
+            self.sleep_tracker.reset(self.particles, self.level_particles, self.store)
+
+    # Snapshot layout. The header, with the number of events emitted so far,
+    # in all and of each kind, is followed by the particle state, then the
+    # player state, as flat arrays of doubles.
+    snapshot_header = struct.Struct('<qIIq{}q'.format(len(KIND_NAMES)))
+    # pos, last_pos, velocity, mass, restitution, sleeping, idle_time, island
+    particle_state_size = 11
+    player_state_size = 13
+
+    def snapshot(self):
+        """
+        Save the full simulation state into a flat binary buffer.
+
+        The buffer can be given to restore() on this environment, or on
+        another environment with the same level loaded.
+        """
+        header = self.snapshot_header.pack(
+            self.tick,
+            len(self.level_particles),
+            len(self.players),
+            self.events.count,
+            *self.events.kind_counts
+        )
+
+        if self.store is not None and len(self.particles) == len(self.level_particles):
+            store = self.store
+            particle_state = np.column_stack([
+                store.pos,
+                store.last_pos,
+                store.velocity,
+                store.mass,
+                store.restitution,
+                store.sleeping,
+                store.idle_time,
+                store.island,
+            ]).tobytes()
+        else:
+            particle_state = array('d', [
+                value
+                for p in self.level_particles
+                for value in p.pos + p.last_pos + p.velocity + (
+                    p.mass,
+                    p.restitution,
+                    p.sleeping,
+                    p.idle_time,
+                    p.island,
+                )
+            ]).tobytes()
+
+        values = array('d')
+        for p in self.players:
+            values.extend((
+                p.heading,
+                p.turning_time,
+                p.boost_charge_time,
+                p.boost_time_remaining,
+                p.boost_heavy_time_remaining,
+                p.damage,
+                p.dead,
+                -1 if p.death_tick is None else p.death_tick,
+                p.do_brake,
+                p.do_thrust,
+                p.turn_direction,
+            ))
+            values.extend(p.rudder_force)
+        return header + particle_state + values.tobytes()
+
+    def restore(self, snapshot):
+        """Restore the simulation state from a buffer made by snapshot()."""
+        header = self.snapshot_header.unpack_from(snapshot)
+        tick, num_particles, num_players, event_count = header[:4]
+        if (
+            num_particles != len(self.level_particles) or
+            num_players != len(self.players)
+        ):
+            raise ValueError('Snapshot does not match the loaded level.')
+        values = array('d')
+        values.frombytes(snapshot[self.snapshot_header.size:])
+        self.tick = tick
+        # The events of the ticks after the snapshot will be emitted again.
+        self.events.rewind(event_count, header[4:])
+
+        # Players first, since dying changes which particles are simulated.
+        offset = num_particles * self.particle_state_size
+        was_dead = [p.dead for p in self.players]
+        for p in self.players:
+            (
+                p.heading,
+                p.turning_time,
+                p.boost_charge_time,
+                p.boost_time_remaining,
+                p.boost_heavy_time_remaining,
+                p.damage,
+                dead,
+                death_tick,
+                do_brake,
+                do_thrust,
+                turn_direction,
+                rudder_x,
+                rudder_y,
+            ) = values[offset:offset + self.player_state_size]
+            offset += self.player_state_size
+            p.direction = heading_to_vector(p.heading)
+            p.dead = bool(dead)
+            p.death_tick = None if death_tick < 0 else int(death_tick)
+            p.do_brake = bool(do_brake)
+            p.do_thrust = bool(do_thrust)
+            p.turn_direction = int(turn_direction)
+            p.rudder_force = (rudder_x, rudder_y)
+        if was_dead != [p.dead for p in self.players]:
+            self.objects[:] = [
+                o for o in self.level_objects
+                if not (isinstance(o, Player) and o.dead)
+            ]
+            self.particles[:] = [
+                p for p in self.level_particles
+                if not (isinstance(p, Player) and p.dead)
+            ]
+            self.particles_changed()
+
+        size = self.particle_state_size
+        if self.store is not None and len(self.particles) == num_particles:
+            state = np.frombuffer(
+                snapshot,
+                dtype=float,
+                count=num_particles * size,
+                offset=self.snapshot_header.size,
+            ).reshape((num_particles, size))
+            store = self.store
+            store.pos[:] = state[:, 0:2]
+            store.last_pos[:] = state[:, 2:4]
+            store.velocity[:] = state[:, 4:6]
+            store.mass[:] = state[:, 6]
+            store.restitution[:] = state[:, 7]
+            store.sleeping[:] = state[:, 8]
+            store.idle_time[:] = state[:, 9]
+            store.island[:] = state[:, 10]
+        else:
+            values = values.tolist()
+            for i, p in enumerate(self.level_particles):
+                k = i * size
+                p.pos = (values[k], values[k + 1])
+                p.last_pos = (values[k + 2], values[k + 3])
+                p.velocity = (values[k + 4], values[k + 5])
+                p.mass = values[k + 6]
+                p.restitution = values[k + 7]
+                p.sleeping = bool(values[k + 8])
+                p.idle_time = values[k + 9]
+                p.island = int(values[k + 10])
+        self.simulated = None
+        if self.sleep_tracker is not None:
+            self.sleep_tracker.reset(self.particles, self.level_particles, self.store)
+
     def update(self, elapsed_ticks):
         elapsed_seconds = elapsed_ticks / 1000
 
-        #TODO: Use collision algorithms faster than O(n**2).
+        if self.recorder is not None:
+            self.recorder.record(self.tick, self.inputs, elapsed_ticks)
+
+        self.events.tick = self.tick
+
+        # The profiler checks are spelled out, so they cost next to nothing
+        # when there is no profiler.
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_tick()
+        particles = self.awake_particles()
+        if profiler is not None:
+            profiler.lap('sleep')
+        index_pairs = self.collide_pairs(particles)
+        if profiler is not None:
+            profiler.lap('pairs')
+        self.collide_walls(particles)
+        if profiler is not None:
+            profiler.lap('walls')
+        self.integrate(particles, elapsed_seconds)
+        if profiler is not None:
+            profiler.lap('integrate')
+        if self.continuous:
+            self.collide_fast_particles(particles, elapsed_seconds)
+            if profiler is not None:
+                profiler.lap('continuous')
+        if self.sleep_tracker is not None:
+            self.sleep_tracker.update(elapsed_seconds, particles, index_pairs)
+            if profiler is not None:
+                profiler.lap('sleep')
+        self.check_deaths()
+        if profiler is not None:
+            profiler.lap('deaths')
+            profiler.end_tick()
+
+        self.tick += 1
 
-        # Particle collisions.
-        for (p1, p2) in every_pair(self.particles):
-            collide_particles(p1, p2)
+    def awake_particles(self):
+        """
+        Find the particles to simulate this tick.
 
-        # Wall-particle collisions.
-        for w in self.walls:
-            for p in self.particles:
-                w.collide_wall(p)
+        Only particles that are awake are simulated. Sleeping particles that
+        are touched by a moving one wake up first, to take part in the
+        collision.
+        """
+        if self.sleep_tracker is not None:
+            self.sleep_tracker.wake_touching()
+            particles = self.sleep_tracker.awake
+        else:
+            particles = self.particles
+        if particles is not self.simulated:
+            self.simulated = particles
+            self.broadphase.reset()
+            if self.store is not None and self.sleep_tracker is not None:
+                self.simulated_index = self.sleep_tracker.awake_index
+            elif self.store is not None:
+                self.simulated_index = np.array(
+                    [p.index for p in particles],
+                    dtype=int,
+                )
+        return particles
 
-        for o in self.particles:
-            o.update(elapsed_seconds)
+    def collide_pairs(self, particles):
+        """
+        Collide every pair of touching particles.
 
-        # Check whether a player has won.
+        Returns the candidate pairs of indices into particles that the
+        broadphase found, as a list of (i, j) tuples, or a PairArrays for the
+        vectorized physics.
+        """
+        if self.store is not None:
+            # The pairs stay as index arrays, all the way to the narrowphase.
+            index = self.simulated_index
+            index_pairs = self.broadphase.index_pair_arrays(
+                self.store.pos[index],
+                self.store.radius[index],
+            )
+            contacts = collide_particle_pairs(
+                self.store,
+                index[index_pairs.first],
+                index[index_pairs.second],
+                self.events,
+            )
+        else:
+            positions = [p.pos for p in particles]
+            radii = [p.radius for p in particles]
+            index_pairs = self.broadphase.index_pairs(positions, radii)
+            contacts = 0
+            events = self.events
+            for i, j in index_pairs:
+                if collide_particles(particles[i], particles[j], events):
+                    contacts += 1
+        if self.profiler is not None:
+            self.profiler.count(pairs_tested=len(index_pairs), contacts=contacts)
+        return index_pairs
+
+    def collide_walls(self, particles):
+        # Only test walls near the path the particle took this tick. Hitting
+        # a wall can move the particle by up to its radius, so we pad the
+        # path by twice the radius to still find every wall it could touch
+        # afterward.
+        if self.store is not None:
+            tests, hits = collide_walls_batch(
+                self.store,
+                self.simulated_index,
+                self.wall_arrays,
+                self.events,
+            )
+            if self.profiler is not None:
+                self.profiler.count(wall_tests=tests, wall_hits=hits)
+            return
+        tests = 0
+        hits = 0
+        for p in particles:
+            p_tests, p_hits = self.collide_particle_walls(p)
+            tests += p_tests
+            hits += p_hits
+        if self.profiler is not None:
+            self.profiler.count(wall_tests=tests, wall_hits=hits)
+
+    def collide_particle_walls(self, p):
+        """
+        Collide one particle with the walls near its last path, and return the
+        number of walls tested, and the number hit.
+        """
+        bounds = swept_bounds(p, 2 * p.radius)
+        walls = self.wall_index.query(bounds)
+        hits = 0
+        for w in walls:
+            hits += w.collide_wall(p, bounds, self.events)
+        return len(walls), hits
+
+    def integrate(self, particles, elapsed_seconds):
+        """Apply forces and drag, and move the particles."""
+        if self.store is not None:
+            for p in self.players:
+                if p.dead:
+                    continue
+                p.update_state(elapsed_seconds)
+                force, extra_drag = p.update_physics(elapsed_seconds)
+                self.store.force[p.index] = force
+                self.store.extra_drag[p.index] = extra_drag
+            # Sleeping particles are at rest, so integrating them changes
+            # nothing, and is cheaper than picking out the awake ones.
+            self.store.integrate(elapsed_seconds)
+        else:
+            for o in particles:
+                o.update(elapsed_seconds)
+
+    def check_deaths(self):
+        """
+        Kill the players that have taken more damage than their health, and
+        emit their deaths.
+
+        Only the players that took damage since the last check are looked at,
+        as found from the damage events.
+        """
+        events = self.events
+        reader = self.damage_reader
+        dropped = reader.dropped
+        damaged = set(e.first for e in reader.read())
+        if reader.dropped != dropped:
+            # Some damage was written over before it was read.
+            damaged = set(self.players)
         for p in self.players:
-            if not p.dead and p.damage > p.player_health:
-                print('Player {} is dead.'.format(p.number + 1))
+            if p in damaged and not p.dead and p.damage > p.player_health:
                 p.dead = True
+                p.death_tick = self.tick
                 self.objects.remove(p)
                 self.particles.remove(p)
+                self.particles_changed()
+                events.emit(DEATH, p, None, p.damage, p.pos)
+
+    def collide_fast_particles(self, awake, elapsed_seconds):
+        """
+        Catch collisions that happened during the tick between fast particles.
+
+        The regular particle collisions only check for overlap at the end of a
+        tick, so a particle that moves farther than its radius in one tick can
+        pass through another one. For those fast particles only, we find the
+        time of impact along their paths, and split the tick there: the
+        particles move to the point of impact, collide, and then use the rest
+        of the tick to move on with their new velocities. The new paths are
+        checked for impacts in turn, up to c.max_impacts for each particle.
+        They are checked against the walls by collide_walls, on the next tick.
+
+        The pairs to test are found with a grid over the bounding boxes of the
+        paths, so each particle is only tested against the ones near it. Only
+        the awake particles can be fast, and the grid is only built when one
+        of them is.
+        """
+        particles = self.particles
+        # Each particle is indexed by the grid cell that the low corner of the
+        # bounds of its path is in. The cells are as big as the biggest
+        # bounds, so a box can only overlap bounds whose corner is in the
+        # cells it covers, or in the ones just below or left of those.
+        if self.store is not None:
+            store = self.store
+            index = self.simulated_index
+            motion = store.pos[index] - store.last_pos[index]
+            fast = index[
+                motion[:, 0]**2 + motion[:, 1]**2 > store.radius[index]**2
+            ].tolist()
+            if not fast:
+                return
+            low = np.minimum(store.pos, store.last_pos) - store.radius[:, np.newaxis]
+            high = np.maximum(store.pos, store.last_pos) + store.radius[:, np.newaxis]
+            bounds = np.column_stack([low, high]).tolist()
+            cell_size = (high - low).max() or 1.0
+            # The cells are kept as codes that sort by column, then row, so
+            # the particles in a column of cells are a run of the sorted
+            # particles.
+            cell_xy = np.floor(low / cell_size).astype(int)
+            cell_min = cell_xy.min(axis=0) - 1
+            cell_max = cell_xy.max(axis=0) + 1
+            stride = cell_max[1] - cell_min[1] + 1
+            codes = (cell_xy[:, 0] - cell_min[0]) * stride + (cell_xy[:, 1] - cell_min[1])
+            order = np.argsort(codes, kind='stable')
+            sorted_codes = codes[order]
+            cell_min = cell_min.tolist()
+            cell_max = cell_max.tolist()
+
+            def cell_members(cx1, cy1, cx2, cy2):
+                cx1, cy1 = max(cx1, cell_min[0]), max(cy1, cell_min[1])
+                cx2, cy2 = min(cx2, cell_max[0]), min(cy2, cell_max[1])
+                if cx1 > cx2 or cy1 > cy2:
+                    return []
+                columns = np.arange(cx1, cx2 + 1) - cell_min[0]
+                starts = np.searchsorted(sorted_codes, columns * stride + (cy1 - cell_min[1]))
+                ends = np.searchsorted(sorted_codes, columns * stride + (cy2 - cell_min[1]), 'right')
+                return np.concatenate([
+                    order[start:end] for start, end in zip(starts, ends)
+                ]).tolist()
+        else:
+            for p in awake:
+                (x1, y1), (x2, y2) = p.last_pos, p.pos
+                if (x2 - x1)**2 + (y2 - y1)**2 > p.radius**2:
+                    break
+            else:
+                return
+            # Sleeping particles stay put, so the fast ones are all awake.
+            fast = []
+            bounds = []
+            cell_size = 0.0
+            for i, p in enumerate(particles):
+                (x1, y1), (x2, y2) = p.last_pos, p.pos
+                r = p.radius
+                if (x2 - x1)**2 + (y2 - y1)**2 > r**2:
+                    fast.append(i)
+                box = (
+                    min(x1, x2) - r, min(y1, y2) - r,
+                    max(x1, x2) + r, max(y1, y2) + r,
+                )
+                bounds.append(box)
+                cell_size = max(cell_size, box[2] - box[0], box[3] - box[1])
+            if not fast:
+                return
+            cell_size = cell_size or 1.0
+            cells = {}
+            floor = math.floor
+            for k, (x1, y1, _, _) in enumerate(bounds):
+                key = (int(floor(x1 / cell_size)), int(floor(y1 / cell_size)))
+                cells.setdefault(key, []).append(k)
+
+            def cell_members(cx1, cy1, cx2, cy2):
+                members = []
+                for cx in range(cx1, cx2 + 1):
+                    for cy in range(cy1, cy2 + 1):
+                        members.extend(cells.get((cx, cy), ()))
+                return members
+
+        # The particles that collided move along new paths for the rest of the
+        # tick, kept as (start_time, start, end), with times as fractions of
+        # the tick. An impact found on an old path is out of date.
+        paths = {}
+        versions = {}
+        impact_counts = {}
+        moved = []
+        moved_set = set()
+        impacts = []
+
+        def path(i):
+            if i in paths:
+                return paths[i]
+            p = particles[i]
+            return (0.0, p.last_pos, p.pos)
+
+        def near(i):
+            """Find the particles whose paths may come near that of i."""
+            x1, y1, x2, y2 = bounds[i]
+            candidates = cell_members(
+                int(math.floor(x1 / cell_size)) - 1,
+                int(math.floor(y1 / cell_size)) - 1,
+                int(math.floor(x2 / cell_size)),
+                int(math.floor(y2 / cell_size)),
+            )
+            # Particles that moved are listed separately, with new bounds
+            # that may be bigger than a cell.
+            candidates = [j for j in candidates if j not in moved_set]
+            candidates.extend(moved)
+            for j in candidates:
+                bx1, by1, bx2, by2 = bounds[j]
+                if j != i and not (bx1 > x2 or x1 > bx2 or by1 > y2 or y1 > by2):
+                    yield j
+
+        def find_impacts(i, others):
+            p1 = particles[i]
+            path1 = path(i)
+            for j in others:
+                p2 = particles[j]
+                if p1.immovable and p2.immovable:
+                    continue
+                path2 = path(j)
+                start = max(path1[0], path2[0])
+                if start >= 1:
+                    continue
+                t = path_time_of_impact(
+                    position_at(path1, start), path1[2],
+                    position_at(path2, start), path2[2],
+                    p1.radius + p2.radius,
+                )
+                if t is not None:
+                    a, b = min(i, j), max(i, j)
+                    heapq.heappush(impacts, (
+                        start + t * (1 - start), a, b,
+                        versions.get(a, 0), versions.get(b, 0),
+                    ))
+
+        fast_set = set(fast)
+        for i in fast:
+            # Pairs of fast particles are found from the first of them.
+            find_impacts(i, (j for j in near(i) if not (j in fast_set and j < i)))
+
+        # Resolve the impacts in time order.
+        while impacts:
+            t, i, j, version_i, version_j = heapq.heappop(impacts)
+            if (
+                versions.get(i, 0) != version_i or
+                versions.get(j, 0) != version_j or
+                impact_counts.get(i, 0) >= c.max_impacts or
+                impact_counts.get(j, 0) >= c.max_impacts
+            ):
+                continue
+            p1 = particles[j]
+            p2 = particles[i]
+            for k, p in [(j, p1), (i, p2)]:
+                if self.sleep_tracker is not None:
+                    self.sleep_tracker.wake(p)
+                p.pos = position_at(path(k), t)
+            bounce_particles(p1, p2, self.events)
+            remaining = (1 - t) * elapsed_seconds
+            for k, p in [(j, p1), (i, p2)]:
+                end = vec.add(p.pos, vec.mul(p.velocity, remaining))
+                paths[k] = (t, p.pos, end)
+                versions[k] = versions.get(k, 0) + 1
+                impact_counts[k] = impact_counts.get(k, 0) + 1
+                (x1, y1), (x2, y2) = p.pos, end
+                r = p.radius
+                bounds[k] = (
+                    min(x1, x2) - r, min(y1, y2) - r,
+                    max(x1, x2) + r, max(y1, y2) + r,
+                )
+                if k not in moved_set:
+                    moved_set.add(k)
+                    moved.append(k)
+            for k in (j, i):
+                if impact_counts[k] < c.max_impacts:
+                    find_impacts(k, near(k))
+
+        # Move the particles that collided to the end of their new paths. The
+        # walls along the new paths are hit at the start of the next tick, as
+        # for every other particle, so each hit is resolved only once.
+        for k in moved:
+            p = particles[k]
+            _, p.last_pos, p.pos = paths[k]
+        if self.profiler is not None:
+            self.profiler.count(impacts=sum(impact_counts.values()) // 2)
+
+
+def position_at(path, t):
+    """Find the position along a (start_time, start, end) path at time t."""
+    start_time, start, end = path
+    if t == start_time:
+        return start
+    amount = (t - start_time) / (1 - start_time)
+    return vec.add(start, vec.mul(vec.vfrom(start, end), amount))
 
 
 def every_pair(iterable):
@@ -72,3 +744,143 @@ def every_pair(iterable):
                 break
             else:
                 yield a, b
+
+
+class ParticleStore(object):
+    """
+    Structure-of-arrays storage for particle state.
+
+    The state of every particle is kept in contiguous numpy arrays, so that
+    the physics can be done for all particles at once. The particles
+    themselves become thin views onto their row of the arrays, so the rest of
+    the game can keep using them as ordinary objects.
+    """
+    vector_fields = ['pos', 'last_pos', 'velocity']
+    scalar_fields = [
+        'mass', 'radius', 'restitution', 'drag_rate',
+        'sleeping', 'idle_time', 'island',
+    ]
+
+    def __init__(self, particles, columns=None):
+        """
+        Store the state of the particles, and turn them into views.
+
+        columns can hold the state instead, as an array for each field, with
+        one value or one (x, y) row per particle. Then particles that have no
+        state of their own besides can be given as just their class, and views
+        of that class are made for them without calling their constructor, as
+        for the particles of a level file.
+        """
+        self.particles = list(particles)
+        n = len(self.particles)
+        if columns is None:
+            columns = dict(
+                (name, [getattr(p, name) for p in self.particles])
+                for name in self.vector_fields + self.scalar_fields
+            )
+        for name in self.vector_fields:
+            setattr(self, name, np.array(
+                columns[name],
+                dtype=float,
+            ).reshape((n, 2)))
+        for name in self.scalar_fields:
+            setattr(self, name, np.array(
+                columns[name],
+                dtype=float,
+            ))
+        self.immovable = np.array(
+            [p.immovable for p in self.particles],
+            dtype=bool,
+        )
+        self.is_player = np.array(
+            [isinstance(p, Player) for p in self.particles],
+            dtype=bool,
+        )
+        # Per-tick force and extra drag, set by players before integration.
+        self.force = np.zeros((n, 2))
+        self.extra_drag = np.zeros(n)
+
+        for i, p in enumerate(self.particles):
+            if isinstance(p, type):
+                cls = stored_class(p)
+                p = self.particles[i] = cls.__new__(cls)
+            else:
+                for name in self.vector_fields + self.scalar_fields:
+                    p.__dict__.pop(name, None)
+                p.__class__ = stored_class(type(p))
+            p.store = self
+            p.index = i
+
+    def release(self):
+        """Turn the particles back into ordinary objects holding their state."""
+        for p in self.particles:
+            state = {}
+            for name in self.vector_fields + self.scalar_fields:
+                state[name] = getattr(p, name)
+            p.__class__ = p.unstored_class
+            del p.store
+            del p.index
+            p.__dict__.update(state)
+
+    def integrate(self, elapsed_seconds):
+        """Do the work of Particle.update for every particle at once."""
+        velocity = self.velocity
+
+        # Apply force.
+        velocity += self.force * (elapsed_seconds / self.mass)[:, np.newaxis]
+        self.force[:] = 0
+
+        # Apply drag.
+        drag = (self.drag_rate + self.extra_drag) * elapsed_seconds
+        self.extra_drag[:] = 0
+        speed = np.sqrt(velocity[:, 0]**2 + velocity[:, 1]**2)
+        stopped = drag > speed
+        slowed = ~stopped & (drag != 0)
+        velocity[stopped] = 0
+        velocity[slowed] += (
+            velocity[slowed] * (-drag[slowed] / speed[slowed])[:, np.newaxis]
+        )
+
+        # Limit to maximum speed.
+        speed = np.sqrt(velocity[:, 0]**2 + velocity[:, 1]**2)
+        fast = speed > c.max_speed
+        velocity[fast] *= (c.max_speed / speed[fast])[:, np.newaxis]
+
+        # Update position based on velocity.
+        self.last_pos[:] = self.pos
+        self.pos += velocity * elapsed_seconds
+
+
+class StoredParticle(object):
+    """Mixin that makes a particle a view onto a ParticleStore."""
+
+def _vector_field(name):
+    def get(self):
+        return tuple(getattr(self.store, name)[self.index].tolist())
+    def set(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(get, set)
+
+def _scalar_field(name):
+    def get(self):
+        return getattr(self.store, name)[self.index].item()
+    def set(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(get, set)
+
+for _name in ParticleStore.vector_fields:
+    setattr(StoredParticle, _name, _vector_field(_name))
+for _name in ParticleStore.scalar_fields:
+    setattr(StoredParticle, _name, _scalar_field(_name))
+
+_stored_classes = {}
+
+def stored_class(cls):
+    """Find the view class for particles of the given class."""
+    if cls not in _stored_classes:
+        _stored_classes[cls] = type(
+            cls.__name__,
+            (StoredParticle, cls),
+            dict(unstored_class=cls),
+        )
+    return _stored_classes[cls]
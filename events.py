@@ -0,0 +1,239 @@
+"""
+A record of what happens in the simulation, for scoring, sound, effects and
+analytics to consume.
+
+The physics emits an event for every collision, wall hit, damage and death
+into an EventBus, a ring buffer allocated up front, so emitting costs a few
+list stores and only allocates when a busier tick than ever before makes the
+buffer grow. Consumers each keep an EventReader, and
+read the events that happened since their last read in one batch, instead of
+scanning the state of every object to find out what changed.
+"""
+from __future__ import division
+
+from collections import namedtuple
+
+# The kinds of events.
+COLLISION = 0 # Two particles bounced off each other.
+WALL = 1 # A particle bounced off a wall, the second participant.
+DAMAGE = 2 # A player took damage, given as the impulse.
+DEATH = 3 # A player died.
+KIND_NAMES = ['collision', 'wall', 'damage', 'death']
+
+Event = namedtuple('Event', 'kind tick first second impulse point')
+Event.__doc__ = """
+Something that happened during a tick.
+
+first and second are the objects involved, with second None for damage and
+deaths. impulse is the change in momentum, and point where it happened.
+"""
+
+
+class EventBus(object):
+    """
+    A ring buffer of the most recent events.
+
+    The events are stored in parallel lists, and once they are full, the
+    oldest events are written over. count is the number of events ever
+    emitted, and kind_counts the number of each kind, so readers can tell
+    cheaply whether anything new happened. Set tick before emitting the
+    events of a tick.
+
+    The lists double in size whenever the events of one tick would take more
+    than a ticks_kept share of them, so a reader that reads every few ticks
+    never misses any.
+
+    When the simulation goes back to an earlier tick, rewind() takes back the
+    events emitted since, so they aren't seen twice when the ticks are
+    simulated again.
+    """
+    # The lists of event values, and what they are filled with.
+    fields = [
+        ('kinds', 0), ('ticks', 0), ('firsts', None), ('seconds', None),
+        ('impulses', 0.0), ('xs', 0.0), ('ys', 0.0),
+    ]
+
+    def __init__(self, capacity=4096, ticks_kept=8):
+        self.capacity = capacity
+        self.ticks_kept = ticks_kept
+        for name, value in self.fields:
+            setattr(self, name, [value] * capacity)
+        self.count = 0
+        self.kind_counts = [0] * len(KIND_NAMES)
+        self.tick = 0
+        # The number of the first event that was not taken back or skipped.
+        self.first = 0
+
+    @property
+    def tick(self):
+        return self._tick
+
+    @tick.setter
+    def tick(self, tick):
+        self._tick = tick
+        self.tick_start = self.count
+
+    def make_room(self, n):
+        """Grow the lists if needed, before emitting n more events this tick."""
+        needed = self.count - self.tick_start + n
+        if needed * self.ticks_kept <= self.capacity:
+            return
+        old_capacity = self.capacity
+        oldest = self.oldest
+        capacity = old_capacity
+        while needed * self.ticks_kept > capacity:
+            capacity *= 2
+        for name, value in self.fields:
+            old = getattr(self, name)
+            new = [value] * capacity
+            for number in range(oldest, self.count):
+                new[number % capacity] = old[number % old_capacity]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def emit(self, kind, first, second=None, impulse=0.0, point=(0.0, 0.0)):
+        if (self.count - self.tick_start + 1) * self.ticks_kept > self.capacity:
+            self.make_room(1)
+        k = self.count % self.capacity
+        self.kinds[k] = kind
+        self.ticks[k] = self.tick
+        self.firsts[k] = first
+        self.seconds[k] = second
+        self.impulses[k] = impulse
+        self.xs[k], self.ys[k] = point
+        self.count += 1
+        self.kind_counts[kind] += 1
+
+    def emit_many(self, kind, firsts, seconds, impulses, xs, ys):
+        """Emit events of one kind from lists of their values."""
+        n = len(firsts)
+        self.make_room(n)
+        start = self.count % self.capacity
+        # Fill up to the end of the lists, then wrap around to the start.
+        for begin, end, offset in [
+            (start, min(start + n, self.capacity), 0),
+            (0, start + n - self.capacity, self.capacity - start),
+        ]:
+            if end <= begin:
+                continue
+            size = end - begin
+            self.kinds[begin:end] = [kind] * size
+            self.ticks[begin:end] = [self.tick] * size
+            self.firsts[begin:end] = firsts[offset:offset + size]
+            self.seconds[begin:end] = seconds[offset:offset + size]
+            self.impulses[begin:end] = impulses[offset:offset + size]
+            self.xs[begin:end] = xs[offset:offset + size]
+            self.ys[begin:end] = ys[offset:offset + size]
+        self.count += n
+        self.kind_counts[kind] += n
+
+    @property
+    def oldest(self):
+        """The number of the oldest event still in the buffer."""
+        return max(self.first, self.count - self.capacity)
+
+    def rewind(self, count, kind_counts):
+        """
+        Go back to when count events had been emitted, kind_counts of each
+        kind. The events after are taken back. Going forward instead skips
+        the events in between, which are not known.
+        """
+        if count > self.count:
+            self.first = count
+        else:
+            # The events that were written over by the ones taken back are
+            # gone too.
+            self.first = min(self.oldest, count)
+        self.count = count
+        self.kind_counts = list(kind_counts)
+        self.tick_start = count
+
+    def event(self, number):
+        """Get an event by its number, which must still be in the buffer."""
+        k = number % self.capacity
+        return Event(
+            self.kinds[k],
+            self.ticks[k],
+            self.firsts[k],
+            self.seconds[k],
+            self.impulses[k],
+            (self.xs[k], self.ys[k]),
+        )
+
+    def reader(self, kinds=None):
+        return EventReader(self, kinds)
+
+
+class EventReader(object):
+    """
+    Reads the events of a bus in batches, starting from when it was made.
+
+    kinds are the kinds of events to read, by default all of them. If the
+    reader falls so far behind that events of its kinds were written over
+    before it read them, it counts them as dropped.
+
+    The reader keeps the number of events of its kinds up to its cursor, so
+    when none of them were emitted since the last read, reading only
+    compares the counts.
+    """
+    def __init__(self, bus, kinds=None):
+        self.bus = bus
+        self.kinds = None if kinds is None else set(kinds)
+        self.dropped = 0
+        self.skip()
+
+    def kind_count(self):
+        """The number of events of the kinds read that were emitted."""
+        if self.kinds is None:
+            return self.bus.count
+        counts = self.bus.kind_counts
+        return sum(counts[kind] for kind in self.kinds)
+
+    def skip(self):
+        """Skip over the events so far, without reading them."""
+        self.cursor = self.bus.count
+        self.seen = self.kind_count()
+
+    def read(self, before=None):
+        """
+        Get the events since the last read, oldest first.
+
+        Given a tick, only the events of the ticks before it are read, and
+        the rest are left for the next read.
+        """
+        bus = self.bus
+        end = bus.count
+        if self.cursor > end:
+            # Events that were read were taken back.
+            self.skip()
+            return []
+        total = self.kind_count()
+        if total == self.seen:
+            self.cursor = end
+            return []
+
+        kinds = self.kinds
+        capacity = bus.capacity
+        start = max(self.cursor, bus.oldest)
+        seen = self.seen
+        if start > self.cursor:
+            # Whatever events of our kinds are not left in the buffer were
+            # written over.
+            left = sum(
+                1 for n in range(start, end)
+                if kinds is None or bus.kinds[n % capacity] in kinds
+            )
+            dropped = total - seen - left
+            self.dropped += dropped
+            seen += dropped
+        events = []
+        for n in range(start, end):
+            k = n % capacity
+            if before is not None and bus.ticks[k] >= before:
+                end = n
+                break
+            if kinds is None or bus.kinds[k] in kinds:
+                events.append(bus.event(n))
+        self.cursor = end
+        self.seen = seen + len(events)
+        return events
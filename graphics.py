@@ -21,17 +21,39 @@ PLAYER_COLORS = [
 ]
 
 class Graphics(object):
+    # Objects that never move, which can be drawn once into the background.
+    static_types = set(['wall', 'polyline'])
+
     def __init__(self, display):
         self.display = display
+        self.surface = display.screen
+        self.offset = (0, 0)
+        self.drawn = []
+
+    def draw(self, obj, surface=None, offset=(0, 0)):
+        """
+        Draw an object, by default onto the screen. The offset is added to the
+        screen position, to draw onto a surface bigger than the screen.
 
-    def draw(self, obj):
+        Returns the rectangle that was drawn over.
+        """
         drawing_functions = {
             'player': self.draw_player,
             'particle': self.draw_particle,
             'bumper': self.draw_bumper,
             'wall': self.draw_wall,
+            'polyline': self.draw_polyline,
         }
+        self.surface = surface or self.display.screen
+        self.offset = offset
+        self.drawn = []
         drawing_functions[obj.graphics_type](obj)
+        if len(self.drawn) == 1:
+            return self.drawn[0]
+        return self.drawn[0].unionall(self.drawn[1:])
+
+    def is_static(self, obj):
+        return obj.graphics_type in self.static_types
 
     def draw_particle(self, particle):
         self.circle(PARTICLE_COLOR, particle.pos, particle.radius)
@@ -93,22 +115,31 @@ class Graphics(object):
     def draw_wall(self, wall):
         self.line(WALL_COLOR, wall.p1, wall.p2, .25)
 
+    def draw_polyline(self, polyline):
+        for p1, p2 in zip(polyline.vertices, polyline.vertices[1:]):
+            self.line(WALL_COLOR, p1, p2, .25)
+        if polyline.closed:
+            self.line(WALL_COLOR, polyline.vertices[-1], polyline.vertices[0], .25)
+
     # Drawing utility functions.
 
+    def to_surface(self, pos):
+        return vec.add(self.display.to_screen(pos), self.offset)
+
     def line(self, color, a, b, width):
-        pg.draw.line(
-            self.display.screen,
+        self.drawn.append(pg.draw.line(
+            self.surface,
             color,
-            self.display.to_screen(a),
-            self.display.to_screen(b),
+            self.to_surface(a),
+            self.to_surface(b),
             max(1, int(width * self.display.pixels_per_unit)),
-        )
+        ))
 
     def circle(self, color, center, radius, width=0):
-        pg.draw.circle(
-            self.display.screen,
+        self.drawn.append(pg.draw.circle(
+            self.surface,
             color,
-            self.display.to_screen(center),
+            self.to_surface(center),
             int(radius * self.display.pixels_per_unit),
             int(width * self.display.pixels_per_unit),
-        )
+        ))
@@ -0,0 +1,145 @@
+"""
+Run the simulation without a display.
+
+The environment is stepped as fast as possible, with scripted or recorded
+inputs standing in for the keyboard.
+
+Usage:
+    python headless.py [level] [--ticks N] [--broadphase NAME] [--vectorized]
+        [--profile]
+"""
+from __future__ import division, print_function
+
+import argparse
+import time
+from collections import namedtuple
+
+from environment import Environment
+from player import Player
+from profiler import Profiler
+import levels
+import constants as c
+
+
+class ScriptedInput(object):
+    """
+    An input that follows a script instead of polling the keyboard.
+
+    It has the same attributes as an InputManager. The keyword arguments give
+    the starting value of each attribute, and decide which control scheme the
+    player uses, thrust and turn direction by default, or x and y axes.
+
+    The script is a list of (tick, state) pairs in tick order, where state is
+    a dictionary of attribute values that take effect on that tick.
+    """
+    def __init__(self, script=(), **initial):
+        if not initial:
+            initial = dict(thrust=False, brake=False, turn_direction=0)
+        for key, value in initial.items():
+            setattr(self, key, value)
+        self.script = list(script)
+        self.position = 0
+
+    def update(self, tick):
+        while (
+            self.position < len(self.script) and
+            self.script[self.position][0] <= tick
+        ):
+            _, state = self.script[self.position]
+            for key, value in state.items():
+                setattr(self, key, value)
+            self.position += 1
+
+
+RunResult = namedtuple('RunResult', 'env ticks seconds ticks_per_second')
+
+def run(
+    level,
+    inputs=None,
+    ticks=c.physics_fps * 60,
+    stop_on_death=False,
+    **environment_options
+):
+    """
+    Simulate a level for the given number of ticks, as fast as possible.
+
+    Each input is updated with the tick number before every physics tick.
+    Returns a RunResult with the final environment and the simulation speed.
+    """
+    env = Environment(inputs, **environment_options)
+    env.load_level(level)
+
+    start = time.time()
+    tick = 0
+    while tick < ticks:
+        for inp in env.inputs:
+            inp.update(tick)
+        env.update(c.physics_tick_ms)
+        tick += 1
+        if stop_on_death and any(p.dead for p in env.players):
+            break
+    seconds = time.time() - start
+
+    return RunResult(
+        env=env,
+        ticks=tick,
+        seconds=seconds,
+        ticks_per_second=tick / seconds if seconds > 0 else float('inf'),
+    )
+
+def report(result):
+    """Print the simulation speed and final state of a run."""
+    print('{} ticks in {:.3f} seconds, {:.0f} ticks per second ({:.1f}x real time)'.format(
+        result.ticks,
+        result.seconds,
+        result.ticks_per_second,
+        result.ticks_per_second / c.physics_fps,
+    ))
+    for p in result.env.players:
+        print('player {}: pos ({:.2f}, {:.2f}), speed {:.2f}, damage {:.1f}{}'.format(
+            p.number + 1,
+            p.pos[0],
+            p.pos[1],
+            p.speed,
+            p.damage,
+            ', dead' if p.dead else '',
+        ))
+    print('{} particles, {} walls'.format(
+        len(result.env.particles),
+        len(result.env.walls),
+    ))
+    if result.env.profiler is not None:
+        print('per tick:')
+        for line in result.env.profiler.report():
+            print('    ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('level', nargs='?', default='versus')
+    parser.add_argument('--ticks', type=int, default=c.physics_fps * 60)
+    parser.add_argument('--broadphase', default='grid')
+    parser.add_argument('--vectorized', action='store_true')
+    parser.add_argument('--profile', action='store_true', help='Time each phase of the tick.')
+    args = parser.parse_args()
+
+    level = getattr(levels, args.level)
+    # Have every player hold down thrust and turn, so that there is some
+    # movement to simulate.
+    inputs = [
+        ScriptedInput(thrust=True, brake=False, turn_direction=(-1) ** i)
+        for i in range(sum(1 for cls, _ in level if issubclass(cls, Player)))
+    ]
+    result = run(
+        level,
+        inputs,
+        ticks=args.ticks,
+        broadphase=args.broadphase,
+        vectorized=args.vectorized,
+        profiler=Profiler() if args.profile else None,
+    )
+    report(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,389 @@
+"""
+Loading levels, from lists of objects in Python or from level files.
+
+A level file is a small header followed by flat arrays: one row of doubles
+per particle, and per wall, polyline or polygon in the order of the level,
+then the vertices of the walls, the geometry of each of their segments, and
+the cells of the wall index. Everything is little-endian, so the files work
+on any machine. The wall geometry and the index are computed when the file is
+saved, so loading only has to make the objects, without going through their
+constructors. With numpy, the arrays are read straight out of a memory-mapped
+file, without copying, and a ParticleStore can be filled from them directly.
+
+Usage:
+    python levelfile.py OUT [--level NAME | --generated N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import functools
+import gc
+import mmap
+import struct
+import sys
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from particle import Particle, make_particles
+from bumper import Bumper
+from player import Player
+from wall import Wall, WallIndex, Polyline, Polygon
+import levels
+
+MAGIC = b'MGLV'
+VERSION = 3
+# Magic, version, and the number of particles, walls, wall vertices, wall
+# segments, index cells, and wall entries in the index cells, then the size of
+# the index cells.
+HEADER = struct.Struct('<4sB3xIIIIIId')
+
+# The kinds of particles, and the values in a particle row.
+PARTICLE_KINDS = [Particle, Bumper, Player]
+PARTICLE_FIELDS = [
+    'kind', 'x', 'y', 'vx', 'vy', 'mass', 'radius', 'restitution', 'drag_rate',
+    'heading', 'player_health',
+]
+# The kinds of walls, and the values in a wall row. The vertices of the walls
+# follow each other in the vertex array, and their segments in the segment
+# array.
+WALL_KINDS = [Wall, Polyline, Polygon]
+WALL_FIELDS = ['kind', 'restitution', 'num_vertices', 'min_x', 'min_y', 'max_x', 'max_y']
+SEGMENT_FIELDS = [
+    'tangent_x', 'tangent_y', 'normal_x', 'normal_y',
+    'min_x', 'min_y', 'max_x', 'max_y',
+]
+
+
+def without_gc(func):
+    """
+    Pause the garbage collector while func runs.
+
+    Making the many objects of a level would run the collector over and over,
+    though none of them are garbage.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if enabled:
+                gc.enable()
+    return wrapper
+
+
+def make_objects(level):
+    """Construct the objects of a level, given as (class, args) pairs."""
+    objects = []
+    for object_class, args in level:
+        if isinstance(args, dict):
+            objects.append(object_class(**args))
+        else:
+            objects.append(object_class(*args))
+    return objects
+
+
+class LevelFile(object):
+    """The contents of a level file, as flat arrays."""
+    def __init__(
+        self,
+        particles,
+        walls,
+        vertices,
+        segments,
+        cell_size,
+        cell_keys,
+        cell_starts,
+        cell_walls,
+    ):
+        self.particles = particles
+        self.walls = walls
+        self.vertices = vertices
+        self.segments = segments
+        self.cell_size = cell_size
+        self.cell_keys = cell_keys
+        self.cell_starts = cell_starts
+        self.cell_walls = cell_walls
+
+    def make_objects(self):
+        """Construct the particles and walls of the level."""
+        return self.make_particles() + self.make_walls()
+
+    def particle_values(self):
+        """The values of the particles for each of PARTICLE_FIELDS, by name."""
+        width = len(PARTICLE_FIELDS)
+        return dict(
+            (name, self.particles[k::width])
+            for k, name in enumerate(PARTICLE_FIELDS)
+        )
+
+    @without_gc
+    def make_particles(self, stored=False):
+        """
+        Construct the particles of the level.
+
+        If stored is true, only the players are made, and the other particles
+        are given as their class, to be made as views onto a ParticleStore
+        filled with particle_columns().
+        """
+        values = self.particle_values()
+        if np is not None:
+            classes = np.array(PARTICLE_KINDS, dtype=object)[
+                values['kind'].astype(int)].tolist()
+        else:
+            classes = [PARTICLE_KINDS[int(kind)] for kind in values['kind']]
+        players = [k for k, cls in enumerate(classes) if cls is Player]
+        if stored:
+            particles = list(classes)
+        else:
+            # The players are made separately.
+            columns = [
+                values[name].tolist()
+                for name in ['x', 'y', 'vx', 'vy', 'mass', 'radius', 'restitution', 'drag_rate']
+            ]
+            xs, ys, vxs, vys, masses, radii, restitutions, drag_rates = columns
+            particles = make_particles(
+                [Particle if cls is Player else cls for cls in classes],
+                zip(xs, ys),
+                zip(vxs, vys),
+                masses,
+                radii,
+                restitutions,
+                drag_rates,
+            )
+        width = len(PARTICLE_FIELDS)
+        for k in players:
+            (
+                _kind, x, y, vx, vy, mass, radius, restitution, drag_rate,
+                heading, player_health,
+            ) = self.particles[k * width:(k + 1) * width].tolist()
+            particles[k] = Player(
+                pos=(x, y),
+                velocity=(vx, vy),
+                mass=mass,
+                radius=radius,
+                restitution=restitution,
+                drag_rate=drag_rate,
+                heading=heading,
+                player_health=player_health,
+            )
+        return particles
+
+    def particle_columns(self):
+        """
+        The state of the particles as numpy arrays, by field name, with pos and
+        velocity as one (x, y) row per particle. This needs numpy.
+        """
+        columns = self.particle_values()
+        columns['pos'] = np.column_stack([columns['x'], columns['y']])
+        columns['velocity'] = np.column_stack([columns['vx'], columns['vy']])
+        return columns
+
+    @without_gc
+    def make_walls(self):
+        """Construct the walls, polylines and polygons of the level, in order."""
+        walls = []
+        width = len(WALL_FIELDS)
+        values = self.walls.tolist()
+        vertices = self.vertices.tolist()
+        points = list(zip(vertices[::2], vertices[1::2]))
+        segments = self.segments.tolist()
+        geometry = [
+            (
+                (segments[k], segments[k + 1]),
+                (segments[k + 2], segments[k + 3]),
+                (segments[k + 4], segments[k + 5], segments[k + 6], segments[k + 7]),
+            )
+            for k in range(0, len(segments), len(SEGMENT_FIELDS))
+        ]
+        v = 0
+        g = 0
+        for k in range(0, len(values), width):
+            kind, restitution, num_vertices, min_x, min_y, max_x, max_y = values[k:k + width]
+            cls = WALL_KINDS[int(kind)]
+            n = int(num_vertices)
+            if cls is Wall:
+                tangent, normal, bounds = geometry[g]
+                walls.append(Wall.from_geometry(
+                    points[v], points[v + 1], restitution, tangent, normal, bounds,
+                ))
+                g += 1
+            else:
+                count = n if cls.closed else n - 1
+                walls.append(cls.from_geometry(
+                    points[v:v + n],
+                    restitution,
+                    geometry[g:g + count],
+                    (min_x, min_y, max_x, max_y),
+                ))
+                g += count
+            v += n
+        return walls
+
+    def make_wall_index(self, walls):
+        """Make the index of the walls, which must be the ones of this level, in order."""
+        keys = self.cell_keys.tolist()
+        starts = self.cell_starts.tolist()
+        entries = self.cell_walls.tolist()
+        cells = dict(zip(
+            zip(keys[::2], keys[1::2]),
+            [entries[start:end] for start, end in zip(starts, starts[1:])],
+        ))
+        return WallIndex.from_cells(walls, self.cell_size, cells)
+
+
+def save(path, objects):
+    """Save the particles and walls among the given objects to a level file."""
+    particles = array('d')
+    walls = []
+    for o in objects:
+        if isinstance(o, Particle):
+            particles.extend((
+                # Particles in a ParticleStore have a view class instead.
+                PARTICLE_KINDS.index(getattr(o, 'unstored_class', type(o))),
+                o.pos[0],
+                o.pos[1],
+                o.velocity[0],
+                o.velocity[1],
+                o.mass,
+                o.radius,
+                o.restitution,
+                o.drag_rate,
+                getattr(o, 'heading', 0.0),
+                getattr(o, 'player_health', 0.0),
+            ))
+        elif isinstance(o, Wall):
+            walls.append(o)
+
+    wall_values = array('d')
+    vertices = array('d')
+    segments = array('d')
+    for w in walls:
+        if isinstance(w, Polyline):
+            points = w.vertices
+        else:
+            points = [w.p1, w.p2]
+        wall_values.extend((WALL_KINDS.index(type(w)), w.restitution, len(points)) + w.bounds)
+        for point in points:
+            vertices.extend(point)
+        for _p1, _p2, tangent, normal, bounds, _cap1, _cap2 in w.segments():
+            segments.extend(tangent + normal + bounds)
+
+    index = WallIndex(walls)
+    cell_keys = array('q')
+    cell_starts = array('q', [0])
+    cell_walls = array('q')
+    for key, indices in sorted(index.cells.items()):
+        cell_keys.extend(key)
+        cell_walls.extend(indices)
+        cell_starts.append(len(cell_walls))
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC,
+            VERSION,
+            len(particles) // len(PARTICLE_FIELDS),
+            len(walls),
+            len(vertices) // 2,
+            len(segments) // len(SEGMENT_FIELDS),
+            len(cell_keys) // 2,
+            len(cell_walls),
+            index.cell_size,
+        ))
+        for values in [
+            particles, wall_values, vertices, segments,
+            cell_keys, cell_starts, cell_walls,
+        ]:
+            if sys.byteorder == 'big':
+                values.byteswap()
+            f.write(values.tobytes())
+
+
+def load(path):
+    """Read a level file into a LevelFile."""
+    with open(path, 'rb') as f:
+        if np is not None:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+    (
+        magic, version, num_particles, num_walls, num_vertices, num_segments,
+        num_cells, num_cell_walls, cell_size,
+    ) = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{} is not a level file.'.format(path))
+
+    # Every array is made of 8 byte values, so they all stay aligned.
+    offset = [HEADER.size]
+    def read(typecode, count):
+        start = offset[0]
+        offset[0] += count * 8
+        if np is not None:
+            return np.frombuffer(
+                data,
+                dtype='<f8' if typecode == 'd' else '<i8',
+                count=count,
+                offset=start,
+            )
+        values = array(typecode)
+        values.frombytes(data[start:offset[0]])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    return LevelFile(
+        particles=read('d', num_particles * len(PARTICLE_FIELDS)),
+        walls=read('d', num_walls * len(WALL_FIELDS)),
+        vertices=read('d', num_vertices * 2),
+        segments=read('d', num_segments * len(SEGMENT_FIELDS)),
+        cell_size=cell_size,
+        cell_keys=read('q', num_cells * 2),
+        cell_starts=read('q', num_cells + 1),
+        cell_walls=read('q', num_cell_walls),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Save a level to a level file.')
+    parser.add_argument('path')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--level', default='versus', help='A level in the levels module.')
+    group.add_argument(
+        '--generated',
+        type=int,
+        metavar='N',
+        help='A generated benchmark level with N particles.',
+    )
+    args = parser.parse_args()
+
+    if args.generated is not None:
+        # The benchmark module uses the environment, which uses this one.
+        import benchmark
+        level = benchmark.generated_level(args.generated)
+    else:
+        level = getattr(levels, args.level)
+
+    start = time.time()
+    objects = make_objects(level)
+    WallIndex([o for o in objects if isinstance(o, Wall)])
+    from_list = time.time() - start
+    save(args.path, objects)
+
+    start = time.time()
+    level_file = load(args.path)
+    objects = level_file.make_objects()
+    level_file.make_wall_index([o for o in objects if isinstance(o, Wall)])
+    from_file = time.time() - start
+    print('{} objects, {:.1f} ms from the level list, {:.1f} ms from the file'.format(
+        len(objects), from_list * 1000, from_file * 1000,
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,7 @@ import math
 from particle import Particle
 from bumper import Bumper
 from player import Player
-from wall import Wall
+from wall import Wall, Polygon
 import constants as c
 
 test = [
@@ -12,13 +12,7 @@ test = [
     (Particle, dict(pos=(3,-3),velocity=(0,-3), mass=5)),
     (Wall, [(-3,-3), (-6,3)]),
     (Wall, [(6,3), (6,-3)]),
-    (Wall, [(0,8), (-15,12)]),
-    (Wall, [(-15,12), (-12,-7)]),
-    (Wall, [(-12,-7), (2,-11)]),
-    (Wall, [(2,-11), (14,-10)]),
-    (Wall, [(14,-10), (17,2)]),
-    (Wall, [(17,2), (15,13)]),
-    (Wall, [(15,13), (0,8)]),
+    (Polygon, [[(0,8), (-15,12), (-12,-7), (2,-11), (14,-10), (17,2), (15,13)]]),
 ]
 
 versus = [
@@ -33,10 +27,7 @@ versus = [
     (Particle, dict(pos=(-15, 15),velocity=(0,0), mass=10, radius=.5)),
     (Particle, dict(pos=(15, 15),velocity=(0,0), mass=7)),
     (Particle, dict(pos=(-15, -15),velocity=(0,0), mass=7)),
-    (Wall, [(-20,-20), (-20,20)]),
-    (Wall, [(-20,20), (20,20)]),
-    (Wall, [(20,20), (20,-20)]),
-    (Wall, [(20,-20), (-20,-20)]),
+    (Polygon, [[(-20,-20), (-20,20), (20,20), (20,-20)]]),
     #(Wall, [(-12,-8), (-8,-12)]),
     #(Wall, [(12,8), (8,12)]),
 ]
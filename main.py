@@ -1,21 +1,69 @@
 from __future__ import division, print_function
+import argparse
 import random
 
 import pygame as pg
 from display import Display
 from environment import Environment
 from input_manager import InputManager
+from replay import Replay, ReplayRecorder, ReplayPlayer, ReplayInput, input_scheme
+from profiler import Profiler
+from physics_thread import PhysicsThread, RenderState
+from scheduler import TickScheduler
+from events import DEATH
+import netplay
 import levels
+import constants as c
 
-PHYSICS_FPS = 60
-PHYSICS_TICK_MS = 1000 / PHYSICS_FPS
+PHYSICS_FPS = c.physics_fps
+PHYSICS_TICK_MS = c.physics_tick_ms
 SCREENSIZE = (1024, 768)
+DISPLAY_FPS = 120 # The display framerate cap, when THREADED.
+BROADPHASE = 'grid' # One of 'grid', 'sweep_and_prune', or 'brute_force'.
+VECTORIZED = False # Use numpy arrays for the physics.
+PROFILE = False # Time each phase of the physics, shown with the fps.
+THREADED = False # Run the physics on its own thread, apart from drawing.
+MAX_STEPS_PER_FRAME = 5 # Physics frames to catch up on at most, before skipping.
+REDUCE_FIDELITY = True # Turn off continuous collision when the physics can't keep up.
+LEVEL = 'versus' # TEMP, hardcoded level selection.
+REPLAY_PATH = 'last_match.replay' # Where to record the match, or None.
+REPLAY_SEEK_TICKS = 10 * PHYSICS_FPS
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', metavar='FILE', help='Watch a recorded match.')
+    parser.add_argument('--port', type=int, help='Play over the network, on this UDP port.')
+    parser.add_argument(
+        '--peer',
+        type=netplay.peer_address,
+        metavar='HOST:PORT',
+        help='The address of the other player.',
+    )
+    parser.add_argument('--player', type=int, choices=[0, 1], default=0)
+    args = parser.parse_args()
+    if (args.port is None) != (args.peer is None):
+        parser.error('--port and --peer must be given together')
+    if args.port is not None and args.replay is not None:
+        parser.error('--replay cannot be used with --port')
+
     pg.init()
     pg.font.init()
 
+    if args.replay is not None:
+        player = ReplayPlayer(
+            Replay.load(args.replay),
+            profiler=Profiler() if PROFILE else None,
+        )
+        disp = Display(player.env, SCREENSIZE)
+        replay_loop(player, disp)
+        pg.quit()
+        return
+    if args.port is not None:
+        net_game(args.port, args.peer, args.player)
+        pg.quit()
+        return
+
     #TEMP: hardcoded keymaps.
     inputs = [
         #InputManager({
@@ -35,24 +83,111 @@ def main():
         }),
     ]
 
-    env = Environment(inputs)
+    if THREADED:
+        # The physics thread reads copies of the inputs, set between ticks.
+        sim_inputs = [ReplayInput(input_scheme(inp)) for inp in inputs]
+    else:
+        sim_inputs = inputs
+
+    env = Environment(
+        sim_inputs,
+        broadphase=BROADPHASE,
+        vectorized=VECTORIZED,
+        profiler=Profiler() if PROFILE else None,
+    )
     disp = Display(env, SCREENSIZE)
-    env.load_level(levels.inelastic_collision_bug) # TEMP, hardcoded level selection.
+    env.load_level(getattr(levels, LEVEL))
+    if REPLAY_PATH is not None:
+        env.recorder = ReplayRecorder(LEVEL, sim_inputs, env.options)
 
-    main_loop(env, disp)
+    if THREADED:
+        threaded_loop(env, disp, inputs, sim_inputs)
+    else:
+        main_loop(env, disp)
 
+    if env.recorder is not None:
+        env.recorder.replay.save(REPLAY_PATH)
     pg.quit()
 
 
-def main_loop(env, disp):
+def net_game(port, peer, number):
+    """Play a two-player match against a peer over UDP, at a (host, port)."""
+    # The local player uses the arrow keys.
+    local_input = InputManager({
+        'thrust': pg.K_UP,
+        'brake': pg.K_DOWN,
+        'turn_direction': (pg.K_LEFT, pg.K_RIGHT),
+    })
+    env = netplay.make_environment(
+        getattr(levels, LEVEL),
+        broadphase=BROADPHASE,
+        vectorized=VECTORIZED,
+        profiler=Profiler() if PROFILE else None,
+    )
+    if THREADED:
+        sim_input = ReplayInput(input_scheme(local_input))
+    else:
+        sim_input = local_input
+    session = netplay.NetSession(
+        env,
+        number,
+        sim_input,
+        netplay.make_socket(port, host=''),
+        peer,
+    )
+    if REPLAY_PATH is not None:
+        env.recorder = ReplayRecorder(LEVEL, env.inputs, env.options)
+    disp = Display(env, SCREENSIZE)
+
+    if THREADED:
+        threaded_loop(
+            env,
+            disp,
+            [local_input],
+            [sim_input],
+            step=session.advance,
+            confirmed_tick=lambda: session.confirmed_tick,
+        )
+    else:
+        main_loop(
+            env,
+            disp,
+            inputs=[local_input],
+            step=session.advance,
+            confirmed_tick=lambda: session.confirmed_tick,
+        )
+
+    if env.recorder is not None:
+        env.recorder.replay.save(REPLAY_PATH)
+
+
+def main_loop(env, disp, inputs=None, step=None, confirmed_tick=None):
     """
     Run the main game loop.
 
-    We decouple the display framerate from the physics update framerate,
-    putting as many physics frames as necessary between display frames.
+    We decouple the display framerate from the physics update framerate. A
+    TickScheduler runs the physics frames that are due between display
+    frames, but only as many as fit in its budget, so that the screen keeps
+    being drawn even when the physics can't keep up.
 
     The display framerate is capped at the physics framerate.
+
+    The keyboard drives the given inputs, by default the inputs of the
+    environment. Each physics frame calls step, which by default updates the
+    environment by one tick. If the ticks can be rolled back, confirmed_tick
+    gives the first tick that still can be, and only the deaths before it are
+    reported.
     """
+    if inputs is None:
+        inputs = env.inputs
+    if step is None:
+        step = lambda: env.update(PHYSICS_TICK_MS)
+        scheduler = make_scheduler(env)
+    else:
+        scheduler = make_scheduler(None)
+    disp.scheduler = scheduler
+    deaths = env.events.reader([DEATH])
+
     # FPS tracking.
     update_fps_event = pg.USEREVENT + 1
     pg.time.set_timer(update_fps_event, 700)
@@ -60,13 +195,8 @@ def main_loop(env, disp):
     clock = pg.time.Clock()
     clock.tick()  # necessary, or the first tick will be very large
 
-    start_time = pg.time.get_ticks()
-
-    # One iteration of the loop is one physics frame.
-    # Not every iteraton will incur a draw() call if we aren't caught up.
-    frame_count = 0
+    scheduler.start()
     while True:
-        frame_count += 1
         # Process events.
         for e in pg.event.get():
             if e.type == pg.QUIT:
@@ -76,7 +206,7 @@ def main_loop(env, disp):
                 if key == pg.K_ESCAPE:
                     pg.event.post(pg.event.Event(pg.QUIT))
                 else:
-                    for inp in env.inputs:
+                    for inp in inputs:
                         inp.track_keypress(e.key)
             elif e.type == pg.MOUSEMOTION:
                 pass
@@ -89,20 +219,147 @@ def main_loop(env, disp):
 
         # Check pressed keys.
         pressed_keys = pg.key.get_pressed()
-        for inp in env.inputs:
+        for inp in inputs:
             inp.update(pressed_keys)
 
-        # Update the environment.
-        # the current time.
-        env.update(PHYSICS_TICK_MS)
+        # Update the environment, as far as it is due.
+        scheduler.run(step)
+        report_deaths(deaths, confirmed_tick)
+
+        disp.draw()
+        clock.tick(PHYSICS_FPS)  # Limit display framerate.
+
+
+def report_deaths(deaths, confirmed_tick=None):
+    """
+    Print the deaths read by a reader of DEATH events. If confirmed_tick is
+    given, only the deaths before the tick it returns are reported.
+    """
+    before = None if confirmed_tick is None else confirmed_tick()
+    for event in deaths.read(before):
+        print('Player {} is dead.'.format(event.first.number + 1))
+
+
+def make_scheduler(env):
+    """
+    Make the scheduler for the physics of a game.
+
+    Reduced fidelity changes how the match plays out, so it is only allowed
+    for the given environment, and only when it isn't recording a replay.
+    """
+    if not REDUCE_FIDELITY or (env is not None and env.recorder is not None):
+        env = None
+    return TickScheduler(
+        PHYSICS_TICK_MS,
+        max_steps=MAX_STEPS_PER_FRAME,
+        env=env,
+    )
+
+
+def threaded_loop(env, disp, inputs, sim_inputs, step=None, confirmed_tick=None):
+    """
+    Run the game with the physics on a separate thread.
 
-        # Check if we are caught up to the current time, and if so, take the
-        # time to draw the screen.
-        elapsed_time = pg.time.get_ticks() - start_time
-        target_frame = (elapsed_time / 1000) * PHYSICS_FPS
-        if frame_count > target_frame:
+    The physics thread updates the environment at the physics framerate,
+    however long drawing takes. This thread handles events and input, and
+    draws as often as the display allows, interpolating between the states
+    published by the physics thread, so the motion stays smooth at any
+    display framerate.
+
+    The keyboard drives the given inputs, on this thread. The simulation reads
+    sim_inputs instead, which the physics thread sets from them between ticks,
+    so the two threads never share an input. Each physics frame calls step,
+    which by default updates the environment by one tick. Deaths are reported
+    as in main_loop, from the physics thread, which is the one that emits
+    them.
+    """
+    scheduler = make_scheduler(env if step is None else None)
+    if step is None:
+        step = lambda: env.update(PHYSICS_TICK_MS)
+    deaths = env.events.reader([DEATH])
+    def step_and_report():
+        step()
+        report_deaths(deaths, confirmed_tick)
+    physics = PhysicsThread(
+        env,
+        step=step_and_report,
+        tick_ms=PHYSICS_TICK_MS,
+        inputs=sim_inputs,
+        scheduler=scheduler,
+    )
+    render_state = RenderState(physics, inputs)
+    disp.set_environment(render_state)
+    disp.scheduler = physics.scheduler
+
+    update_fps_event = pg.USEREVENT + 1
+    pg.time.set_timer(update_fps_event, 700)
+    clock = pg.time.Clock()
+    clock.tick()
+
+    physics.start()
+    try:
+        while True:
+            for e in pg.event.get():
+                if e.type == pg.QUIT:
+                    return
+                elif e.type == pg.KEYDOWN:
+                    if e.key == pg.K_ESCAPE:
+                        return
+                    for inp in inputs:
+                        inp.track_keypress(e.key)
+                elif e.type == update_fps_event:
+                    disp.set_fps(clock.get_fps())
+
+            pressed_keys = pg.key.get_pressed()
+            for inp in inputs:
+                inp.update(pressed_keys)
+            physics.set_inputs(inputs)
+
+            render_state.update()
             disp.draw()
-            clock.tick(PHYSICS_FPS)  # Limit display framerate.
+            clock.tick(DISPLAY_FPS)
+    finally:
+        physics.stop()
+        disp.set_environment(env)
+
+
+def replay_loop(player, disp):
+    """
+    Watch a replay.
+
+    The left and right keys seek backward and forward, the up and down keys
+    change the playback speed, and space pauses.
+    """
+    clock = pg.time.Clock()
+    speed = 1
+    paused = False
+    while True:
+        for e in pg.event.get():
+            if e.type == pg.QUIT:
+                return
+            elif e.type == pg.KEYDOWN:
+                if e.key == pg.K_ESCAPE:
+                    return
+                elif e.key == pg.K_SPACE:
+                    paused = not paused
+                elif e.key == pg.K_RIGHT:
+                    player.fast_forward(REPLAY_SEEK_TICKS)
+                elif e.key == pg.K_LEFT:
+                    player.seek(player.tick - REPLAY_SEEK_TICKS)
+                elif e.key == pg.K_UP:
+                    speed = min(speed * 2, 64)
+                elif e.key == pg.K_DOWN:
+                    speed = max(speed // 2, 1)
+
+        if not paused:
+            for _ in range(speed):
+                player.step()
+
+        if player.env is not disp.environment:
+            disp.set_environment(player.env)
+        disp.set_fps(clock.get_fps())
+        disp.draw()
+        clock.tick(PHYSICS_FPS)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,343 @@
+"""
+Rollback netcode for two-player matches over UDP.
+
+Each peer simulates the whole match. Local inputs are sent to the other peer
+as they happen, and the remote player's inputs are predicted by repeating the
+last one received. When a remote input arrives that differs from the
+prediction, the environment is rolled back to a snapshot taken before that
+tick, and re-simulated forward with the correct inputs.
+
+Usage, with each command in its own terminal:
+    python netplay.py --player 0 --port 7000 --peer 127.0.0.1:7001
+    python netplay.py --player 1 --port 7001 --peer 127.0.0.1:7000
+"""
+from __future__ import division, print_function
+
+import argparse
+import hashlib
+import heapq
+import random
+import socket
+import struct
+import time
+
+from environment import Environment
+from headless import ScriptedInput
+from replay import (
+    ReplayInput, input_scheme, pack_input, unpack_input, NEUTRAL_INPUT,
+)
+import batch
+import levels
+import constants as c
+
+# Packet layout: the latest remote tick received in full, the tick of the
+# first input in the packet, and the number of inputs, followed by one byte
+# per input.
+PACKET_HEADER = struct.Struct('<iiB')
+
+
+class NetSession(object):
+    """
+    Keeps a local Environment in sync with a remote peer.
+
+    The environment must have a level loaded with two players, and a
+    ReplayInput for each player, which the session sets before every tick.
+    Call advance() once per physics frame, after updating the local input.
+
+    input_delay is the number of ticks that local inputs are delayed by, which
+    gives them time to reach the peer and makes rollbacks less common.
+    max_rollback is the most ticks the simulation may run ahead of the last
+    confirmed remote input. Beyond that, the session waits for the peer
+    instead of predicting further, which bounds the work of a rollback.
+    """
+    def __init__(
+        self,
+        env,
+        local_number,
+        local_input,
+        sock,
+        peer_address,
+        input_delay=2,
+        max_rollback=8,
+    ):
+        self.env = env
+        self.local_number = local_number
+        self.remote_number = 1 - local_number
+        self.local_input = local_input
+        self.sock = sock
+        self.peer_address = peer_address
+        self.input_delay = input_delay
+        self.max_rollback = max_rollback
+
+        self.local_scheme = input_scheme(env.inputs[local_number])
+        self.remote_scheme = input_scheme(env.inputs[self.remote_number])
+
+        # Inputs by tick. The first input_delay local ticks have no input.
+        self.local_inputs = dict(
+            (tick, NEUTRAL_INPUT) for tick in range(env.tick + input_delay)
+        )
+        self.remote_inputs = {}
+        self.predicted_inputs = {}
+        # The next remote tick we are missing. Everything before it has been
+        # received.
+        self.remote_tick = env.tick
+        # The next local tick the peer is missing, as acknowledged by it.
+        self.peer_ack = env.tick
+        # Snapshots taken before simulating each unconfirmed tick.
+        self.snapshots = {}
+
+        # Statistics.
+        self.rollbacks = 0
+        self.resimulated_ticks = 0
+        self.stalls = 0
+
+    @property
+    def confirmed_tick(self):
+        """The number of ticks simulated with known inputs for both players."""
+        return min(self.env.tick, self.remote_tick)
+
+    def advance(self):
+        """
+        Simulate one tick, rolling back first if a prediction was wrong.
+
+        Returns False without simulating if we are too far ahead of the peer.
+        """
+        env = self.env
+        next_local = env.tick + self.input_delay
+        if next_local not in self.local_inputs:
+            self.local_inputs[next_local] = pack_input(
+                self.local_input,
+                self.local_scheme,
+            )
+        self.send()
+        self.receive()
+
+        if env.tick - self.remote_tick >= self.max_rollback:
+            self.stalls += 1
+            return False
+        self.simulate_tick()
+        return True
+
+    def simulate_tick(self):
+        env = self.env
+        tick = env.tick
+        if tick >= self.remote_tick:
+            # We will need to come back to this tick if the prediction is
+            # wrong.
+            self.snapshots[tick] = env.snapshot()
+        remote = self.remote_inputs.get(tick)
+        if remote is None:
+            remote = self.predict(tick)
+            self.predicted_inputs[tick] = remote
+        env.inputs[self.local_number].set_state(
+            unpack_input(self.local_inputs[tick], self.local_scheme)
+        )
+        env.inputs[self.remote_number].set_state(
+            unpack_input(remote, self.remote_scheme)
+        )
+        env.update(c.physics_tick_ms)
+
+    def predict(self, tick):
+        """Guess a remote input by repeating the last one received."""
+        if self.remote_tick > 0:
+            return self.remote_inputs.get(self.remote_tick - 1, NEUTRAL_INPUT)
+        return NEUTRAL_INPUT
+
+    def send(self):
+        # Send every input the peer hasn't acknowledged yet, so that lost
+        # packets are made up for by the following ones.
+        start = self.peer_ack
+        end = max(self.local_inputs) + 1
+        end = min(end, start + 255)
+        data = PACKET_HEADER.pack(self.remote_tick, start, end - start)
+        data += bytes(bytearray(self.local_inputs[t] for t in range(start, end)))
+        self.sock.sendto(data, self.peer_address)
+
+    def receive(self):
+        rollback_tick = None
+        while True:
+            try:
+                data, _address = self.sock.recvfrom(4096)
+            except (socket.error, OSError):
+                break
+            if len(data) < PACKET_HEADER.size:
+                continue
+            ack, start, count = PACKET_HEADER.unpack_from(data)
+            self.peer_ack = max(self.peer_ack, ack)
+            values = bytearray(data[PACKET_HEADER.size:PACKET_HEADER.size + count])
+            for tick, value in enumerate(values, start):
+                if tick < self.remote_tick or tick in self.remote_inputs:
+                    continue
+                self.remote_inputs[tick] = value
+                predicted = self.predicted_inputs.pop(tick, None)
+                if predicted is not None and predicted != value:
+                    if rollback_tick is None or tick < rollback_tick:
+                        rollback_tick = tick
+            while self.remote_tick in self.remote_inputs:
+                self.remote_tick += 1
+
+        if rollback_tick is not None:
+            self.rollback(rollback_tick)
+        self.forget_confirmed()
+
+    def rollback(self, tick):
+        """Go back to the given tick, and re-simulate up to the present."""
+        env = self.env
+        present = env.tick
+        env.restore(self.snapshots[tick])
+        self.rollbacks += 1
+        self.resimulated_ticks += present - tick
+        # Predictions after a wrong one are made again during re-simulation.
+        for t in range(tick, present):
+            self.predicted_inputs.pop(t, None)
+        while env.tick < present:
+            self.simulate_tick()
+
+    def forget_confirmed(self):
+        """Drop snapshots and inputs that can no longer be rolled back to."""
+        confirmed = self.confirmed_tick
+        for tick in [t for t in self.snapshots if t < confirmed]:
+            del self.snapshots[tick]
+        # Local inputs are still needed to re-simulate, and to resend until the
+        # peer has them.
+        oldest = min(confirmed, self.peer_ack)
+        for tick in [t for t in self.local_inputs if t < oldest]:
+            del self.local_inputs[tick]
+        # Keep the last received remote input, for predictions.
+        for tick in [t for t in self.remote_inputs if t < confirmed - 1]:
+            del self.remote_inputs[tick]
+
+    def finished(self, ticks):
+        """Whether both peers have all the inputs for the given ticks."""
+        return (
+            self.env.tick >= ticks and
+            self.remote_tick >= ticks and
+            self.peer_ack >= ticks
+        )
+
+
+class LossySocket(object):
+    """
+    A UDP socket wrapper that simulates network latency and packet loss.
+
+    Outgoing packets are dropped at random with the given probability, and the
+    rest are held back for the latency plus a random jitter, in seconds.
+    """
+    def __init__(self, sock, latency=0.0, jitter=0.0, loss=0.0, rand=None):
+        self.sock = sock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rand = rand or random.Random()
+        self.queue = []
+        self.count = 0
+
+    def sendto(self, data, address):
+        self.flush()
+        if self.rand.random() < self.loss:
+            return
+        delay = self.latency + self.rand.uniform(0, self.jitter)
+        # The counter keeps packets with equal times in the order they were
+        # sent.
+        heapq.heappush(self.queue, (time.time() + delay, self.count, data, address))
+        self.count += 1
+
+    def recvfrom(self, size):
+        self.flush()
+        return self.sock.recvfrom(size)
+
+    def flush(self):
+        now = time.time()
+        while self.queue and self.queue[0][0] <= now:
+            _, _, data, address = heapq.heappop(self.queue)
+            self.sock.sendto(data, address)
+
+
+def make_socket(port, host='127.0.0.1'):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+def make_environment(level, **environment_options):
+    """Make an environment for a networked match, with two player inputs."""
+    env = Environment(
+        [ReplayInput(0), ReplayInput(0)],
+        **environment_options
+    )
+    env.load_level(level)
+    return env
+
+def state_hash(env):
+    return hashlib.sha1(env.snapshot()).hexdigest()[:12]
+
+
+def peer_address(text):
+    """Parse a HOST:PORT argument into a (host, port) address."""
+    host, _, port = text.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(
+            'Expected HOST:PORT, got {!r}'.format(text)
+        )
+    return host, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--player', type=int, choices=[0, 1], required=True)
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--peer', type=peer_address, required=True, metavar='HOST:PORT')
+    parser.add_argument('--level', default='versus')
+    parser.add_argument('--ticks', type=int, default=c.physics_fps * 30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='seconds')
+    parser.add_argument('--loss', type=float, default=0.0)
+    args = parser.parse_args()
+
+    sock = LossySocket(
+        make_socket(args.port),
+        latency=args.latency,
+        jitter=args.jitter,
+        loss=args.loss,
+        rand=random.Random(args.seed * 2 + args.player),
+    )
+    env = make_environment(getattr(levels, args.level))
+    # Both peers play a random script, seeded by player number.
+    local_input = ScriptedInput(batch.random_script(
+        random.Random(args.seed * 2 + args.player),
+        args.ticks,
+    ))
+    session = NetSession(env, args.player, local_input, sock, args.peer)
+
+    # Run in real time, then keep exchanging packets until both peers have
+    # every input.
+    tick_seconds = c.physics_tick_ms / 1000
+    start = time.time()
+    frame = 0
+    while not session.finished(args.ticks):
+        frame += 1
+        if env.tick < args.ticks:
+            local_input.update(env.tick + session.input_delay)
+            session.advance()
+        else:
+            session.send()
+            session.receive()
+        delay = start + frame * tick_seconds - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    # Linger, so the peer gets our acknowledgement of its last inputs.
+    for _ in range(10):
+        session.send()
+        time.sleep(tick_seconds)
+
+    print('tick {}, state {}'.format(env.tick, state_hash(env)))
+    print('{} rollbacks, {} ticks re-simulated, {} stalls'.format(
+        session.rollbacks,
+        session.resimulated_ticks,
+        session.stalls,
+    ))
+
+
+if __name__ == '__main__':
+    main()
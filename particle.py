@@ -1,9 +1,19 @@
 from __future__ import division
 import math
 
-import vec
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from events import COLLISION
+import vec2 as vec
 import constants as c
 
+# The direction to push particles apart along when their centers are on top of
+# each other, from the first particle to the second.
+COINCIDENT_NORMAL = (1.0, 0.0)
+
 class Particle(object):
     graphics_type = 'particle'
     immovable = False
@@ -14,8 +24,8 @@ class Particle(object):
         velocity=(0, 0),
         mass=1.0,
         radius=None,
-        restitution=c.restitution_particle,
-        drag_rate=c.drag_rate,
+        restitution=None,
+        drag_rate=None,
     ):
         self.last_pos = pos
         self.pos = pos
@@ -24,8 +34,17 @@ class Particle(object):
         if radius is None:
             radius = math.sqrt(self.mass)
         self.radius = radius
+        # The defaults are looked up now rather than when the module loads,
+        # so that overriding the constants takes effect.
+        if restitution is None:
+            restitution = c.restitution_particle
         self.restitution = restitution
+        if drag_rate is None:
+            drag_rate = c.drag_rate
         self.drag_rate = drag_rate
+        self.sleeping = False
+        self.idle_time = 0.0
+        self.island = -1
 
     @property
     def speed(self):
@@ -81,20 +100,63 @@ class Particle(object):
                 v = vec.norm(v, self.radius)
                 self.pos = vec.add(point, v)
 
+def make_particles(classes, positions, velocities, masses, radii, restitutions, drag_rates):
+    """
+    Make particles of the given classes from lists of their state, without
+    calling their constructors or looking up defaults, such as for the many
+    particles of a level file. The classes must have no state of their own
+    besides that of Particle.
+    """
+    particles = []
+    for cls, pos, velocity, mass, radius, restitution, drag_rate in zip(
+        classes, positions, velocities, masses, radii, restitutions, drag_rates,
+    ):
+        p = cls.__new__(cls)
+        p.last_pos = pos
+        p.pos = pos
+        p.velocity = velocity
+        p.mass = mass
+        p.radius = radius
+        p.restitution = restitution
+        p.drag_rate = drag_rate
+        p.sleeping = False
+        p.idle_time = 0.0
+        p.island = -1
+        particles.append(p)
+    return particles
+
 def intersect(p1, p2):
     distance2 = vec.mag2(vec.vfrom(p1.pos, p2.pos))
     return distance2 <= (p1.radius + p2.radius)**2
 
-def collide_particles(p1, p2):
-    restitution = p1.restitution * p2.restitution
+def collide_particles(p1, p2, events=None):
+    """
+    Collide two particles if they touch, and return whether they did.
 
+    If events is an EventBus, the collision is emitted to it.
+    """
     # Don't collide immovable particles.
     if p1.immovable and p2.immovable:
-        return
+        return False
 
     # Test if p1 and p2 are actually intersecting.
     if not intersect(p1, p2):
-        return
+        return False
+
+    bounce_particles(p1, p2, events)
+    return True
+
+def bounce_particles(p1, p2, events=None):
+    """
+    Collide two particles that are touching, without checking whether they
+    intersect first.
+
+    If events is an EventBus, the collision is emitted to it, unless the
+    particles were moving apart. Particles whose centers are on top of each
+    other are pushed apart along the x axis.
+    """
+    restitution = p1.restitution * p2.restitution
+    first, second = p1, p2
 
     # If one particle is immovable, make it the first one.
     if not p1.immovable and p2.immovable:
@@ -105,7 +167,10 @@ def collide_particles(p1, p2):
 
     # Split into normal and tangential components and calculate
     # initial velocities.
-    normal = vec.norm(v_span)
+    if v_span == (0, 0):
+        normal = COINCIDENT_NORMAL
+    else:
+        normal = vec.norm(v_span)
     tangent = vec.perp(normal)
     v1_tangent = vec.proj(p1.velocity, tangent)
     v2_tangent = vec.proj(p2.velocity, tangent)
@@ -124,6 +189,8 @@ def collide_particles(p1, p2):
             v2_tangent,
             vec.mul(normal, p2_final),
         )
+        if events is not None:
+            emit_collision(events, first, second, (p2_final - p2_initial) * p2.mass)
         return
 
     # Elastic collision equations along normal component.
@@ -147,3 +214,216 @@ def collide_particles(p1, p2):
         v2_tangent,
         vec.mul(normal, p2_final),
     )
+    if events is not None:
+        emit_collision(events, first, second, (p2_final - p2_initial) * m2)
+
+def emit_collision(events, p1, p2, impulse):
+    """
+    Emit a collision between two particles, with the contact point on the line
+    between their centers, where their surfaces would meet.
+    """
+    (x1, y1), (x2, y2) = p1.pos, p2.pos
+    radius = p1.radius + p2.radius
+    share = p1.radius / radius if radius > 0 else 0.5
+    point = (x1 + (x2 - x1) * share, y1 + (y2 - y1) * share)
+    events.emit(COLLISION, p1, p2, abs(impulse), point)
+
+
+def time_of_impact(p1, p2):
+    """
+    Find when two particles first touched while moving from last_pos to pos.
+
+    Returns the time of impact as a fraction of the last tick, or None if they
+    did not touch, or were already touching at the start of the tick.
+    """
+    return path_time_of_impact(
+        p1.last_pos, p1.pos, p2.last_pos, p2.pos, p1.radius + p2.radius,
+    )
+
+def path_time_of_impact(start1, end1, start2, end2, radius):
+    """
+    Find when two circles, whose radii add up to radius, first touched while
+    moving in straight lines from start to end over the same time.
+
+    Returns the time of impact as a fraction of that time, or None if they
+    did not touch, or were already touching at the start.
+    """
+    # Work in the frame of reference of the first circle, with the second
+    # one moving in a straight line.
+    start = vec.vfrom(start1, start2)
+    end = vec.vfrom(end1, end2)
+    motion = vec.vfrom(start, end)
+
+    # Solve |start + motion * t| = radius for the first t.
+    a = vec.mag2(motion)
+    if a == 0:
+        return None
+    b = 2 * vec.dot(start, motion)
+    c = vec.mag2(start) - radius**2
+    if c <= 0:
+        return None
+    discriminant = b**2 - 4 * a * c
+    if discriminant < 0:
+        return None
+    t = (-b - math.sqrt(discriminant)) / (2 * a)
+    if 0 <= t <= 1:
+        return t
+    return None
+
+def collide_particle_pairs(state, first, second, events=None):
+    """
+    Call collide_particles on pairs of ParticleStore indices, in order, with
+    numpy, and return the number that were touching.
+
+    If events is an EventBus, the collisions are emitted to it.
+    """
+    first = np.asarray(first, dtype=int)
+    second = np.asarray(second, dtype=int)
+    pos = state.pos
+    radius = state.radius
+    immovable = state.immovable
+
+    # Don't collide immovable particles, and only keep pairs that are actually
+    # intersecting. Collisions don't change positions, so we can test all the
+    # pairs up front.
+    span = pos[second] - pos[first]
+    distance2 = span[:, 0]**2 + span[:, 1]**2
+    keep = (
+        ~(immovable[first] & immovable[second]) &
+        (distance2 <= (radius[first] + radius[second])**2)
+    )
+    first = first[keep]
+    second = second[keep]
+    if len(first) == 0:
+        return 0
+
+    # Pairs that share a movable particle go one after another, so put each
+    # pair in the round after the last one that used either of its particles.
+    previous_a, previous_b = _previous_pairs(
+        first, second, immovable[first], immovable[second],
+    )
+    rounds = np.zeros(len(first), dtype=int)
+    while True:
+        after_a = np.where(previous_a < 0, 0, rounds[previous_a] + 1)
+        after_b = np.where(previous_b < 0, 0, rounds[previous_b] + 1)
+        new_rounds = np.maximum(after_a, after_b)
+        if np.array_equal(new_rounds, rounds):
+            break
+        rounds = new_rounds
+
+    order = np.argsort(rounds, kind='stable')
+    boundaries = np.searchsorted(rounds[order], np.arange(rounds[order[-1]] + 2))
+    impulse = np.zeros(len(first))
+    approaching = np.zeros(len(first), dtype=bool)
+    for start, end in zip(boundaries[:-1].tolist(), boundaries[1:].tolist()):
+        in_round = order[start:end]
+        approaching[in_round], impulse[in_round] = _collide_disjoint_pairs(
+            state, first[in_round], second[in_round],
+        )
+    if events is not None and approaching.any():
+        _emit_collisions(
+            state, events, first[approaching], second[approaching], impulse[approaching],
+        )
+    return len(first)
+
+def _previous_pairs(first, second, first_immovable, second_immovable):
+    """
+    Find the last pair before each one with the same movable first particle,
+    and second particle, or -1.
+    """
+    n = len(first)
+    particles = np.concatenate([first, second])
+    pairs = np.concatenate([np.arange(n), np.arange(n)])
+    movable = ~np.concatenate([first_immovable, second_immovable])
+    previous = np.full(2 * n, -1, dtype=int)
+    entries = np.nonzero(movable)[0]
+    entries = entries[np.lexsort((pairs[entries], particles[entries]))]
+    repeated = particles[entries[1:]] == particles[entries[:-1]]
+    previous[entries[1:][repeated]] = pairs[entries[:-1][repeated]]
+    return previous[:n], previous[n:]
+
+def _collide_disjoint_pairs(state, first, second):
+    velocity = state.velocity
+    mass = state.mass
+    immovable = state.immovable
+    restitution = state.restitution[first] * state.restitution[second]
+    # The impulse of each collision, which stays 0 for pairs moving apart.
+    impulse = np.zeros(len(first))
+
+    # If one particle is immovable, make it the first one.
+    swap = immovable[second] & ~immovable[first]
+    first, second = np.where(swap, second, first), np.where(swap, first, second)
+
+    # Split into normal and tangential components and calculate
+    # initial velocities.
+    v_span = state.pos[second] - state.pos[first]
+    span_length = np.sqrt(v_span[:, 0]**2 + v_span[:, 1]**2)
+    coincident = span_length == 0
+    v_span[coincident] = COINCIDENT_NORMAL
+    span_length[coincident] = 1
+    normal = v_span * (1 / span_length)[:, np.newaxis]
+    tangent = np.column_stack([normal[:, 1], -normal[:, 0]])
+    tangent_length2 = tangent[:, 0]**2 + tangent[:, 1]**2
+    v1 = velocity[first]
+    v2 = velocity[second]
+    v1_tangent = tangent * (_dot(v1, tangent) / tangent_length2)[:, np.newaxis]
+    v2_tangent = tangent * (_dot(v2, tangent) / tangent_length2)[:, np.newaxis]
+    p1_initial = _dot(v1, normal)
+    p2_initial = _dot(v2, normal)
+
+    # Don't collide if particles were actually moving away from each other.
+    approaching = ~(p1_initial - p2_initial < 0)
+
+    # Handle immovable particles specially.
+    bounce = approaching & immovable[first]
+    p2_final = -p2_initial[bounce] * restitution[bounce]
+    velocity[second[bounce]] = (
+        v2_tangent[bounce] + normal[bounce] * p2_final[:, np.newaxis]
+    )
+    impulse[bounce] = (p2_final - p2_initial[bounce]) * mass[second[bounce]]
+
+    # Elastic collision equations along normal component.
+    elastic = approaching & ~immovable[first]
+    m1 = mass[first[elastic]]
+    m2 = mass[second[elastic]]
+    m1plusm2 = (m1 + m2) / restitution[elastic]
+    p1_initial = p1_initial[elastic]
+    p2_initial = p2_initial[elastic]
+    p1_final = (
+        p1_initial * (m1 - m2) / m1plusm2 +
+        p2_initial * (2 * m2) / m1plusm2
+    )
+    p2_final = (
+        p2_initial * (m2 - m1) / m1plusm2 +
+        p1_initial * (2 * m1) / m1plusm2
+    )
+    normal = normal[elastic]
+    velocity[first[elastic]] = (
+        v1_tangent[elastic] + normal * p1_final[:, np.newaxis]
+    )
+    velocity[second[elastic]] = (
+        v2_tangent[elastic] + normal * p2_final[:, np.newaxis]
+    )
+    impulse[elastic] = (p2_final - p2_initial) * m2
+    return approaching, np.abs(impulse)
+
+def _emit_collisions(state, events, first, second, impulse):
+    r1 = state.radius[first]
+    radius = r1 + state.radius[second]
+    share = np.full(len(first), 0.5)
+    np.divide(r1, radius, out=share, where=radius > 0)
+    share = share[:, np.newaxis]
+    pos1 = state.pos[first]
+    point = pos1 + (state.pos[second] - pos1) * share
+    objects = state.particles
+    events.emit_many(
+        COLLISION,
+        [objects[i] for i in first.tolist()],
+        [objects[i] for i in second.tolist()],
+        impulse.tolist(),
+        point[:, 0].tolist(),
+        point[:, 1].tolist(),
+    )
+
+def _dot(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1]
@@ -0,0 +1,232 @@
+"""
+Running the physics on its own thread, apart from the display.
+
+The physics thread steps the environment at a fixed rate, and after every
+tick publishes an immutable snapshot of what the display needs to draw. The
+display, on the main thread, keeps the last two snapshots and draws a state
+interpolated between them, so that the motion is smooth at any frame rate, and
+a slow frame never holds up the physics.
+
+The keyboard is read on the main thread too. Its state is handed to the
+physics thread packed into replay bytes, and copied into the inputs of the
+simulation only between ticks, so that a tick sees the same inputs from start
+to end, and a recorded replay still reproduces the match exactly.
+"""
+from __future__ import division
+
+import threading
+import time
+from collections import namedtuple
+
+from player import Player
+from replay import input_scheme, pack_input, unpack_input
+from scheduler import TickScheduler
+import constants as c
+
+
+Snapshot = namedtuple('Snapshot', 'tick time particles players wall_index')
+Snapshot.__doc__ = """
+The state of an environment after a tick, as needed for drawing it.
+
+time is when the tick was due, by time.perf_counter(). particles holds an
+(object, graphics_type, pos, radius) tuple for each particle, and players an
+(object, attributes) pair for each player. The objects are only used to
+match up the same object between snapshots.
+"""
+
+# The player attributes that are drawn, or shown by the widgets.
+player_attributes = [
+    'graphics_type', 'pos', 'radius', 'velocity', 'direction', 'number',
+    'do_thrust', 'do_brake', 'boost_charge_time', 'boost_heavy_time_remaining',
+    'rudder_force', 'damage', 'player_health', 'dead',
+]
+
+def take_snapshot(env, tick_time):
+    particles = tuple(
+        (p, p.graphics_type, p.pos, p.radius)
+        for p in env.particles
+        if not isinstance(p, Player)
+    )
+    players = tuple(
+        (p, dict((name, getattr(p, name)) for name in player_attributes))
+        for p in env.players
+    )
+    return Snapshot(env.tick, tick_time, particles, players, env.wall_index)
+
+
+class PhysicsThread(threading.Thread):
+    """
+    Steps an environment at a fixed rate, and publishes snapshots of it.
+
+    step is called for each tick, and defaults to updating the environment.
+    The ticks are run by a TickScheduler, so if the physics falls behind, it
+    skips ahead instead of trying to catch up all at once.
+
+    inputs are the inputs the simulation reads, by default those of the
+    environment. They belong to the physics thread; other threads hand over
+    new input states with set_inputs. If step raises an exception, the thread
+    stops, and the exception is raised again by latest.
+    """
+    def __init__(
+        self,
+        env,
+        step=None,
+        tick_ms=c.physics_tick_ms,
+        inputs=None,
+        scheduler=None,
+    ):
+        super(PhysicsThread, self).__init__()
+        self.daemon = True
+        self.env = env
+        if step is None:
+            step = lambda: env.update(tick_ms)
+        self.step = step
+        self.tick_seconds = tick_ms / 1000
+        if scheduler is None:
+            scheduler = TickScheduler(tick_ms, max_steps=10)
+        self.scheduler = scheduler
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        now = time.perf_counter()
+        # The last two snapshots, oldest first.
+        self.snapshots = (take_snapshot(env, now), take_snapshot(env, now))
+        self.error = None
+        if inputs is None:
+            inputs = env.inputs
+        self.inputs = inputs
+        self.schemes = [input_scheme(inp) for inp in inputs]
+        self.input_states = None
+
+    def latest(self):
+        """Get the last two snapshots, oldest first."""
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            return self.snapshots
+
+    def set_inputs(self, sources):
+        """Hand over the current state of sources, one for each input."""
+        states = bytes(bytearray(
+            pack_input(inp, scheme)
+            for inp, scheme in zip(sources, self.schemes)
+        ))
+        with self.lock:
+            self.input_states = states
+
+    def apply_inputs(self):
+        with self.lock:
+            states = self.input_states
+        if states is None:
+            return
+        for inp, scheme, packed in zip(self.inputs, self.schemes, bytearray(states)):
+            for key, value in unpack_input(packed, scheme).items():
+                setattr(inp, key, value)
+
+    def publish(self, snapshot):
+        with self.lock:
+            self.snapshots = (self.snapshots[1], snapshot)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            self.run_ticks()
+        except Exception as e:
+            self.error = e
+
+    def tick(self):
+        self.apply_inputs()
+        self.step()
+        # The scheduler clock is time.perf_counter(), in milliseconds.
+        self.publish(take_snapshot(self.env, self.scheduler.sim_time / 1000))
+
+    def run_ticks(self):
+        scheduler = self.scheduler
+        scheduler.start()
+        while not self.stopped.is_set():
+            if scheduler.run(self.tick) == 0:
+                time.sleep(max(scheduler.time_until_due(), 0) / 1000)
+
+
+class RenderObject(object):
+    """Stands in for a simulated object when drawing, with copied attributes."""
+
+
+class RenderState(object):
+    """
+    An interpolated view of the snapshots from a PhysicsThread.
+
+    It has the attributes of an Environment that the display uses, so the
+    display can show it in place of the environment. The objects are stand-ins,
+    kept from one frame to the next, and only touched by the main thread.
+    inputs are shown by the joystick widgets, and should be the ones read on
+    the main thread.
+    """
+    def __init__(self, physics, inputs=None):
+        self.physics = physics
+        if inputs is None:
+            inputs = physics.inputs
+        self.inputs = inputs
+        self.profiler = physics.env.profiler
+        self.objects = []
+        self.players = []
+        self.wall_index = None
+        self.stand_ins = {}
+
+    def stand_in(self, obj):
+        if obj not in self.stand_ins:
+            self.stand_ins[obj] = RenderObject()
+        return self.stand_ins[obj]
+
+    def update(self, now=None):
+        """
+        Set the stand-ins to the state one tick ago, which lies between the
+        last two snapshots.
+        """
+        if now is None:
+            now = time.perf_counter()
+        previous, current = self.physics.latest()
+        span = current.time - previous.time
+        if span > 0:
+            amount = (now - self.physics.tick_seconds - previous.time) / span
+            amount = min(max(amount, 0.0), 1.0)
+        else:
+            amount = 1.0
+        previous_pos = dict((p, pos) for p, _, pos, _ in previous.particles)
+        previous_pos.update((p, attributes['pos']) for p, attributes in previous.players)
+
+        def interpolate(obj, pos):
+            old = previous_pos.get(obj)
+            if old is None:
+                return pos
+            return (
+                old[0] + (pos[0] - old[0]) * amount,
+                old[1] + (pos[1] - old[1]) * amount,
+            )
+
+        stand_ins = {}
+        objects = []
+        for obj, graphics_type, pos, radius in current.particles:
+            r = self.stand_in(obj)
+            r.graphics_type = graphics_type
+            r.pos = interpolate(obj, pos)
+            r.radius = radius
+            stand_ins[obj] = r
+            objects.append(r)
+        players = []
+        for obj, attributes in current.players:
+            r = self.stand_in(obj)
+            r.__dict__.update(attributes)
+            r.pos = interpolate(obj, attributes['pos'])
+            stand_ins[obj] = r
+            players.append(r)
+            if not r.dead:
+                objects.append(r)
+        # Forget the objects that are gone.
+        self.stand_ins = stand_ins
+        # Widgets may keep the list of players, so it is changed in place.
+        self.objects = objects
+        self.players[:] = players
+        self.wall_index = current.wall_index
@@ -1,8 +1,9 @@
 from __future__ import division
 
-import vec
+import vec2 as vec
 
 from particle import Particle
+from events import DAMAGE
 import constants as c
 
 def heading_to_vector(heading):
@@ -38,7 +39,10 @@ class Player(Particle):
         # Damage
         self.damage = 0.0
         self.dead = False
+        self.death_tick = None
         self.player_health = kwargs.pop('player_health', c.player_health)
+        # The EventBus that damage is emitted to, set by the environment.
+        self.events = None
 
         super(Player, self).__init__(**kwargs)
 
@@ -208,11 +212,16 @@ class Player(Particle):
         force = vec.norm(force, strength)
         return force
 
-    def rebound(self, *args, **kwargs):
+    def rebound(self, normal, point=None, restitution=1):
         v_initial = self.velocity
-        super(Player, self).rebound(*args, **kwargs)
+        super(Player, self).rebound(normal, point, restitution)
         v_final = self.velocity
 
         # Apply damage based on the difference in momentum.
         v_diff = vec.sub(v_final, v_initial)
-        self.damage += vec.mag(v_diff) * self.mass
+        amount = vec.mag(v_diff) * self.mass
+        self.damage += amount
+        if self.events is not None:
+            if point is None:
+                point = self.pos
+            self.events.emit(DAMAGE, self, None, amount, point)
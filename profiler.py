@@ -0,0 +1,78 @@
+from __future__ import division
+
+import time
+
+
+class Profiler(object):
+    """
+    Measures where the time goes in Environment.update.
+
+    Set it as the profiler of an environment, and every tick adds the time
+    spent in each phase, and counts of the work done. The totals are kept for
+    the whole run, and the averages per tick over the last full window of
+    ticks are kept in recent, for showing while the game runs.
+    """
+    phases = ['sleep', 'pairs', 'walls', 'integrate', 'continuous', 'deaths']
+    counters = ['pairs_tested', 'contacts', 'wall_tests', 'wall_hits', 'impacts']
+
+    def __init__(self, window=60):
+        self.window = window
+        self.ticks = 0
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.counts = dict.fromkeys(self.counters, 0)
+        self.recent = None
+        self.window_start = (0, dict(self.times), dict(self.counts))
+        self.last_time = None
+
+    def start_tick(self):
+        self.last_time = time.perf_counter()
+
+    def lap(self, phase):
+        """Add the time since the last lap, or the start of the tick, to phase."""
+        now = time.perf_counter()
+        self.times[phase] += now - self.last_time
+        self.last_time = now
+
+    def count(self, **counts):
+        for name, n in counts.items():
+            self.counts[name] += n
+
+    def end_tick(self):
+        self.ticks += 1
+        if self.ticks - self.window_start[0] >= self.window:
+            self.recent = self.averages(*self.window_start)
+            self.window_start = (self.ticks, dict(self.times), dict(self.counts))
+
+    def averages(self, start_tick=0, start_times=None, start_counts=None):
+        """
+        Get the mean seconds per tick in each phase, and the mean counts per
+        tick, since the given starting point or for the whole run.
+        """
+        ticks = self.ticks - start_tick
+        start_times = start_times or dict.fromkeys(self.phases, 0.0)
+        start_counts = start_counts or dict.fromkeys(self.counters, 0)
+        result = {}
+        for name in self.phases:
+            result[name] = (self.times[name] - start_times[name]) / max(ticks, 1)
+        for name in self.counters:
+            result[name] = (self.counts[name] - start_counts[name]) / max(ticks, 1)
+        result['total'] = sum(result[name] for name in self.phases)
+        return result
+
+    def report(self, averages=None):
+        """Describe the averages per tick as lines of text."""
+        if averages is None:
+            averages = self.averages()
+        lines = ['tick: {:.2f} ms'.format(averages['total'] * 1000)]
+        for name in self.phases:
+            lines.append('{}: {:.2f} ms'.format(name, averages[name] * 1000))
+        lines.append('pair tests: {:.0f}, contacts: {:.0f}, fast impacts: {:.0f}'.format(
+            averages['pairs_tested'],
+            averages['contacts'],
+            averages['impacts'],
+        ))
+        lines.append('wall tests: {:.0f}, hits: {:.0f}'.format(
+            averages['wall_tests'],
+            averages['wall_hits'],
+        ))
+        return lines
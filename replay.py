@@ -0,0 +1,268 @@
+"""
+Recording and playback of matches.
+
+A replay stores the level name, the options of the Environment, and the input
+state of every player for every tick, packed into one byte per player per
+tick. Since the simulation is deterministic, playing the inputs back through a
+new Environment with the same options reproduces the match exactly.
+
+Usage:
+    python replay.py FILE [--seek TICK]
+"""
+from __future__ import division, print_function
+
+import argparse
+import struct
+import time
+
+from environment import Environment
+import headless
+import levels
+
+MAGIC = b'MGRP'
+VERSION = 2
+# Magic, version, number of players, tick length, number of ticks, length of
+# the level name, the option flags, and the length of the broadphase name.
+HEADER = struct.Struct('<4sBBdIHBB')
+
+# The Environment options stored as flags, one bit each, in order.
+OPTION_FLAGS = ['vectorized', 'continuous', 'sleeping']
+
+# Control schemes, matching the ones understood by Player.interpret_controls.
+SCHEME_TURN = 0 # thrust, brake, and turn_direction.
+SCHEME_AXES = 1 # brake, x_axis, and y_axis.
+
+# No buttons pressed and all axes centered, in either scheme.
+NEUTRAL_INPUT = 0x14
+
+
+def input_scheme(inp):
+    if hasattr(inp, 'turn_direction'):
+        return SCHEME_TURN
+    return SCHEME_AXES
+
+def pack_input(inp, scheme):
+    """Pack the state of an input into a single byte."""
+    if scheme == SCHEME_TURN:
+        return (
+            bool(inp.thrust) |
+            bool(inp.brake) << 1 |
+            (inp.turn_direction + 1) << 2
+        )
+    else:
+        return (
+            bool(inp.brake) << 1 |
+            (inp.x_axis + 1) << 2 |
+            (inp.y_axis + 1) << 4
+        )
+
+def unpack_input(value, scheme):
+    """Unpack an input byte into a dictionary of input attributes."""
+    if scheme == SCHEME_TURN:
+        return dict(
+            thrust=bool(value & 1),
+            brake=bool(value & 2),
+            turn_direction=((value >> 2) & 3) - 1,
+        )
+    else:
+        return dict(
+            brake=bool(value & 2),
+            x_axis=((value >> 2) & 3) - 1,
+            y_axis=((value >> 4) & 3) - 1,
+        )
+
+
+class Replay(object):
+    """
+    The recorded inputs of a match.
+
+    options are the keyword arguments of the Environment that the match was
+    played in, as given by Environment.options.
+    """
+    def __init__(self, level_name, schemes, tick_ms, options, frames=b''):
+        self.level_name = level_name
+        self.schemes = list(schemes)
+        self.tick_ms = tick_ms
+        self.options = dict(options)
+        self.frames = bytearray(frames)
+
+    @property
+    def num_ticks(self):
+        if not self.schemes:
+            return 0
+        return len(self.frames) // len(self.schemes)
+
+    def inputs_at(self, tick):
+        """Get the input attributes of each player on the given tick."""
+        n = len(self.schemes)
+        values = self.frames[tick * n:(tick + 1) * n]
+        return [
+            unpack_input(value, scheme)
+            for value, scheme in zip(values, self.schemes)
+        ]
+
+    def save(self, path):
+        name = self.level_name.encode('utf-8')
+        broadphase = self.options['broadphase'].encode('utf-8')
+        flags = 0
+        for bit, option in enumerate(OPTION_FLAGS):
+            flags |= bool(self.options[option]) << bit
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(
+                MAGIC,
+                VERSION,
+                len(self.schemes),
+                self.tick_ms,
+                self.num_ticks,
+                len(name),
+                flags,
+                len(broadphase),
+            ))
+            f.write(name)
+            f.write(broadphase)
+            f.write(bytes(bytearray(self.schemes)))
+            f.write(bytes(self.frames))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        (
+            magic, version, num_players, tick_ms, num_ticks, name_length,
+            flags, broadphase_length,
+        ) = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a replay file.'.format(path))
+        offset = HEADER.size
+        level_name = data[offset:offset + name_length].decode('utf-8')
+        offset += name_length
+        options = dict(
+            (option, bool(flags >> bit & 1))
+            for bit, option in enumerate(OPTION_FLAGS)
+        )
+        options['broadphase'] = data[offset:offset + broadphase_length].decode('utf-8')
+        offset += broadphase_length
+        schemes = bytearray(data[offset:offset + num_players])
+        offset += num_players
+        frames = data[offset:offset + num_players * num_ticks]
+        return cls(level_name, schemes, tick_ms, options, frames)
+
+
+class ReplayRecorder(object):
+    """
+    Records the inputs of an Environment.
+
+    Set it as the recorder of the environment, and it is called at the start of
+    every tick with the current state of the inputs. If the environment is
+    restored to an earlier tick, the inputs after it are recorded over.
+
+    options are the options of the environment, from Environment.options.
+    """
+    def __init__(self, level_name, inputs, options):
+        self.replay = Replay(
+            level_name,
+            [input_scheme(inp) for inp in inputs],
+            tick_ms=0.0,
+            options=options,
+        )
+
+    def record(self, tick, inputs, elapsed_ticks):
+        replay = self.replay
+        if replay.num_ticks == 0:
+            replay.tick_ms = elapsed_ticks
+        elif elapsed_ticks != replay.tick_ms:
+            raise ValueError('Replays can only be recorded with a fixed time step.')
+        del replay.frames[tick * len(replay.schemes):]
+        replay.frames.extend(
+            pack_input(inp, scheme)
+            for inp, scheme in zip(inputs, replay.schemes)
+        )
+
+
+class ReplayInput(object):
+    """An input that is set from a replay, with the attributes of its scheme."""
+    def __init__(self, scheme):
+        self.set_state(unpack_input(NEUTRAL_INPUT, scheme))
+
+    def set_state(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+class ReplayPlayer(object):
+    """
+    Plays back a replay by re-simulating it.
+
+    The environment is made with the options the match was recorded with.
+    Snapshots of the environment are kept every keyframe_interval ticks as the
+    replay plays, so that seeking backward starts from the nearest keyframe
+    instead of from the beginning.
+    """
+    def __init__(self, replay, keyframe_interval=600, profiler=None):
+        self.replay = replay
+        self.keyframe_interval = keyframe_interval
+        inputs = [ReplayInput(scheme) for scheme in replay.schemes]
+        self.env = Environment(inputs, profiler=profiler, **replay.options)
+        self.env.load_level(getattr(levels, replay.level_name))
+        self.keyframes = {}
+        self.save_keyframe()
+
+    @property
+    def tick(self):
+        return self.env.tick
+
+    @property
+    def done(self):
+        return self.env.tick >= self.replay.num_ticks
+
+    def save_keyframe(self):
+        self.keyframes[self.env.tick] = self.env.snapshot()
+
+    def step(self):
+        """Simulate one tick of the replay."""
+        if self.done:
+            return
+        for inp, state in zip(self.env.inputs, self.replay.inputs_at(self.env.tick)):
+            inp.set_state(state)
+        self.env.update(self.replay.tick_ms)
+        if self.env.tick % self.keyframe_interval == 0:
+            if self.env.tick not in self.keyframes:
+                self.save_keyframe()
+
+    def seek(self, tick):
+        """Move the replay to the given tick."""
+        tick = max(0, min(tick, self.replay.num_ticks))
+        keyframe_tick = max(t for t in self.keyframes if t <= tick)
+        if tick < self.env.tick or keyframe_tick > self.env.tick:
+            self.env.restore(self.keyframes[keyframe_tick])
+        while self.env.tick < tick:
+            self.step()
+
+    def fast_forward(self, ticks):
+        self.seek(self.env.tick + ticks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play back a replay without a display.')
+    parser.add_argument('path')
+    parser.add_argument('--seek', type=int, default=None)
+    args = parser.parse_args()
+
+    player = ReplayPlayer(Replay.load(args.path))
+    start = time.time()
+    if args.seek is None:
+        player.seek(player.replay.num_ticks)
+    else:
+        player.seek(args.seek)
+    seconds = time.time() - start
+    ticks = player.tick
+    headless.report(headless.RunResult(
+        env=player.env,
+        ticks=ticks,
+        seconds=seconds,
+        ticks_per_second=ticks / seconds if seconds > 0 else float('inf'),
+    ))
+
+
+if __name__ == '__main__':
+    main()
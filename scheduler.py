@@ -0,0 +1,120 @@
+from __future__ import division, print_function
+
+import time
+
+
+def clock_ms():
+    return time.perf_counter() * 1000
+
+
+class TickScheduler(object):
+    """
+    Decides when to run physics ticks, so that a slow simulation degrades
+    instead of locking up the game.
+
+    Ticks are due every tick_ms of real time. Each call to run() runs the ticks
+    that are due, but at most max_steps of them, and stops early once they
+    have taken frame_budget_ms, so the caller gets to draw a frame in between
+    no matter how slow the ticks are. If the simulation falls more than
+    max_steps ticks behind, the extra time is dropped: the game slows down
+    rather than trying to catch up all at once, which would only make the next
+    frame later still.
+
+    The cost of a tick is tracked as a moving average. If env is given, and
+    ticks take more than reduce_above of the tick time, the environment is
+    switched to reduced fidelity, without continuous collision, until they
+    take less than restore_below of it again. That changes the outcome of the
+    simulation, so leave env out when recording a replay or playing over the
+    network.
+    """
+    def __init__(
+        self,
+        tick_ms,
+        max_steps=5,
+        frame_budget_ms=50.0,
+        env=None,
+        reduce_above=0.8,
+        restore_below=0.4,
+        smoothing=0.1,
+        clock=clock_ms,
+    ):
+        self.tick_ms = tick_ms
+        self.max_steps = max_steps
+        self.frame_budget_ms = frame_budget_ms
+        self.env = env
+        self.reduce_above = reduce_above
+        self.restore_below = restore_below
+        self.smoothing = smoothing
+        self.clock = clock
+        # The time the simulation has reached, by the clock.
+        self.sim_time = None
+        self.tick_cost_ms = 0.0
+        self.reduced = False
+        self.behind = False
+        self.dropped_ms = 0.0
+        self.times_behind = 0
+
+    def start(self):
+        self.sim_time = self.clock()
+
+    def time_until_due(self):
+        """The time in milliseconds until the next tick is due."""
+        return self.sim_time + self.tick_ms - self.clock()
+
+    def run(self, step):
+        """
+        Call step once for each tick that is due, within the limits.
+
+        sim_time is advanced before each call, so step sees the time that the
+        tick brings the simulation to. Returns the number of ticks run.
+        """
+        start = now = self.clock()
+        due = int((now - self.sim_time) // self.tick_ms)
+        if due > self.max_steps:
+            dropped = (due - self.max_steps) * self.tick_ms
+            self.sim_time += dropped
+            self.dropped_ms += dropped
+            if not self.behind:
+                self.times_behind += 1
+                print('Physics fell behind, skipping {:.0f} ms.'.format(dropped))
+            self.behind = True
+            due = self.max_steps
+        elif due <= 1:
+            self.behind = False
+
+        ran = 0
+        while ran < due:
+            self.sim_time += self.tick_ms
+            step()
+            end = self.clock()
+            self.tick_cost_ms += (end - now - self.tick_cost_ms) * self.smoothing
+            now = end
+            ran += 1
+            if now - start >= self.frame_budget_ms:
+                break
+        if ran:
+            self.adjust_fidelity()
+        return ran
+
+    def adjust_fidelity(self):
+        if self.env is None:
+            return
+        load = self.tick_cost_ms / self.tick_ms
+        if not self.reduced and load > self.reduce_above:
+            self.reduced = True
+            self.continuous = self.env.continuous
+            self.env.continuous = False
+        elif self.reduced and load < self.restore_below:
+            self.reduced = False
+            self.env.continuous = self.continuous
+
+    def report(self):
+        """Describe any trouble keeping up, in lines of text."""
+        lines = []
+        if self.reduced:
+            lines.append('physics at reduced fidelity, {:.1f} ms per tick'.format(
+                self.tick_cost_ms,
+            ))
+        if self.behind:
+            lines.append('physics behind, {:.0f} ms skipped'.format(self.dropped_ms))
+        return lines
@@ -0,0 +1,286 @@
+from __future__ import division
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from broadphase import UniformGrid
+from particle import intersect
+from player import Player
+import constants as c
+
+
+class SleepTracker(object):
+    """
+    Puts islands of touching particles to sleep once they have all been
+    slower than c.sleep_speed for c.sleep_time seconds, until a moving
+    particle touches one of them. Players never sleep, and immovable
+    particles neither sleep nor wake anything.
+
+    The state is kept in the sleeping, idle_time and island attributes of the
+    particles, or in the arrays of the ParticleStore for the vectorized
+    physics. An island is labeled with the lowest level index in it.
+    """
+    def __init__(self):
+        self.particles = []
+        self.awake = []
+        self.islands = {}
+        self.order = {}
+        self.cells = None
+        self.cell_size = 1.0
+        self.store = None
+        self.awake_index = None
+        self.sleeping_index = None
+        self.level_order = None
+
+    def reset(self, particles, level_particles, store=None):
+        """Rebuild after the particles or their state have changed."""
+        self.particles = particles
+        self.store = store
+        self.order = dict((p, k) for k, p in enumerate(level_particles))
+        self.islands = {}
+        if store is not None:
+            self.level_order = np.array(
+                [self.order[p] for p in store.particles],
+                dtype=int,
+            )
+            sleeping = np.flatnonzero(store.sleeping).tolist()
+            for i, label in zip(sleeping, store.island[sleeping].tolist()):
+                self.islands.setdefault(label, []).append(store.particles[i])
+        else:
+            for p in particles:
+                if p.sleeping:
+                    self.islands.setdefault(p.island, []).append(p)
+        self.cell_size = 2 * max([p.radius for p in particles] or [0.5])
+        self.sleepers_changed()
+
+    def sleepers_changed(self):
+        # The awake list is replaced rather than changed in place, so users
+        # can tell when it is out of date.
+        if self.store is not None:
+            sleeping = self.store.sleeping != 0
+            self.awake_index = np.flatnonzero(~sleeping)
+            self.sleeping_index = np.flatnonzero(sleeping)
+            particles = self.store.particles
+            self.awake = [particles[i] for i in self.awake_index.tolist()]
+        else:
+            self.awake = [p for p in self.particles if not p.sleeping]
+        self.cells = None
+
+    def cell_of(self, pos):
+        return (
+            int(math.floor(pos[0] / self.cell_size)),
+            int(math.floor(pos[1] / self.cell_size)),
+        )
+
+    def build_cells(self):
+        self.cells = {}
+        for members in self.islands.values():
+            for p in members:
+                self.cells.setdefault(self.cell_of(p.pos), []).append(p)
+
+    def wake_touching(self):
+        """
+        Wake the islands of sleeping particles that touch a moving one.
+
+        Returns True if anything woke up.
+        """
+        if not self.islands:
+            return False
+        if self.store is not None:
+            return self.wake_touching_arrays()
+        if self.cells is None:
+            self.build_cells()
+        cells = self.cells
+        woken = False
+        for p in self.awake:
+            if p.immovable:
+                continue
+            cx, cy = self.cell_of(p.pos)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for q in cells.get((cx + dx, cy + dy), ()):
+                        if q.sleeping and intersect(p, q):
+                            self.wake_island(q.island)
+                            woken = True
+        if woken:
+            self.sleepers_changed()
+        return woken
+
+    def wake_touching_arrays(self):
+        """Do the work of wake_touching with numpy."""
+        store = self.store
+        movers = self.awake_index[~store.immovable[self.awake_index]]
+        sleepers = self.sleeping_index
+        pairs = UniformGrid().cross_pair_arrays(
+            store.pos[movers],
+            store.radius[movers],
+            store.pos[sleepers],
+            store.radius[sleepers],
+        )
+        first = sleepers[pairs.first]
+        second = movers[pairs.second]
+        span = store.pos[first] - store.pos[second]
+        touching = (
+            span[:, 0]**2 + span[:, 1]**2 <=
+            (store.radius[first] + store.radius[second])**2
+        )
+        if not touching.any():
+            return False
+        for label in np.unique(store.island[first[touching]]).tolist():
+            self.wake_island(label)
+        self.sleepers_changed()
+        return True
+
+    def wake(self, p):
+        """Wake the island of a single particle, if it is asleep."""
+        if p.sleeping:
+            self.wake_island(p.island)
+            self.sleepers_changed()
+
+    def wake_island(self, label):
+        for p in self.islands.pop(label):
+            p.sleeping = False
+            p.idle_time = 0.0
+            p.island = -1
+
+    def update(self, elapsed_seconds, particles, index_pairs):
+        """
+        Update idle times after a tick, and put idle islands to sleep.
+
+        particles is the list of awake particles that was simulated, and
+        index_pairs the candidate pairs of them from the broadphase.
+        """
+        if self.store is not None:
+            self.update_arrays(elapsed_seconds, particles, index_pairs)
+            return
+        ready = set()
+        for p in particles:
+            if p.sleeping or p.immovable or isinstance(p, Player):
+                continue
+            if p.speed <= c.sleep_speed:
+                p.idle_time += elapsed_seconds
+                if p.idle_time >= c.sleep_time:
+                    ready.add(p)
+            else:
+                p.idle_time = 0.0
+        if not ready:
+            return
+
+        # Join touching particles into islands, with union-find. Only
+        # contacts with a ready particle matter, since an island with any
+        # particle that isn't ready stays awake anyway.
+        parent = {}
+        def find(p):
+            root = p
+            while root in parent:
+                root = parent[root]
+            while p is not root:
+                parent[p], p = root, parent[p]
+            return root
+        for i, j in index_pairs:
+            p1 = particles[i]
+            p2 = particles[j]
+            if (
+                (p1 in ready or p2 in ready) and
+                not p1.immovable and not p2.immovable and
+                intersect(p1, p2)
+            ):
+                root1 = find(p1)
+                root2 = find(p2)
+                if root1 is not root2:
+                    parent[root1] = root2
+
+        islands = {}
+        for p in particles:
+            if not p.immovable:
+                islands.setdefault(find(p), []).append(p)
+        fell_asleep = False
+        for members in islands.values():
+            if not all(p in ready for p in members):
+                continue
+            label = min(self.order[p] for p in members)
+            for p in members:
+                p.sleeping = True
+                p.island = label
+                p.velocity = (0, 0)
+            # Labels can repeat once particles are added or removed, in
+            # which case the islands just wake up together.
+            self.islands.setdefault(label, []).extend(members)
+            fell_asleep = True
+        if fell_asleep:
+            self.sleepers_changed()
+
+    def update_arrays(self, elapsed_seconds, particles, index_pairs):
+        """Do the work of update with numpy, for a PairArrays of index_pairs."""
+        store = self.store
+        if particles is self.awake:
+            index = self.awake_index
+        else:
+            # Something woke up during the tick.
+            index = np.array([p.index for p in particles], dtype=int)
+        immovable = store.immovable[index]
+        movable = ~(immovable | store.is_player[index] | (store.sleeping[index] != 0))
+        velocity = store.velocity[index]
+        speed = np.sqrt(velocity[:, 0]**2 + velocity[:, 1]**2)
+        slow = movable & (speed <= c.sleep_speed)
+        idle_time = store.idle_time[index]
+        idle_time[slow] += elapsed_seconds
+        idle_time[movable & ~slow] = 0.0
+        store.idle_time[index] = idle_time
+        ready = slow & (idle_time >= c.sleep_time)
+        if not ready.any():
+            return
+
+        # Only contacts with a ready particle matter, since an island with
+        # any particle that isn't ready stays awake anyway.
+        first = index_pairs.first
+        second = index_pairs.second
+        keep = (
+            (ready[first] | ready[second]) &
+            ~immovable[first] & ~immovable[second]
+        )
+        first = first[keep]
+        second = second[keep]
+        pos = store.pos[index]
+        radius = store.radius[index]
+        span = pos[first] - pos[second]
+        touching = (
+            span[:, 0]**2 + span[:, 1]**2 <=
+            (radius[first] + radius[second])**2
+        )
+        first = first[touching]
+        second = second[touching]
+
+        # Give both particles of each contact the lower of their labels, until
+        # every island has one label.
+        labels = np.arange(len(index))
+        while len(first):
+            low = np.minimum(labels[first], labels[second])
+            joined = labels.copy()
+            np.minimum.at(joined, first, low)
+            np.minimum.at(joined, second, low)
+            joined = joined[joined]
+            if (joined == labels).all():
+                break
+            labels = joined
+
+        waiting = labels[~ready & ~immovable]
+        asleep = np.flatnonzero(ready & ~np.isin(labels, waiting))
+        if len(asleep) == 0:
+            return
+        order = self.level_order[index[asleep]]
+        lowest = np.full(len(index), len(self.level_order))
+        np.minimum.at(lowest, labels[asleep], order)
+        island = lowest[labels[asleep]]
+        members = index[asleep]
+        store.sleeping[members] = 1
+        store.island[members] = island
+        store.velocity[members] = 0
+        particles = store.particles
+        for i, label in zip(members.tolist(), island.tolist()):
+            self.islands.setdefault(label, []).append(particles[i])
+        self.sleepers_changed()
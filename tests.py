@@ -1,12 +1,43 @@
 from __future__ import print_function
 
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
 import traceback
+from unittest import SkipTest
+
+# Draw without a window.
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import pygame as pg
 
 import vec
+import vec2
 import constants as c
-from environment import Environment
+import levels
+import environment
+from environment import Environment, every_pair
+from broadphase import make_broadphase
 from particle import Particle
+from particle import intersect
 from bumper import Bumper
+from wall import Wall, WallIndex, WallArrays, Polyline, Polygon
+from player import Player
+from profiler import Profiler
+import headless
+import batch
+import replay
+import netplay
+import benchmark
+import worldgen
+import levelfile
+from camera import Camera
+import display
+from physics_thread import PhysicsThread, RenderState
+from scheduler import TickScheduler
+from events import EventBus, COLLISION, WALL, DAMAGE, DEATH
 
 
 def assert_vectors_equal(a, b):
@@ -14,6 +45,19 @@ def assert_vectors_equal(a, b):
         assert abs(da - db) < c.epsilon, '{} != {}'.format(a, b)
 
 
+def skip_without_numpy():
+    """Skip the rest of a test, since the vectorized physics needs numpy."""
+    if environment.np is None:
+        raise SkipTest('numpy is not installed')
+
+
+def vectorized_modes():
+    """Run the scalar physics, then the vectorized physics if there is numpy."""
+    yield False
+    skip_without_numpy()
+    yield True
+
+
 def test_bumper():
     northwest = vec.norm((-1, -1))
     northeast = vec.norm((1, -1))
@@ -53,12 +97,1175 @@ def test_collision():
         assert_vectors_equal(right.velocity, (20, 0))
 
 
+def test_vec2_matches_vec():
+    # Every function of vec2 is exported.
+    assert sorted(vec2.__all__) == sorted(
+        name for name, value in vars(vec2).items()
+        if callable(value) and getattr(value, '__module__', None) == 'vec2'
+    )
+
+    rand = random.Random(0)
+    for _ in range(100):
+        a = (rand.uniform(-10, 10), rand.uniform(-10, 10))
+        b = (rand.uniform(-10, 10), rand.uniform(-10, 10))
+        s = rand.uniform(-10, 10)
+        for name, args in [
+            ('add', (a, b)),
+            ('sub', (a, b)),
+            ('vfrom', (a, b)),
+            ('mul', (a, s)),
+            ('div', (a, s)),
+            ('neg', (a,)),
+            ('norm', (a,)),
+            ('norm', (a, s)),
+            ('avg', (a, b)),
+            ('rotate', (a, s)),
+            ('perp', (a,)),
+            ('proj', (a, b)),
+        ]:
+            assert_vectors_equal(
+                getattr(vec, name)(*args),
+                getattr(vec2, name)(*args),
+            )
+        for name, args in [
+            ('dot', (a, b)),
+            ('mag2', (a,)),
+            ('mag', (a,)),
+            ('dist2', (a, b)),
+            ('dist', (a, b)),
+            ('angle', (a, b)),
+            ('heading', (a,)),
+        ]:
+            assert abs(getattr(vec, name)(*args) - getattr(vec2, name)(*args)) < c.epsilon
+
+
+def test_continuous_collision():
+    level = [
+        (Particle, dict(pos=(0, 0.1), velocity=(c.max_speed, 0), radius=.25, drag_rate=0)),
+        (Particle, dict(pos=(10, 0), velocity=(0, 0), radius=.25, drag_rate=0)),
+    ]
+    for continuous, vectorized in [(False, False), (True, False), (True, True)]:
+        if vectorized:
+            skip_without_numpy()
+        env = Environment(continuous=continuous, vectorized=vectorized)
+        env.load_level(level)
+        bullet, target = env.particles
+        for _ in range(10):
+            env.update(c.physics_tick_ms)
+        if continuous:
+            # The target was hit, and the bullet bounced off it.
+            assert target.velocity[0] > 50
+            assert bullet.pos[0] < target.pos[0]
+        else:
+            # Without continuous collision, the bullet passes right through.
+            assert target.velocity == (0, 0)
+            assert bullet.pos[0] > target.pos[0]
+
+
+def test_continuous_collision_substeps():
+    # A bullet bounces off a bumper early in a tick, and on the way back
+    # would pass through a particle, or a wall, before the tick ends.
+    bullet = (Particle, dict(pos=(0, 0), velocity=(c.max_speed, 0), radius=.1, drag_rate=0))
+    bumper = (Bumper, dict(pos=(.5, 0), radius=.1))
+    target = (Particle, dict(pos=(-.5, 0), radius=.1, drag_rate=0))
+    wall = (Wall, [(-.5, -1), (-.5, 1)])
+    for vectorized in vectorized_modes():
+        env = Environment(vectorized=vectorized, sleeping=False)
+        env.load_level([bullet, bumper, target])
+        particles = env.awake_particles()
+        env.integrate(particles, c.physics_tick_ms / 1000)
+        env.collide_fast_particles(particles, c.physics_tick_ms / 1000)
+        b, _, t = env.particles
+        assert t.velocity[0] < -50
+        assert -.5 < b.pos[0] < .5
+
+        # The wall is hit along the new path, at the start of the next tick.
+        env = Environment(vectorized=vectorized, sleeping=False)
+        env.load_level([bullet, bumper, wall])
+        particles = env.awake_particles()
+        env.integrate(particles, c.physics_tick_ms / 1000)
+        env.collide_fast_particles(particles, c.physics_tick_ms / 1000)
+        env.collide_walls(particles)
+        b = env.particles[0]
+        assert b.velocity[0] > 0
+        assert -.5 < b.pos[0] < .5
+
+
+def test_continuous_collision_wall_endpoint():
+    # A bullet bounces off a bumper, and back onto the end of a Polyline,
+    # which it only bounces off once.
+    level = [
+        (Particle, dict(pos=(0, 0), velocity=(c.max_speed, 0), radius=.1, drag_rate=0)),
+        (Bumper, dict(pos=(.5, 0), radius=.1)),
+        (Polyline, dict(vertices=[(-1.1, -2.01), (-1.1, -.01)])),
+    ]
+    for vectorized in vectorized_modes():
+        env = Environment(vectorized=vectorized, sleeping=False)
+        env.load_level(level)
+        reader = env.events.reader([WALL])
+        for _ in range(5):
+            env.update(c.physics_tick_ms)
+        hit, = reader.read()
+        assert hit.point == (-1.1, -.01)
+        bullet = env.particles[0]
+        assert bullet.velocity[0] > 0 and bullet.velocity[1] > 0
+
+
+def random_level(seed, count=60, size=12):
+    rand = random.Random(seed)
+    level = []
+    for _ in range(count):
+        level.append((Particle, dict(
+            pos=(rand.uniform(-size, size), rand.uniform(-size, size)),
+            velocity=(rand.uniform(-20, 20), rand.uniform(-20, 20)),
+            mass=rand.uniform(.25, 4),
+        )))
+    return level
+
+
+def test_broadphase_matches_brute_force():
+    envs = []
+    for broadphase in ['brute_force', 'grid', 'sweep_and_prune']:
+        env = Environment(broadphase=broadphase)
+        env.load_level(random_level(0))
+        for _ in range(100):
+            env.update(10)
+        envs.append(env)
+
+    reference = envs[0]
+    for other in envs[1:]:
+        for p1, p2 in zip(reference.particles, other.particles):
+            assert p1.pos == p2.pos
+            assert p1.velocity == p2.velocity
+
+
+def test_grid_pair_arrays():
+    skip_without_numpy()
+    np = environment.np
+    grid = make_broadphase('grid')
+    for seed in range(10):
+        rand = random.Random(seed)
+        n = rand.randint(0, 200)
+        positions = [(rand.uniform(-20, 20), rand.uniform(-20, 20)) for _ in range(n)]
+        radii = [rand.uniform(.2, 2) for _ in range(n)]
+        pairs = grid.index_pair_arrays(
+            np.array(positions, dtype=float).reshape((n, 2)),
+            np.array(radii, dtype=float),
+        )
+        assert list(pairs) == grid.index_pairs(positions, radii)
+
+        # Splitting the particles in two, the pairs across the split are the
+        # ones with one particle on each side.
+        split = n // 3
+        positions = np.array(positions, dtype=float).reshape((n, 2))
+        radii = np.array(radii, dtype=float)
+        cross = grid.cross_pair_arrays(
+            positions[split:], radii[split:], positions[:split], radii[:split],
+        )
+        assert sorted((i, j + split) for i, j in cross) == sorted(
+            (j, i) for i, j in pairs if i >= split > j
+        )
+
+
+def test_sweep_and_prune_pairs():
+    env = Environment()
+    env.load_level(random_level(1))
+    sweep = make_broadphase('sweep_and_prune')
+
+    # The persistent endpoint list stays correct as the particles move.
+    for _ in range(20):
+        particles = env.particles
+        expected = set(
+            frozenset([a, b]) for a, b in every_pair(particles)
+            if intersect(a, b)
+        )
+        index_pairs = sweep.index_pairs(
+            [p.pos for p in particles],
+            [p.radius for p in particles],
+        )
+        actual = set(
+            frozenset([particles[i], particles[j]]) for i, j in index_pairs
+            if intersect(particles[i], particles[j])
+        )
+        assert actual == expected
+        env.update(10)
+
+
+def test_wall_index_query():
+    rand = random.Random(2)
+    walls = [
+        Wall(
+            (rand.uniform(-50, 50), rand.uniform(-50, 50)),
+            (rand.uniform(-50, 50), rand.uniform(-50, 50)),
+        )
+        for _ in range(100)
+    ]
+    index = WallIndex(walls)
+    queries = []
+    for _ in range(100):
+        x, y = rand.uniform(-60, 60), rand.uniform(-60, 60)
+        size = rand.uniform(0, 20)
+        bounds = (x, y, x + size, y + size)
+        expected = [
+            w for w in walls
+            if w.bounds[0] <= bounds[2] and bounds[0] <= w.bounds[2]
+            and w.bounds[1] <= bounds[3] and bounds[1] <= w.bounds[3]
+        ]
+        assert index.query(bounds) == expected
+        queries.append((bounds, expected))
+
+    skip_without_numpy()
+    np = environment.np
+    for bounds, expected in queries:
+        _, found = WallArrays(index).query_pairs(
+            np.array([bounds[:2]], dtype=float),
+            np.array([bounds[2:]], dtype=float),
+        )
+        assert [walls[i] for i in found.tolist()] == expected
+
+
+def test_polygon_corners():
+    square = Polygon([(0, 0), (0, 10), (10, 10), (10, 0)])
+    # The corners are shared between segments, and each has one owner.
+    segments = square.segments()
+    assert len(segments) == 4
+    for k, (p1, p2, _, _, _, cap1, cap2) in enumerate(segments):
+        assert p2 is segments[(k + 1) % 4][0]
+        assert cap1 and not cap2
+
+    # A particle coming at a corner from outside bounces off it once.
+    p = Particle(pos=(-0.5, -0.5), velocity=(1, 1), radius=1.0)
+    p.last_pos = (-0.6, -0.6)
+    assert square.collide_wall(p) == 1
+    assert_vectors_equal(p.velocity, vec.mul((-1, -1), c.restitution_wall * p.restitution))
+
+    # Only the cells along the edges hold the square, not its middle.
+    index = WallIndex([square], cell_size=2.0)
+    assert index.query((4, 4, 6, 6)) == []
+    assert index.query((-1, 4, 1, 6)) == [square]
+
+
+def test_vectorized_matches_scalar():
+    skip_without_numpy()
+    level = [o for o in levels.test if issubclass(o[0], Wall)] + random_level(3, size=5)
+    envs = []
+    for vectorized in [False, True]:
+        env = Environment(vectorized=vectorized)
+        env.load_level(level)
+        reader = env.events.reader()
+        places = object_places(env)
+        env.sequence = []
+        for _ in range(200):
+            env.update(10)
+            env.sequence.extend(event_sequence(places, reader.read()))
+        envs.append(env)
+
+    scalar, vectorized = envs
+    for p1, p2 in zip(scalar.particles, vectorized.particles):
+        assert_vectors_equal(p1.pos, p2.pos)
+        assert_vectors_equal(p1.velocity, p2.velocity)
+    assert len(scalar.sequence) == len(vectorized.sequence) > 0
+    for e1, e2 in zip(scalar.sequence, vectorized.sequence):
+        assert e1[:4] == e2[:4]
+        assert abs(e1[4] - e2[4]) < c.epsilon
+        assert_vectors_equal(e1[5], e2[5])
+
+
+def test_coincident_particles():
+    # Particles with their centers on top of each other are pushed apart
+    # along the x axis, the same way by the scalar and vectorized physics.
+    # The immovable bumper is always the one that stays put.
+    others = [
+        (Particle, dict(pos=(2, 3), velocity=(0, 1), mass=2)),
+        (Bumper, dict(pos=(2, 3), restitution=1)),
+    ]
+    results = []
+    for vectorized in vectorized_modes():
+        velocities = []
+        for other in others:
+            env = Environment(vectorized=vectorized, sleeping=False, continuous=False)
+            env.load_level([
+                (Particle, dict(pos=(2, 3), velocity=(-4, 1), restitution=1, drag_rate=0)),
+                other,
+            ])
+            particles = env.awake_particles()
+            env.collide_pairs(particles)
+            velocities.append([p.velocity for p in env.particles])
+        particle, bumper = velocities
+        assert particle[0][0] > 0 > particle[1][0]
+        assert bumper == [(4, 1), (0, 0)]
+        results.append(velocities)
+    assert results[0] == results[1]
+
+
+def test_batch_walls_match_scalar():
+    skip_without_numpy()
+    # Fast particles in a closed ring of walls, with players driving into
+    # them, cover crossing, endpoint caps, sides, and damage.
+    rand = random.Random(4)
+    level = [o for o in levels.test if issubclass(o[0], Wall)]
+    for _ in range(40):
+        level.append((Particle, dict(
+            pos=(rand.uniform(-10, 10), rand.uniform(-6, 6)),
+            velocity=(rand.uniform(-80, 80), rand.uniform(-80, 80)),
+            radius=rand.uniform(.2, 1),
+        )))
+    level.append((Player, dict(pos=(-5, 0), mass=1.0, radius=1.0)))
+    level.append((Player, dict(pos=(5, 0), mass=1.0, radius=1.0, heading=3.0)))
+    envs = []
+    for vectorized in [False, True]:
+        inputs = [
+            headless.ScriptedInput(batch.random_script(random.Random(i), 300))
+            for i in range(2)
+        ]
+        env = Environment(inputs, vectorized=vectorized, sleeping=False)
+        env.load_level(level)
+        reader = env.events.reader()
+        places = object_places(env)
+        env.sequence = []
+        for tick in range(300):
+            for inp in inputs:
+                inp.update(tick)
+            env.update(c.physics_tick_ms)
+            env.sequence.extend(event_sequence(places, reader.read()))
+        assert reader.dropped == 0
+        envs.append(env)
+
+    scalar, vectorized = envs
+    for p1, p2 in zip(scalar.particles, vectorized.particles):
+        assert p1.pos == p2.pos
+        assert p1.velocity == p2.velocity
+    for p1, p2 in zip(scalar.players, vectorized.players):
+        assert p1.damage > 0
+        assert p1.damage == p2.damage
+    assert scalar.events.kind_counts == vectorized.events.kind_counts
+    assert scalar.sequence == vectorized.sequence
+
+
+def object_places(env):
+    """Number the particles and walls of env, to compare events by."""
+    places = {None: None}
+    for n, o in enumerate(env.particles):
+        places[o] = ('particle', n)
+    for n, o in enumerate(env.walls):
+        places[o] = ('wall', n)
+    return places
+
+
+def event_sequence(places, events):
+    """Events with their objects replaced by their places."""
+    return [
+        (e.kind, e.tick, places[e.first], places[e.second], e.impulse, e.point)
+        for e in events
+    ]
+
+
+def test_batch_walls_cases_match_scalar():
+    skip_without_numpy()
+    # Each way of hitting a wall, or not, as (last_pos, pos, velocity, radius,
+    # hit), for a vertical and a slanted wall. The endpoints bounce particles
+    # whichever way they are moving, but the side only bounces those headed
+    # toward it.
+    cases = [
+        ((-1, 0.5), (1, 0.3), (20, -2), 0.25, True), # Crossing.
+        ((0.3, -2.5), (0.3, -2.5), (0, 1), 0.8, True), # First endpoint.
+        ((0.3, -2.5), (0.3, -2.5), (0, -1), 0.8, True),
+        ((0.3, 2.5), (0.3, 2.5), (0, -1), 0.8, True), # Second endpoint.
+        ((0.6, 0), (0.6, 0), (-1, 0), 1.0, True), # Side.
+        ((0.6, 0), (0.6, 0), (1, 0), 1.0, False),
+    ]
+    for wall in [((0, -2), (0, 2)), ((0, -2), (0.5, 2))]:
+        for last_pos, pos, velocity, radius, hit in cases:
+            results = []
+            for vectorized in [False, True]:
+                env = Environment(vectorized=vectorized, sleeping=False)
+                env.load_level([
+                    (Wall, wall),
+                    (Particle, dict(pos=pos, velocity=velocity, radius=radius)),
+                ])
+                particles = env.awake_particles()
+                p, = particles
+                p.last_pos = last_pos
+                env.collide_walls(particles)
+                results.append((p.pos, p.velocity))
+            assert results[0] == results[1], (wall, last_pos, results)
+            assert (results[0][1] != velocity) == hit, (wall, last_pos, results)
+
+
+# A player with little health drives into a wall and dies, while two
+# particles collide off to the side.
+event_level = [
+    (Wall, dict(p1=(3, -2), p2=(3, 2))),
+    (Player, dict(pos=(0, 0), velocity=(40, 0), mass=1.0, radius=1.0, player_health=10.0)),
+    (Particle, dict(pos=(0, 10), velocity=(10, 0), radius=1.0, drag_rate=0)),
+    (Particle, dict(pos=(4, 10), velocity=(-10, 0), radius=1.0, drag_rate=0)),
+]
+
+
+def test_event_stream():
+    level = event_level
+    for vectorized in vectorized_modes():
+        env = Environment([headless.ScriptedInput([])], vectorized=vectorized)
+        env.load_level(level)
+        wall, player, p1, p2 = env.objects
+        reader = env.events.reader()
+        for _ in range(60):
+            env.update(c.physics_tick_ms)
+        events = reader.read()
+        assert reader.dropped == 0
+        assert sorted(e.kind for e in events) == [COLLISION, WALL, DAMAGE, DEATH]
+        by_kind = dict((e.kind, e) for e in events)
+
+        collision = by_kind[COLLISION]
+        assert set([collision.first, collision.second]) == set([p1, p2])
+        assert_vectors_equal(collision.point, (2, 10))
+        assert collision.impulse > 0
+
+        hit = by_kind[WALL]
+        assert (hit.first, hit.second) == (player, wall)
+        assert abs(hit.point[0] - 3) < c.epsilon
+        damage = by_kind[DAMAGE]
+        assert damage.first is player
+        assert abs(damage.impulse - hit.impulse) < c.epsilon
+        assert abs(damage.impulse - player.damage) < c.epsilon
+
+        death = by_kind[DEATH]
+        assert death.first is player
+        assert player.dead
+        assert death.tick == player.death_tick == damage.tick
+
+
+def test_zero_radius_collision_event():
+    # Points on top of each other collide at their shared center.
+    level = [
+        (Particle, dict(pos=(1, 2), velocity=(-3, 0), radius=0)),
+        (Particle, dict(pos=(1, 2), velocity=(3, 0), radius=0)),
+    ]
+    for vectorized in vectorized_modes():
+        env = Environment(vectorized=vectorized, sleeping=False, continuous=False)
+        env.load_level(level)
+        reader = env.events.reader()
+        env.collide_pairs(env.awake_particles())
+        event, = reader.read()
+        assert event.kind == COLLISION
+        assert event.point == (1, 2)
+
+
+def test_event_ring_buffer():
+    # Keeping a single tick lets the buffer wrap within a few ticks.
+    bus = EventBus(capacity=4, ticks_kept=1)
+    reader = bus.reader()
+    walls = bus.reader([WALL])
+    collisions = bus.reader([COLLISION])
+    deaths = bus.reader([DEATH])
+    bus.emit(COLLISION, 'a', 'b', 1.0, (0, 0))
+    bus.emit(WALL, 'c', 'w', 2.0, (1, 0))
+    assert [e.first for e in reader.read()] == ['a', 'c']
+    bus.tick = 1
+    bus.emit_many(WALL, ['d', 'e', 'f'], ['w'] * 3, [3.0, 4.0, 5.0], [0, 1, 2], [3, 4, 5])
+    bus.emit(DAMAGE, 'f', None, 5.0, (2, 5))
+    # The buffer wrapped around, writing over the first two events.
+    assert bus.capacity == 4
+    events = reader.read()
+    assert [e.first for e in events] == ['d', 'e', 'f', 'f']
+    assert events[1] == (WALL, 1, 'e', 'w', 4.0, (1, 4))
+    assert reader.dropped == 0
+    # Readers only count the missed events of their own kinds.
+    assert [e.first for e in walls.read()] == ['d', 'e', 'f']
+    assert walls.dropped == 1
+    assert collisions.read() == []
+    assert collisions.dropped == 1
+    assert deaths.read() == []
+    assert deaths.dropped == 0
+
+    # A busier tick makes the buffer grow instead of wrapping.
+    bus.tick = 2
+    bus.emit(DAMAGE, 'g', None, 1.0, (0, 0))
+    bus.emit_many(COLLISION, list('hijklm'), list('nopqrs'), [0.0] * 6, [0] * 6, [0] * 6)
+    assert bus.capacity == 8
+    assert [e.first for e in reader.read()] == list('ghijklm')
+    assert reader.dropped == 0
+    assert [e.first for e in collisions.read()] == list('hijklm')
+    assert collisions.dropped == 1
+    assert bus.count == 13
+    assert bus.kind_counts == [7, 4, 2, 0]
+
+
+def test_event_buffer_keeps_ticks():
+    bus = EventBus(capacity=16, ticks_kept=4)
+    reader = bus.reader()
+    for tick in range(3):
+        bus.tick = tick
+        for n in range(10):
+            bus.emit(COLLISION, (tick, n), None)
+    # Each tick needs 10 slots, so 4 of them need 40, and the buffer grew.
+    assert bus.capacity == 64
+    assert [e.first for e in reader.read()] == [
+        (tick, n) for tick in range(3) for n in range(10)
+    ]
+    assert reader.dropped == 0
+
+
+def test_events_after_rollback():
+    env = Environment([headless.ScriptedInput([])])
+    env.load_level(event_level)
+    reader = env.events.reader()
+    for _ in range(20):
+        env.update(c.physics_tick_ms)
+    expected = [(e.kind, e.tick, e.impulse) for e in reader.read()]
+    assert len(expected) == 4
+
+    # Going back before the events and simulating the same ticks again
+    # emits each event once.
+    env = Environment([headless.ScriptedInput([])])
+    env.load_level(event_level)
+    reader = env.events.reader()
+    confirmed = env.events.reader()
+    deaths = env.events.reader([DEATH])
+    for _ in range(2):
+        env.update(c.physics_tick_ms)
+    snapshot = env.snapshot()
+    for _ in range(18):
+        env.update(c.physics_tick_ms)
+        assert confirmed.read(before=2) == []
+    assert len(deaths.read()) == 1
+    env.restore(snapshot)
+    assert deaths.read() == []
+    for _ in range(18):
+        env.update(c.physics_tick_ms)
+    assert [(e.kind, e.tick, e.impulse) for e in reader.read()] == expected
+    assert [(e.kind, e.tick, e.impulse) for e in confirmed.read(before=20)] == expected
+    assert reader.dropped == confirmed.dropped == 0
+    assert env.events.kind_counts == [1, 1, 1, 1]
+    # A reader that read the events that were taken back sees them again.
+    assert len(deaths.read()) == 1
+    assert deaths.read() == []
+
+
+def test_sleeping_islands():
+    # A resting pile of touching particles, and one that slowly drifts into
+    # it, arriving after the pile has fallen asleep.
+    level = [
+        (Particle, dict(pos=(0, 0))),
+        (Particle, dict(pos=(1.9, 0))),
+        (Particle, dict(pos=(10, 0))),
+        (Particle, dict(pos=(-10, 0), velocity=(-5, 0), drag_rate=0)),
+    ]
+    for vectorized in vectorized_modes():
+        envs = []
+        for sleeping in [False, True]:
+            env = Environment(vectorized=vectorized, sleeping=sleeping)
+            env.load_level(level)
+            envs.append(env)
+        awake_env, env = envs
+        first, second, loner, drifter = env.particles
+
+        for _ in range(60):
+            env.update(c.physics_tick_ms)
+            awake_env.update(c.physics_tick_ms)
+        assert first.sleeping and second.sleeping and loner.sleeping
+        assert first.island == second.island != loner.island
+        assert env.sleep_tracker.awake == [drifter]
+
+        # Send the drifter back into the pile, which wakes up as a whole.
+        for e in envs:
+            e.particles[3].velocity = (5, 0)
+        while not drifter.pos[0] > -2:
+            env.update(c.physics_tick_ms)
+            awake_env.update(c.physics_tick_ms)
+        env.update(c.physics_tick_ms)
+        awake_env.update(c.physics_tick_ms)
+        assert not first.sleeping and not second.sleeping
+        assert loner.sleeping
+        for p1, p2 in zip(awake_env.particles, env.particles):
+            assert p1.pos == p2.pos
+            assert p1.velocity == p2.velocity
+
+
+def test_sleeping_vectorized_matches_scalar():
+    skip_without_numpy()
+    envs = []
+    for vectorized in [False, True]:
+        env = Environment(vectorized=vectorized)
+        env.load_level(benchmark.generated_level(100))
+        env.reader = env.events.reader()
+        env.places = object_places(env)
+        env.sequence = []
+        envs.append(env)
+    for _ in range(600):
+        for env in envs:
+            env.update(c.physics_tick_ms)
+            env.sequence.extend(event_sequence(env.places, env.reader.read()))
+    scalar, vectorized = envs
+    assert scalar.sequence == vectorized.sequence
+    assert any(p.sleeping for p in scalar.particles)
+    for p1, p2 in zip(scalar.particles, vectorized.particles):
+        assert p1.sleeping == bool(p2.sleeping)
+        assert p1.island == p2.island
+        assert p1.idle_time == p2.idle_time
+        assert p1.pos == p2.pos
+
+
+def test_benchmark_tick_phases():
+    env = Environment()
+    env.load_level(benchmark.generated_level(100))
+    assert len(env.particles) == 102
+    times = benchmark.time_ticks(env, 3)
+    assert env.tick == 3
+    # The profiler is only set while timing.
+    assert env.profiler is None
+    phases = Profiler.phases + ['other']
+    assert abs(sum(times[phase] for phase in phases) - times['total']) < 1e-9
+
+
+def test_profiler_counts():
+    env = Environment(profiler=Profiler(window=10))
+    env.load_level([o for o in levels.test if issubclass(o[0], Wall)] + random_level(4, size=5))
+    for _ in range(25):
+        env.update(10)
+    profiler = env.profiler
+    assert profiler.ticks == 25
+    assert profiler.recent is not None
+    assert 0 < profiler.counts['contacts'] <= profiler.counts['pairs_tested']
+    assert 0 < profiler.counts['wall_hits'] <= profiler.counts['wall_tests']
+    averages = profiler.averages()
+    assert averages['total'] > 0
+    assert len(profiler.report()) == len(Profiler.phases) + 3
+
+
+def test_chunk_streaming():
+    world = worldgen.World(seed=1, size=8)
+    assert world.chunk_level((2, 5)) == world.chunk_level((2, 5))
+
+    env = Environment()
+    env.load_level([(Player, dict(pos=(20, 20), mass=1.0, radius=1.0))])
+    player = env.players[0]
+    streamer = worldgen.ChunkStreamer(env, world, radius=0)
+    assert streamer.active == set([(4, 4)])
+    assert len(streamer.wall_chunks) == 9
+    home = streamer.chunks[(4, 4)]
+    assert len(env.particles) == 1 + len(home.particles)
+
+    # Disturb a particle, and leave. Its chunk is frozen, but kept.
+    moved = home.particles[0]
+    moved.velocity = (1, 0)
+    player.pos = (-150, -150)
+    streamer.refresh()
+    assert streamer.active == set([(0, 0)])
+    assert moved not in env.particles
+    assert (4, 4) in streamer.chunks
+    # Untouched chunks are thrown away.
+    assert (4, 3) not in streamer.chunks
+
+    # Coming back brings the same particle back.
+    player.pos = (20, 20)
+    streamer.refresh()
+    assert moved in env.particles
+    assert moved.velocity == (1, 0)
+
+
+def test_level_file():
+    level = levels.test + [
+        (Bumper, dict(pos=(-8, 4), radius=2)),
+        (Polyline, [[(-20, -20), (0, -25), (20, -20)]]),
+    ]
+    fd, path = tempfile.mkstemp(suffix='.level')
+    os.close(fd)
+    try:
+        levelfile.save(path, levelfile.make_objects(level))
+        # The arrays are little-endian on any machine. The first value is the
+        # kind of the first particle.
+        with open(path, 'rb') as f:
+            data = f.read()
+        first = levelfile.PARTICLE_KINDS.index(level[0][0])
+        assert struct.unpack_from('<d', data, levelfile.HEADER.size) == (first,)
+        for vectorized in vectorized_modes():
+            envs = []
+            for load in ['load_level', 'load_level_file']:
+                env = Environment(
+                    [headless.ScriptedInput(thrust=True, brake=False, turn_direction=1)],
+                    vectorized=vectorized,
+                )
+                getattr(env, load)(path if load == 'load_level_file' else level)
+                envs.append(env)
+
+            from_list, from_file = envs
+            assert [type(p) for p in from_file.particles] == [type(p) for p in from_list.particles]
+            assert from_file.wall_index.cells == from_list.wall_index.cells
+            for w1, w2 in zip(from_list.walls, from_file.walls):
+                assert type(w1) is type(w2)
+                assert w1.segments() == w2.segments()
+            for _ in range(100):
+                for env in envs:
+                    env.update(10)
+            for p1, p2 in zip(from_list.particles, from_file.particles):
+                assert tuple(p1.pos) == tuple(p2.pos)
+                assert tuple(p1.velocity) == tuple(p2.velocity)
+    finally:
+        os.remove(path)
+
+
+def test_camera_fits_targets():
+    camera = Camera((800, 600), margin=5)
+    targets = [(10, 20), (50, 0)]
+    camera.follow(targets, smoothing=1)
+    assert camera.center == (30, 10)
+    assert camera.to_screen((30, 10)) == (400, 300)
+    x1, y1, x2, y2 = camera.view_bounds()
+    for x, y in targets:
+        assert x1 + 5 <= x <= x2 - 5 and y1 + 5 <= y <= y2 - 5
+
+    # Zooming in is limited, and the view settles on its target.
+    camera.follow([(0, 0)])
+    for _ in range(200):
+        view = camera.view
+        camera.follow([(0, 0)])
+    assert camera.view == view == (camera.max_pixels_per_unit, (0, 0))
+
+
+class CountingDisplay(display.Display):
+    background_draws = 0
+
+    def draw_background(self):
+        self.background_draws += 1
+        display.Display.draw_background(self)
+
+
+class CountingHealthWidget(display.HealthWidget):
+    bar_draws = 0
+
+    def draw_bars(self):
+        self.bar_draws += 1
+        display.HealthWidget.draw_bars(self)
+
+
+class CountingFont(object):
+    def __init__(self, font):
+        self.font = font
+        self.renders = 0
+
+    def render(self, *args):
+        self.renders += 1
+        return self.font.render(*args)
+
+
+def make_display(env):
+    pg.init()
+    return CountingDisplay(env, (400, 300))
+
+
+def test_display_background_cache():
+    env = Environment([headless.ScriptedInput(), headless.ScriptedInput()])
+    env.load_level(levels.versus)
+    disp = make_display(env)
+    for _ in range(100):
+        env.update(c.physics_tick_ms)
+        disp.draw()
+    # The players stand still, so once the camera has settled, the background
+    # is not drawn again.
+    draws = disp.background_draws
+    for _ in range(10):
+        env.update(c.physics_tick_ms)
+        disp.draw()
+    assert disp.background_draws == draws
+
+
+def test_camera_pans_reuse_background():
+    env = Environment([
+        headless.ScriptedInput(thrust=True, brake=False, turn_direction=1),
+        headless.ScriptedInput(thrust=True, brake=False, turn_direction=-1),
+    ])
+    env.load_level(levels.versus)
+    disp = make_display(env)
+    # Only pan, without zooming.
+    disp.camera.min_pixels_per_unit = disp.camera.max_pixels_per_unit
+    views = set()
+    for _ in range(60):
+        env.update(c.physics_tick_ms)
+        disp.draw()
+        views.add(disp.camera.view)
+    assert len(views) > 10
+    assert disp.background_draws == 1
+
+    # The shifted background is the same as a freshly drawn one.
+    frame = pg.image.tostring(disp.screen, 'RGB')
+    disp.background_view = None
+    disp.camera.smoothing = 0
+    disp.draw()
+    assert disp.background_draws == 2
+    assert pg.image.tostring(disp.screen, 'RGB') == frame
+
+
+def test_text_cache():
+    pg.font.init()
+    font = CountingFont(pg.font.Font(None, 20))
+    cache = display.TextCache(font, (255, 255, 255))
+    surface = cache.render('1 fps')
+    assert cache.render('1 fps') is surface
+    assert font.renders == 1
+    cache.render('2 fps')
+    assert font.renders == 2
+
+    # The cache doesn't grow without bound.
+    cache.max_size = 4
+    for n in range(10):
+        cache.render('{} fps'.format(n))
+    assert len(cache.surfaces) <= 4
+
+
+def test_info_widget_renders_changed_lines():
+    env = Environment([headless.ScriptedInput(), headless.ScriptedInput()])
+    env.load_level(levels.versus)
+    disp = make_display(env)
+    widget = [w for w in disp.widgets if isinstance(w, display.InfoWidget)][0]
+    font = widget.text_cache.font = CountingFont(widget.font)
+    lines = len(widget.text())
+    for _ in range(5):
+        disp.draw()
+    assert font.renders == lines
+    # Only the line that changed is rendered again.
+    disp.set_fps(60)
+    disp.draw()
+    disp.draw()
+    assert font.renders == lines + 1
+
+
+def test_health_bars_redraw_on_damage():
+    env = Environment([headless.ScriptedInput(), headless.ScriptedInput()])
+    env.load_level(levels.versus)
+    disp = make_display(env)
+    widget = CountingHealthWidget(disp, env.players)
+    for _ in range(3):
+        widget.draw(disp.screen)
+    assert widget.bar_draws == 1
+    before = pg.image.tostring(widget.surface, 'RGBA')
+    env.players[0].damage += 10
+    widget.draw(disp.screen)
+    widget.draw(disp.screen)
+    assert widget.bar_draws == 2
+    # The bars show the new damage.
+    assert pg.image.tostring(widget.surface, 'RGBA') != before
+
+
+def test_render_state_interpolates():
+    env = Environment([headless.ScriptedInput()])
+    env.load_level([
+        (Particle, dict(pos=(0, 0), velocity=(10, 0), mass=1.0, radius=1.0)),
+        (Player, dict(pos=(5, 5), mass=1.0, radius=1.0)),
+    ])
+    physics = PhysicsThread(env)
+    render_state = RenderState(physics)
+    keyboard = headless.ScriptedInput(thrust=True, brake=False, turn_direction=1)
+    physics.set_inputs([keyboard])
+    physics.start()
+    deadline = time.time() + 10
+    while physics.latest()[1].tick < 3:
+        assert time.time() < deadline
+        time.sleep(0.001)
+    physics.stop()
+    physics.latest()
+
+    # The inputs were handed over between ticks.
+    assert env.inputs[0].thrust and env.inputs[0].turn_direction == 1
+
+    previous, current = physics.latest()
+    assert current.tick == previous.tick + 1
+    particle = env.particles[0]
+    assert current.particles[0][2] == particle.pos
+    old_x = previous.particles[0][2][0]
+    new_x = current.particles[0][2][0]
+    # Drawing lags one tick behind, so halfway between the snapshots is half
+    # a tick after the older one was due.
+    tick_seconds = physics.tick_seconds
+    render_state.update(now=previous.time + 1.5 * tick_seconds)
+    (drawn,) = [o for o in render_state.objects if o.graphics_type == 'particle']
+    assert abs(drawn.pos[0] - (old_x + new_x) / 2) < 1e-9
+    render_state.update(now=current.time + 5 * tick_seconds)
+    assert drawn.pos == particle.pos
+    assert render_state.players[0].number == 0
+
+
+def test_physics_thread_errors():
+    # The player has no input, so the first tick fails.
+    env = Environment()
+    env.load_level([(Player, dict(pos=(0, 0)))])
+    physics = PhysicsThread(env)
+    physics.start()
+    physics.join(10)
+    try:
+        physics.latest()
+    except AttributeError:
+        pass
+    else:
+        assert False, 'the error was not raised'
+
+
+def test_tick_scheduler_degrades():
+    # A fake clock, where every tick takes cost milliseconds, and a frame is
+    # drawn every 10 milliseconds, unless the ticks ran late.
+    now = [0.0]
+    cost = [2.0]
+    def step():
+        now[0] += cost[0]
+    def frames(count):
+        for _ in range(count):
+            now[0] = max(now[0], (now[0] // 10 + 1) * 10)
+            yield scheduler.run(step)
+    env = Environment()
+    scheduler = TickScheduler(
+        10,
+        max_steps=3,
+        frame_budget_ms=50,
+        env=env,
+        clock=lambda: now[0],
+    )
+    scheduler.start()
+
+    # Keeping up, one tick per frame.
+    assert list(frames(20)) == [1] * 20
+    assert not scheduler.behind and not scheduler.reduced
+
+    # Ticks slower than real time: never more than the budget before drawing,
+    # the rest is dropped, and fidelity is reduced.
+    cost[0] = 30.0
+    assert all(1 <= ran <= 2 for ran in frames(20))
+    assert scheduler.behind and scheduler.times_behind == 1
+    assert scheduler.dropped_ms > 0
+    assert scheduler.reduced and not env.continuous
+
+    # Once the ticks are fast again, it catches up and restores fidelity.
+    cost[0] = 1.0
+    list(frames(50))
+    assert not scheduler.behind and not scheduler.reduced
+    assert env.continuous
+
+
+def test_headless_scripted_boost():
+    # Charge a boost by braking at rest, then release it.
+    inp = headless.ScriptedInput([
+        (0, dict(brake=True)),
+        (60, dict(brake=False)),
+    ])
+    result = headless.run(
+        [(Player, dict(pos=(0, 0), velocity=(0, 0), mass=1.0, radius=1.0))],
+        [inp],
+        ticks=62,
+    )
+    assert result.ticks == 62
+    player = result.env.players[0]
+    assert player.boost_time_remaining > 0
+    assert player.speed > 5
+
+
+def test_batch_match_is_deterministic():
+    match = batch.Match('versus', seed=1, ticks=600, constants=dict(
+        player_boost_strength=2000.0,
+    ))
+    outcome = batch.run_match(match)
+    assert outcome == batch.run_match(match)
+    assert outcome.ticks <= 600
+    # The overrides only last for the match.
+    assert c.player_boost_strength == 1600.0
+
+
+def test_constant_overrides_take_effect():
+    # Defaults are looked up when the objects are made, so overriding the
+    # constants for a match applies to the objects of its level.
+    overrides = dict(restitution_particle=0.5, restitution_wall=0.25, drag_rate=0.0)
+    saved = dict((name, getattr(c, name)) for name in overrides)
+    try:
+        for name, value in overrides.items():
+            setattr(c, name, value)
+        env = Environment()
+        env.load_level(levels.test)
+    finally:
+        for name, value in saved.items():
+            setattr(c, name, value)
+    assert all(p.restitution == 0.5 for p in env.particles)
+    assert all(w.restitution == 0.25 for w in env.walls)
+    assert all(p.drag_rate == 0.0 for p in env.particles)
+
+    assert batch.parse_override('restitution_wall=1') == ('restitution_wall', 1.0)
+    for text in [
+        'restitution_bumper=3', 'player_turn_rate=1', 'player_thrust_curve=1',
+        'nonsense=1',
+    ]:
+        try:
+            batch.parse_override(text)
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False, text
+
+
+def test_replay_playback():
+    rand = random.Random(4)
+    inputs = [
+        headless.ScriptedInput(batch.random_script(rand, 1000)),
+        headless.ScriptedInput(batch.random_script(rand, 1000)),
+    ]
+    env = Environment(inputs)
+    env.load_level(levels.versus)
+    env.recorder = replay.ReplayRecorder('versus', inputs, env.options)
+    for tick in range(1000):
+        for inp in inputs:
+            inp.update(tick)
+        env.update(c.physics_tick_ms)
+
+    recording = env.recorder.replay
+    player = replay.ReplayPlayer(recording, keyframe_interval=300)
+    player.seek(recording.num_ticks)
+    assert [p.pos for p in player.env.objects if hasattr(p, 'pos')] == [
+        p.pos for p in env.objects if hasattr(p, 'pos')
+    ]
+
+    # Seeking back to a tick gives the same state as playing up to it.
+    player.seek(500)
+    state = [p.velocity for p in player.env.particles]
+    player.seek(900)
+    player.seek(500)
+    assert [p.velocity for p in player.env.particles] == state
+
+
+def test_replay_environment_options():
+    # A match recorded with options other than the defaults plays back the
+    # same from a file, with the options it was recorded with.
+    options = dict(
+        broadphase='sweep_and_prune',
+        vectorized=environment.np is not None,
+        continuous=False,
+        sleeping=False,
+    )
+    rand = random.Random(5)
+    inputs = [
+        headless.ScriptedInput(batch.random_script(rand, 600)),
+        headless.ScriptedInput(batch.random_script(rand, 600)),
+    ]
+    env = Environment(inputs, **options)
+    env.load_level(levels.versus)
+    env.recorder = replay.ReplayRecorder('versus', inputs, env.options)
+    for tick in range(600):
+        for inp in inputs:
+            inp.update(tick)
+        env.update(c.physics_tick_ms)
+
+    fd, path = tempfile.mkstemp(suffix='.replay')
+    os.close(fd)
+    try:
+        env.recorder.replay.save(path)
+        recording = replay.Replay.load(path)
+    finally:
+        os.remove(path)
+    assert recording.options == options
+    player = replay.ReplayPlayer(recording)
+    assert player.env.options == options
+    player.seek(recording.num_ticks)
+    for p1, p2 in zip(env.particles, player.env.particles):
+        assert p1.pos == p2.pos
+        assert p1.velocity == p2.velocity
+
+
+def test_snapshot_restore():
+    for vectorized in vectorized_modes():
+        rand = random.Random(6)
+        scripts = [batch.random_script(rand, 3000) for _ in range(2)]
+        inputs = [headless.ScriptedInput(script) for script in scripts]
+        env = Environment(inputs, vectorized=vectorized)
+        env.load_level(levels.versus)
+
+        def run(ticks):
+            for _ in range(ticks):
+                for inp in inputs:
+                    inp.update(env.tick)
+                env.update(c.physics_tick_ms)
+
+        run(100)
+        snapshot = env.snapshot()
+        # Play until a player dies, then rewind to before the death.
+        run(2900)
+        assert any(p.dead for p in env.players)
+        final = env.snapshot()
+
+        env.restore(snapshot)
+        assert env.tick == 100
+        assert not any(p.dead for p in env.players)
+        assert env.snapshot() == snapshot
+        for inp, script in zip(inputs, scripts):
+            inp.script = script
+            inp.position = 0
+        run(2900)
+        assert env.snapshot() == final
+
+
+def test_peer_address():
+    assert netplay.peer_address('localhost:5000') == ('localhost', 5000)
+    assert netplay.peer_address('::1:5000') == ('::1', 5000)
+    for text in ['localhost', 'localhost:', ':5000', 'localhost:port']:
+        try:
+            netplay.peer_address(text)
+        except argparse.ArgumentTypeError:
+            pass
+        else:
+            assert False, text
+
+
+def test_netplay_matches_local_simulation():
+    ticks = 300
+    rand = random.Random(7)
+    scripts = [batch.random_script(rand, ticks) for _ in range(2)]
+
+    sockets = [netplay.make_socket(0), netplay.make_socket(0)]
+    addresses = [s.getsockname() for s in sockets]
+    sessions = []
+    for number in range(2):
+        sessions.append(netplay.NetSession(
+            netplay.make_environment(levels.versus),
+            number,
+            headless.ScriptedInput(scripts[number]),
+            netplay.LossySocket(
+                sockets[number],
+                latency=0.002,
+                jitter=0.002,
+                loss=0.2,
+                rand=random.Random(number),
+            ),
+            addresses[1 - number],
+        ))
+    try:
+        while not all(s.finished(ticks) for s in sessions):
+            for s in sessions:
+                if s.env.tick < ticks:
+                    s.local_input.update(s.env.tick + s.input_delay)
+                    s.advance()
+                else:
+                    s.send()
+                    s.receive()
+    finally:
+        for sock in sockets:
+            sock.close()
+
+    # Both peers agree with a local simulation of the same inputs, which only
+    # start after the input delay.
+    inputs = [headless.ScriptedInput(script) for script in scripts]
+    env = Environment(inputs)
+    env.load_level(levels.versus)
+    for tick in range(ticks):
+        if tick >= sessions[0].input_delay:
+            for inp in inputs:
+                inp.update(tick)
+        env.update(c.physics_tick_ms)
+    for s in sessions:
+        assert s.env.snapshot() == env.snapshot()
+
+
 if __name__ == '__main__':
-    for value in globals().values():
+    for value in list(globals().values()):
         if hasattr(value, '__call__') and value.__name__.startswith('test_'):
             print(value.__name__)
             try:
                 value()
+            except SkipTest as e:
+                print('SKIP: {}'.format(e))
             except AssertionError:
                 print('FAIL')
                 traceback.print_exc()
@@ -0,0 +1,109 @@
+"""A fast two-dimensional version of the vec module.
+
+The functions here give the same results as the ones in vec, but only work on
+two-dimensional vectors, so they can use fixed-arity tuple math instead of
+iterating over the dimensions.
+"""
+from __future__ import division
+
+__all__ = ['add', 'sub', 'vfrom', 'dot', 'mul', 'div', 'neg', 'mag2', 'mag',
+           'dist2', 'dist', 'norm', 'avg', 'angle', 'rotate', 'perp', 'proj',
+           'heading']
+
+from math import sqrt, acos, sin, cos, atan2
+
+def add(v1, v2):
+    """Calculate the vector addition of two vectors."""
+    return (v1[0] + v2[0], v1[1] + v2[1])
+
+def sub(v1, v2):
+    """Subtract one vector from another"""
+    return (v1[0] - v2[0], v1[1] - v2[1])
+
+def vfrom(p1, p2):
+    """Return the vector from p1 to p2."""
+    return (p2[0] - p1[0], p2[1] - p1[1])
+
+def dot(v1, v2):
+    """Calculate the dot product of two vectors."""
+    return v1[0] * v2[0] + v1[1] * v2[1]
+
+def mul(v, c):
+    """Multiply a vector by a scalar."""
+    return (v[0] * c, v[1] * c)
+
+def div(v, c):
+    """Divide a vector by a scalar."""
+    return (v[0] / c, v[1] / c)
+
+def neg(v):
+    """Invert a vector."""
+    return (-v[0], -v[1])
+
+def mag2(v):
+    """Calculate the squared magnitude of a vector."""
+    x, y = v
+    return x * x + y * y
+
+def mag(v):
+    """Calculate the magnitude of a vector."""
+    x, y = v
+    return sqrt(x * x + y * y)
+
+def dist2(p1, p2):
+    """Find the squared distance between two points."""
+    x = p2[0] - p1[0]
+    y = p2[1] - p1[1]
+    return x * x + y * y
+
+def dist(p1, p2):
+    """Find the distance between two points."""
+    return sqrt(dist2(p1, p2))
+
+def norm(v, c=1):
+    """Return a vector in the same direction as v, with magnitude c."""
+    x, y = v
+    c = c / sqrt(x * x + y * y)
+    return (x * c, y * c)
+
+def avg(*args):
+    """Find the vector average of two or more points."""
+    n = len(args)
+    return (
+        sum(p[0] for p in args) / n,
+        sum(p[1] for p in args) / n,
+    )
+
+def angle(v1, v2):
+    """Find the angle in radians between two vectors."""
+    return acos(dot(v1, v2) / (mag(v1) * mag(v2)))
+
+def rotate(v, theta):
+    """Rotate a vector counter-clockwise by the given angle."""
+    x, y = v
+    sin_a = sin(theta)
+    cos_a = cos(theta)
+    return (
+        x * cos_a - y * sin_a,
+        x * sin_a + y * cos_a,
+    )
+
+def perp(v):
+    """Return a perpendicular to a vector."""
+    x, y = v
+    return (y, -x)
+
+def proj(v1, v2):
+    """Calculate the vector projection of v1 onto v2."""
+    x, y = v2
+    c = (v1[0] * x + v1[1] * y) / (x * x + y * y)
+    return (x * c, y * c)
+
+def heading(v):
+    """
+    Return the heading angle of the vector v.
+
+    This is equivalent to the theta value of v in polar coordinates.
+    """
+    x, y = v
+    return atan2(y, x)
@@ -1,64 +1,692 @@
 from __future__ import division
 
-import vec
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from events import WALL, DAMAGE
+import vec2 as vec
 import constants as c
 
 class Wall(object):
     graphics_type = 'wall'
 
-    def __init__(self, p1, p2, restitution=c.restitution_wall):
+    def __init__(self, p1, p2, restitution=None):
+        if restitution is None:
+            restitution = c.restitution_wall
         self.p1 = p1
         self.p2 = p2
         self.restitution = restitution
         self.tangent = vec.vfrom(self.p1, self.p2)
         self.normal = vec.perp(self.tangent)
+        (x1, y1), (x2, y2) = self.p1, self.p2
+        self.bounds = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+    @classmethod
+    def from_geometry(cls, p1, p2, restitution, tangent, normal, bounds):
+        """Make a wall with precomputed geometry, such as from a level file."""
+        wall = cls.__new__(cls)
+        wall.p1 = p1
+        wall.p2 = p2
+        wall.restitution = restitution
+        wall.tangent = tangent
+        wall.normal = normal
+        wall.bounds = bounds
+        return wall
 
     def update(self, elapsedticks):
         pass
 
-    def collide_wall(self, p):
-        restitution = self.restitution * p.restitution
-
-        # First, check that we haven't crossed through the wall due to
-        # extreme speed and low framerate.
-        intersection = intersect_segments(self.p1, self.p2, p.last_pos, p.pos)
-        if intersection:
-            p.pos = p.last_pos
-            p.rebound(self.normal, intersection, restitution)
-            return
-
-        # Find vectors to each endpoint of the segment.
-        v1 = vec.vfrom(self.p1, p.pos)
-        v2 = vec.vfrom(self.p2, p.pos)
-
-        # Find a perpendicular vector from the wall to p.
-        v_dist = vec.proj(v1, self.normal)
-
-        # Test distance from the wall.
-        radius2 = p.radius**2
-        if vec.mag2(v_dist) > radius2:
-            return
-
-        # Test for collision with the endpoints of the segment.
-        # Check whether p is too far off the end of the segment, by checking
-        # the sign of the vector projection, then a radius check for the
-        # distance from the endpoint.
-        if vec.dot(v1, self.tangent) < 0:
-            if vec.mag2(v1) <= radius2:
-                p.rebound(v1, self.p1, restitution)
-            return
-        if vec.dot(v2, self.tangent) > 0:
-            if vec.mag2(v2) <= radius2:
-                p.rebound(v2, self.p2, restitution)
-            return
-
-        # Test that p is headed toward the wall.
-        if vec.dot(p.velocity, v_dist) >= c.epsilon:
-            return
-
-        # We are definitely not off the ends of the segment, and close enough
-        # that we are colliding.
-        p.rebound(self.normal, vec.sub(p.pos, v_dist), restitution)
+    @property
+    def segment_bounds(self):
+        """The bounding box of each segment, as indexed by a WallIndex."""
+        return (self.bounds,)
+
+    def segments(self):
+        """
+        List the segments of the wall, as (p1, p2, tangent, normal, bounds,
+        cap1, cap2) tuples, where cap1 and cap2 tell whether the segment
+        collides with its endpoints.
+        """
+        return [(self.p1, self.p2, self.tangent, self.normal, self.bounds, True, True)]
+
+    def collide_wall(self, p, bounds=None, events=None):
+        """
+        Bounce p off the wall if they touch, and return whether they did.
+
+        If events is an EventBus, the hit is emitted to it.
+        """
+        velocity = p.velocity
+        point = collide_segment(
+            p, self.p1, self.p2, self.tangent, self.normal, self.restitution,
+        )
+        if point is None:
+            return False
+        if events is not None:
+            events.emit(WALL, p, self, wall_impulse(p, velocity), point)
+        return True
+
+
+class Polyline(Wall):
+    """
+    A chain of wall segments through a list of vertices.
+
+    The vertices are stored once, and shared by the segments that meet at
+    them. Each corner belongs to the segment that starts at it, so a particle
+    at a corner is tested against it once rather than by both segments. The
+    index finds the shape with a single bounding box test, after which only
+    its segments near the particle are checked.
+    """
+    graphics_type = 'polyline'
+    # Whether the last vertex joins back to the first.
+    closed = False
+
+    def __init__(self, vertices, restitution=None):
+        if restitution is None:
+            restitution = c.restitution_wall
+        self.vertices = [tuple(v) for v in vertices]
+        self.restitution = restitution
+        n = len(self.vertices)
+        count = n if self.closed else n - 1
+        self.segment_data = []
+        for k in range(count):
+            p1 = self.vertices[k]
+            p2 = self.vertices[(k + 1) % n]
+            tangent = vec.vfrom(p1, p2)
+            (x1, y1), (x2, y2) = p1, p2
+            self.segment_data.append((
+                p1,
+                p2,
+                tangent,
+                vec.perp(tangent),
+                (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)),
+                True,
+                # The end of an open chain has no segment starting at it.
+                not self.closed and k == count - 1,
+            ))
+        xs = [x for x, _ in self.vertices]
+        ys = [y for _, y in self.vertices]
+        self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+    @classmethod
+    def from_geometry(cls, vertices, restitution, geometry, bounds):
+        """
+        Make a shape with precomputed geometry, such as from a level file.
+
+        geometry is the tangent, normal and bounds of each segment.
+        """
+        shape = cls.__new__(cls)
+        shape.vertices = vertices
+        shape.restitution = restitution
+        n = len(vertices)
+        count = len(geometry)
+        shape.segment_data = [
+            (
+                vertices[k],
+                vertices[(k + 1) % n],
+                tangent,
+                normal,
+                segment_bounds,
+                True,
+                not cls.closed and k == count - 1,
+            )
+            for k, (tangent, normal, segment_bounds) in enumerate(geometry)
+        ]
+        shape.bounds = bounds
+        return shape
+
+    @property
+    def segment_bounds(self):
+        return [segment[4] for segment in self.segment_data]
+
+    def segments(self):
+        return self.segment_data
+
+    def collide_wall(self, p, bounds=None, events=None):
+        """
+        Bounce p off each segment it touches, and return how many it did.
+
+        bounds is the area around p to look for segments in, by default the
+        path of p padded by twice its radius, as used for WallIndex.query. If
+        events is an EventBus, each hit is emitted to it.
+        """
+        if bounds is None:
+            bounds = swept_bounds(p, 2 * p.radius)
+            wx1, wy1, wx2, wy2 = self.bounds
+            x1, y1, x2, y2 = bounds
+            if wx1 > x2 or x1 > wx2 or wy1 > y2 or y1 > wy2:
+                return 0
+        x1, y1, x2, y2 = bounds
+        restitution = self.restitution
+        hits = 0
+        for p1, p2, tangent, normal, (sx1, sy1, sx2, sy2), cap1, cap2 in self.segment_data:
+            if sx1 > x2 or x1 > sx2 or sy1 > y2 or y1 > sy2:
+                continue
+            velocity = p.velocity
+            point = collide_segment(p, p1, p2, tangent, normal, restitution, cap1, cap2)
+            if point is not None:
+                hits += 1
+                if events is not None:
+                    events.emit(WALL, p, self, wall_impulse(p, velocity), point)
+        return hits
+
+
+class Polygon(Polyline):
+    """A closed Polyline, such as the walls around an arena."""
+    closed = True
+
+
+def collide_segment(p, p1, p2, tangent, normal, restitution, cap1=True, cap2=True):
+    """
+    Bounce p off a wall segment if they touch, and return the point of
+    contact, or None if they didn't.
+
+    tangent is p2 - p1, and normal is perpendicular to it. cap1 and cap2 tell
+    whether the segment collides with p1 and p2, which it may leave to the
+    segment it shares the endpoint with.
+    """
+    restitution = restitution * p.restitution
+
+    # First, check that we haven't crossed through the wall due to
+    # extreme speed and low framerate.
+    intersection = intersect_segments(p1, p2, p.last_pos, p.pos)
+    if intersection:
+        p.pos = p.last_pos
+        p.rebound(normal, intersection, restitution)
+        return intersection
+
+    # Find vectors to each endpoint of the segment.
+    v1 = vec.vfrom(p1, p.pos)
+    v2 = vec.vfrom(p2, p.pos)
+
+    # Find a perpendicular vector from the wall to p.
+    v_dist = vec.proj(v1, normal)
+
+    # Test distance from the wall.
+    radius2 = p.radius**2
+    if vec.mag2(v_dist) > radius2:
+        return None
+
+    # Test for collision with the endpoints of the segment.
+    # Check whether p is too far off the end of the segment, by checking
+    # the sign of the vector projection, then a radius check for the
+    # distance from the endpoint.
+    if vec.dot(v1, tangent) < 0:
+        if cap1 and vec.mag2(v1) <= radius2:
+            p.rebound(v1, p1, restitution)
+            return p1
+        return None
+    if vec.dot(v2, tangent) > 0:
+        if cap2 and vec.mag2(v2) <= radius2:
+            p.rebound(v2, p2, restitution)
+            return p2
+        return None
+
+    # Test that p is headed toward the wall.
+    if vec.dot(p.velocity, v_dist) >= c.epsilon:
+        return None
+
+    # We are definitely not off the ends of the segment, and close enough
+    # that we are colliding.
+    point = vec.sub(p.pos, v_dist)
+    p.rebound(normal, point, restitution)
+    return point
+
+
+def wall_impulse(p, velocity):
+    """The impulse of a hit that changed the velocity of p from velocity."""
+    return vec.mag(vec.vfrom(velocity, p.velocity)) * p.mass
+
+
+class WallIndex(object):
+    """
+    A static spatial index over walls.
+
+    Walls never move once a level is loaded, so we hash the bounding box of
+    each wall into a uniform grid once, and then look up only the walls near a
+    given area.
+    """
+    def __init__(self, walls, cell_size=None):
+        self.walls = list(walls)
+        if cell_size is None:
+            # Size the cells to the typical wall, so that most walls only
+            # cover a few cells.
+            extents = [
+                max(x2 - x1, y2 - y1)
+                for w in self.walls
+                for (x1, y1, x2, y2) in w.segment_bounds
+            ]
+            cell_size = max(sum(extents) / len(extents), 1.0) if extents else 1.0
+        self.cell_size = cell_size
+
+        # Shapes with many segments are only put in the cells near their
+        # segments, not in every cell of their bounding box.
+        self.cells = {}
+        for index, w in enumerate(self.walls):
+            keys = set()
+            for bounds in w.segment_bounds:
+                keys.update(self.cell_keys(bounds))
+            for key in keys:
+                self.cells.setdefault(key, []).append(index)
+
+    @classmethod
+    def from_cells(cls, walls, cell_size, cells):
+        """
+        Make an index from precomputed cells, such as from a level file.
+
+        cells maps each cell key to the indices of the walls in it, in order.
+        """
+        index = cls.__new__(cls)
+        index.walls = list(walls)
+        index.cell_size = cell_size
+        index.cells = cells
+        return index
+
+    def cell_keys(self, bounds):
+        x1, y1, x2, y2 = bounds
+        size = self.cell_size
+        for cx in range(int(math.floor(x1 / size)), int(math.floor(x2 / size)) + 1):
+            for cy in range(int(math.floor(y1 / size)), int(math.floor(y2 / size)) + 1):
+                yield (cx, cy)
+
+    def query(self, bounds):
+        """
+        Find the walls whose bounding boxes overlap the given bounds.
+
+        The walls are returned in their original order.
+        """
+        x1, y1, x2, y2 = bounds
+        size = self.cell_size
+        num_cells = (
+            (int(math.floor(x2 / size)) - int(math.floor(x1 / size)) + 1) *
+            (int(math.floor(y2 / size)) - int(math.floor(y1 / size)) + 1)
+        )
+        if num_cells > len(self.cells):
+            # Huge query area, it is faster to check every wall.
+            indices = range(len(self.walls))
+        else:
+            indices = set()
+            for key in self.cell_keys(bounds):
+                indices.update(self.cells.get(key, ()))
+            indices = sorted(indices)
+
+        result = []
+        for index in indices:
+            w = self.walls[index]
+            wx1, wy1, wx2, wy2 = w.bounds
+            if wx1 <= x2 and x1 <= wx2 and wy1 <= y2 and y1 <= wy2:
+                result.append(w)
+        return result
+
+
+class WallArrays(object):
+    """
+    The walls of a WallIndex, as numpy arrays for batched collision.
+
+    Shapes are split into their segments, in order, with owners holding the
+    wall or shape of each segment. Each segment has its
+    endpoints p1 and p2, its tangent and normal, as in Wall, its length, its
+    restitution, its bounding box as (x1, y1, x2, y2), and whether it collides
+    with each of its endpoints. The tangent and normal are not unit vectors,
+    so that the batched results round the same way as Wall.collide_wall.
+
+    The segments are indexed in cells of the same size as the WallIndex, kept
+    as a sorted array of cell codes, and the segment indices of each cell in
+    one flat array, with the cell at position k holding
+    cell_walls[cell_starts[k]:cell_starts[k + 1]].
+    """
+    def __init__(self, wall_index):
+        segments = []
+        restitution = []
+        owners = []
+        for w in wall_index.walls:
+            for segment in w.segments():
+                segments.append(segment)
+                restitution.append(w.restitution)
+                owners.append(w)
+        n = len(segments)
+        p1, p2, tangent, normal, bounds, cap1, cap2 = zip(*segments) if n else [()] * 7
+        self.walls = segments
+        # The wall or shape that each segment belongs to.
+        self.owners = owners
+        self.p1 = np.array(p1, dtype=float).reshape((n, 2))
+        self.p2 = np.array(p2, dtype=float).reshape((n, 2))
+        self.tangent = np.array(tangent, dtype=float).reshape((n, 2))
+        self.normal = np.array(normal, dtype=float).reshape((n, 2))
+        self.length = np.sqrt(_dot(self.tangent, self.tangent))
+        self.restitution = np.array(restitution, dtype=float)
+        self.bounds = np.array(bounds, dtype=float).reshape((n, 4))
+        self.cap1 = np.array(cap1, dtype=bool)
+        self.cap2 = np.array(cap2, dtype=bool)
+
+        self.cell_size = wall_index.cell_size
+        cells = {}
+        for k, segment_bounds in enumerate(bounds):
+            for key in wall_index.cell_keys(segment_bounds):
+                cells.setdefault(key, []).append(k)
+        keys = sorted(cells)
+        cell_walls = []
+        cell_starts = [0]
+        for key in keys:
+            cell_walls.extend(cells[key])
+            cell_starts.append(len(cell_walls))
+        self.cell_walls = np.array(cell_walls, dtype=int)
+        self.cell_starts = np.array(cell_starts, dtype=int)
+        keys = np.array(keys, dtype=int).reshape((len(keys), 2))
+        if len(keys):
+            self.cell_min = keys.min(axis=0)
+            self.cell_max = keys.max(axis=0)
+        else:
+            self.cell_min = self.cell_max = np.zeros(2, dtype=int)
+        self.cell_codes = self.cell_code(keys[:, 0], keys[:, 1])
+
+    def cell_code(self, cx, cy):
+        """Number the cells in the range of the index, in key order."""
+        stride = self.cell_max[1] - self.cell_min[1] + 1
+        return (cx - self.cell_min[0]) * stride + (cy - self.cell_min[1])
+
+    def query_pairs(self, low, high):
+        """
+        Find the segments whose bounding boxes overlap each of the given
+        boxes.
+
+        This is WallIndex.query for many boxes at once, down to the segments
+        of the shapes it finds. The boxes are given
+        as arrays of their low and high corners. Returns index arrays of the
+        (box, wall) pairs, sorted by box, then by wall.
+        """
+        size = self.cell_size
+        cell_low = np.maximum(np.floor(low / size).astype(int), self.cell_min)
+        cell_high = np.minimum(np.floor(high / size).astype(int), self.cell_max)
+        extent = np.maximum(cell_high - cell_low + 1, 0)
+        num_cells = extent[:, 0] * extent[:, 1]
+
+        # List every cell covered by each box.
+        boxes = np.repeat(np.arange(len(low)), num_cells)
+        offset = np.arange(len(boxes)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+        rows = extent[boxes, 1]
+        codes = self.cell_code(
+            cell_low[boxes, 0] + offset // rows,
+            cell_low[boxes, 1] + offset % rows,
+        )
+        cells = np.searchsorted(self.cell_codes, codes)
+        found = cells < len(self.cell_codes)
+        found[found] = self.cell_codes[cells[found]] == codes[found]
+        boxes = boxes[found]
+        cells = cells[found]
+
+        # List every wall in those cells, without repeats.
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+        boxes = np.repeat(boxes, counts)
+        offset = np.arange(len(boxes)) - np.repeat(np.cumsum(counts) - counts, counts)
+        walls = self.cell_walls[np.repeat(starts, counts) + offset]
+        num_walls = len(self.walls)
+        pairs = np.unique(boxes * num_walls + walls)
+        boxes = pairs // num_walls
+        walls = pairs % num_walls
+
+        bounds = self.bounds[walls]
+        overlap = (
+            (bounds[:, 0] <= high[boxes, 0]) & (low[boxes, 0] <= bounds[:, 2]) &
+            (bounds[:, 1] <= high[boxes, 1]) & (low[boxes, 1] <= bounds[:, 3])
+        )
+        return boxes[overlap], walls[overlap]
+
+
+def collide_walls_batch(state, index, arrays, events=None):
+    """
+    Collide many particles with the walls at once.
+
+    This is the batched counterpart to calling Wall.collide_wall for each
+    particle, on the walls that WallIndex.query finds for swept_bounds(p,
+    2 * p.radius), working on the arrays of a ParticleStore and on wall
+    segments. index holds the
+    store indices of the particles, and arrays is a WallArrays. The results
+    are the same as the scalar version, down to the rounding.
+
+    A particle is changed by each wall it hits, so it has to meet its walls
+    one after another, in order. The (particle, wall) pairs are split into
+    rounds, where round k holds the k-th wall of every particle, and each
+    round is done at once.
+
+    Players take damage from hitting walls, as in Player.rebound, which is
+    added to the damage attribute of the player objects. If events is an
+    EventBus, the hits and the damage are emitted to it.
+
+    Returns the number of pairs that were tested, and the number of hits.
+    """
+    index = np.asarray(index, dtype=int)
+    if len(index) == 0 or len(arrays.walls) == 0:
+        return 0, 0
+
+    pos = state.pos[index]
+    last_pos = state.last_pos[index]
+    padding = 2 * state.radius[index][:, np.newaxis]
+    particles, walls = arrays.query_pairs(
+        np.minimum(pos, last_pos) - padding,
+        np.maximum(pos, last_pos) + padding,
+    )
+    if len(particles) == 0:
+        return 0, 0
+
+    # The pairs are sorted by particle, then wall, so the round of a pair is
+    # its position among the pairs of its particle.
+    counts = np.bincount(particles, minlength=len(index))
+    starts = np.cumsum(counts) - counts
+    rounds = np.arange(len(particles)) - starts[particles]
+
+    hits = 0
+    found = []
+    for r in range(counts.max()):
+        in_round = np.flatnonzero(rounds == r)
+        round_hits = _collide_walls_round(
+            state,
+            index[particles[in_round]],
+            walls[in_round],
+            arrays,
+        )
+        if round_hits is not None:
+            pairs, hit_particles, hit_walls, impulse, point = round_hits
+            hits += len(pairs)
+            found.append((in_round[pairs], hit_particles, hit_walls, impulse, point))
+    if events is not None and found:
+        _emit_wall_hits(state, arrays, events, found)
+    return len(particles), hits
+
+
+def _collide_walls_round(state, particles, walls, arrays):
+    pos = state.pos[particles]
+    last_pos = state.last_pos[particles]
+    velocity = state.velocity[particles]
+    radius = state.radius[particles]
+    radius2 = radius**2
+    restitution = arrays.restitution[walls] * state.restitution[particles]
+    p1 = arrays.p1[walls]
+    p2 = arrays.p2[walls]
+    tangent = arrays.tangent[walls]
+    normal = arrays.normal[walls]
+
+    # The rebound normal, and the contact point, of each hit.
+    hit_normal = np.zeros_like(pos)
+    point = np.zeros_like(pos)
+
+    # First, check that we haven't crossed through the wall due to extreme
+    # speed and low framerate.
+    crossed = (
+        (_counterclockwise(p1, last_pos, pos) != _counterclockwise(p2, last_pos, pos)) &
+        (_counterclockwise(p1, p2, last_pos) != _counterclockwise(p1, p2, pos))
+    )
+    crossed_point, parallel = _intersect_lines(
+        p1[crossed], p2[crossed], last_pos[crossed], pos[crossed],
+    )
+    crossed[crossed] = ~parallel
+    point[crossed] = crossed_point[~parallel]
+    hit_normal[crossed] = normal[crossed]
+    pos[crossed] = last_pos[crossed]
+
+    # Find vectors to each endpoint of the segment, and the perpendicular
+    # vector from the wall.
+    v1 = pos - p1
+    v2 = pos - p2
+    v_dist = normal * (_dot(v1, normal) / _dot(normal, normal))[:, np.newaxis]
+    near = ~crossed & (_dot(v_dist, v_dist) <= radius2)
+
+    # Test for collision with the endpoints of the segment.
+    before = near & (_dot(v1, tangent) < 0)
+    cap1 = before & arrays.cap1[walls] & (_dot(v1, v1) <= radius2)
+    after = near & ~before & (_dot(v2, tangent) > 0)
+    cap2 = after & arrays.cap2[walls] & (_dot(v2, v2) <= radius2)
+    hit_normal[cap1] = v1[cap1]
+    point[cap1] = p1[cap1]
+    hit_normal[cap2] = v2[cap2]
+    point[cap2] = p2[cap2]
+
+    # Otherwise, collide with the side of the wall, if headed toward it.
+    side = near & ~before & ~after & (_dot(velocity, v_dist) < c.epsilon)
+    hit_normal[side] = normal[side]
+    point[side] = pos[side] - v_dist[side]
+
+    hit = crossed | cap1 | cap2 | side
+    if not hit.any():
+        return None
+    pairs = np.flatnonzero(hit)
+    particles = particles[hit]
+    walls = walls[hit]
+    pos = pos[hit]
+    velocity = velocity[hit]
+    radius = radius[hit]
+    radius2 = radius2[hit]
+    restitution = restitution[hit]
+    hit_normal = hit_normal[hit]
+    point = point[hit]
+
+    # Rebound, as in Particle.rebound: invert the normal component of the
+    # velocity, with restitution.
+    hit_tangent = np.column_stack([hit_normal[:, 1], -hit_normal[:, 0]])
+    v_tangent = hit_tangent * (
+        _dot(velocity, hit_tangent) / _dot(hit_tangent, hit_tangent)
+    )[:, np.newaxis]
+    v_normal = hit_normal * (
+        _dot(velocity, hit_normal) / _dot(hit_normal, hit_normal)
+    )[:, np.newaxis]
+    new_velocity = v_tangent + (-v_normal) * restitution[:, np.newaxis]
+
+    # If the particle is partially inside the wall, move it out.
+    v = pos - point
+    inside = _dot(v, v) < radius2
+    v = v[inside]
+    scale = radius[inside] / np.sqrt(_dot(v, v))
+    pos[inside] = point[inside] + v * scale[:, np.newaxis]
+
+    state.pos[particles] = pos
+    state.velocity[particles] = new_velocity
+
+    change = new_velocity - velocity
+    impulse = np.sqrt(_dot(change, change)) * state.mass[particles]
+
+    # Damage players by the change in momentum, as in Player.rebound.
+    damaged = state.is_player[particles]
+    if damaged.any():
+        objects = state.particles
+        for i, amount in zip(particles[damaged].tolist(), impulse[damaged].tolist()):
+            objects[i].damage += amount
+    return pairs, particles, walls, impulse, point
+
+
+def _emit_wall_hits(state, arrays, events, found):
+    """
+    Emit the hits of every round, in the order that the scalar version emits
+    them: by particle, then by wall, with the damage to a player before the
+    hit that caused it.
+    """
+    pairs, particles, walls, impulse, point = [
+        np.concatenate(values) for values in zip(*found)
+    ]
+    order = np.argsort(pairs)
+    particles = particles[order].tolist()
+    walls = walls[order].tolist()
+    impulse = impulse[order].tolist()
+    xs = point[order, 0].tolist()
+    ys = point[order, 1].tolist()
+    objects = state.particles
+    owners = arrays.owners
+    hitters = [objects[i] for i in particles]
+    if not state.is_player[particles].any():
+        events.emit_many(WALL, hitters, [owners[k] for k in walls], impulse, xs, ys)
+        return
+    is_player = state.is_player
+    for i, p, k, amount, x, y in zip(particles, hitters, walls, impulse, xs, ys):
+        if is_player[i]:
+            events.emit(DAMAGE, p, None, amount, (x, y))
+        events.emit(WALL, p, owners[k], amount, (x, y))
+
+
+def _counterclockwise(a, b, c):
+    return (
+        (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1]) <
+        (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1])
+    )
+
+def _intersect_lines(a, b, c, d):
+    """
+    Do the work of intersect_lines for arrays of lines, with the same
+    formula, so the points round the same way.
+
+    Returns the points, and whether each pair of lines was parallel, in which
+    case its point is meaningless.
+    """
+    ax, ay = a[:, 0], a[:, 1]
+    bx, by = b[:, 0], b[:, 1]
+    cx, cy = c[:, 0], c[:, 1]
+    dx, dy = d[:, 0], d[:, 1]
+    vertical_ab = ax == bx
+    vertical_cd = cx == dx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope_ab = (by - ay) / (bx - ax)
+        y_intercept_ab = ay - slope_ab * ax
+        slope_cd = (dy - cy) / (dx - cx)
+        y_intercept_cd = cy - slope_cd * cx
+        parallel = np.where(
+            vertical_ab | vertical_cd,
+            vertical_ab & vertical_cd,
+            slope_ab == slope_cd,
+        )
+        x = np.where(
+            vertical_ab,
+            ax,
+            np.where(
+                vertical_cd,
+                cx,
+                (y_intercept_cd - y_intercept_ab) / (slope_ab - slope_cd),
+            ),
+        )
+        y = np.where(
+            vertical_ab,
+            slope_cd * x + y_intercept_cd,
+            slope_ab * x + y_intercept_ab,
+        )
+    return np.column_stack([x, y]), parallel
+
+def _dot(a, b):
+    return a[:, 0] * b[:, 0] + a[:, 1] * b[:, 1]
+
+
+def swept_bounds(p, padding):
+    """
+    Find the bounding box of the path of particle p during the last tick,
+    expanded by the given padding.
+    """
+    (x1, y1), (x2, y2) = p.last_pos, p.pos
+    return (
+        min(x1, x2) - padding,
+        min(y1, y2) - padding,
+        max(x1, x2) + padding,
+        max(y1, y2) + padding,
+    )
 
 
 def counterclockwise(a, b, c):
@@ -0,0 +1,279 @@
+"""
+Procedurally generated large worlds, loaded in chunks around the players.
+
+Usage:
+    python worldgen.py [--seed N] [--size N] [--ticks N] [--radius N]
+"""
+from __future__ import division, print_function
+
+import argparse
+import math
+import random
+import time
+
+from environment import Environment
+from levelfile import make_objects
+from headless import ScriptedInput
+from particle import Particle
+from bumper import Bumper
+from player import Player
+from wall import Wall
+import batch
+import constants as c
+
+
+class World(object):
+    """
+    A large square arena, generated from a seed one chunk at a time.
+
+    The arena is size by size chunks, each chunk_size units across, centered
+    on the origin, with walls around the outside. Each chunk gets the given
+    number of particles, bumpers and loose wall segments at random, except in
+    a clearing around the origin where the players start. A chunk comes out
+    the same every time it is generated, so it never needs to be stored until
+    something in it has moved.
+    """
+    def __init__(
+        self,
+        seed=0,
+        size=16,
+        chunk_size=40.0,
+        particles=12,
+        bumpers=1,
+        walls=3,
+        clearing=10.0,
+    ):
+        self.seed = seed
+        self.size = size
+        self.chunk_size = chunk_size
+        self.particles = particles
+        self.bumpers = bumpers
+        self.walls = walls
+        self.clearing = clearing
+
+    @property
+    def half_width(self):
+        return self.size * self.chunk_size / 2
+
+    def chunk_of(self, pos):
+        """Find the key of the chunk containing pos."""
+        x, y = pos
+        return (
+            min(max(int(math.floor((x + self.half_width) / self.chunk_size)), 0), self.size - 1),
+            min(max(int(math.floor((y + self.half_width) / self.chunk_size)), 0), self.size - 1),
+        )
+
+    def chunks_near(self, key, radius):
+        """Find the keys of the chunks within radius chunks of the given one."""
+        cx, cy = key
+        return set(
+            (x, y)
+            for x in range(max(cx - radius, 0), min(cx + radius + 1, self.size))
+            for y in range(max(cy - radius, 0), min(cy + radius + 1, self.size))
+        )
+
+    def chunk_level(self, key):
+        """Generate the contents of a chunk, as a level list."""
+        cx, cy = key
+        rand = random.Random('{}:{}:{}'.format(self.seed, cx, cy))
+        size = self.chunk_size
+        x1 = cx * size - self.half_width
+        y1 = cy * size - self.half_width
+        x2 = x1 + size
+        y2 = y1 + size
+
+        def random_pos(margin):
+            while True:
+                pos = (
+                    rand.uniform(x1 + margin, x2 - margin),
+                    rand.uniform(y1 + margin, y2 - margin),
+                )
+                if math.hypot(*pos) > self.clearing:
+                    return pos
+
+        level = []
+        # The outside walls are split between the chunks along the edge.
+        if cx == 0:
+            level.append((Wall, [(x1, y2), (x1, y1)]))
+        if cx == self.size - 1:
+            level.append((Wall, [(x2, y1), (x2, y2)]))
+        if cy == 0:
+            level.append((Wall, [(x1, y1), (x2, y1)]))
+        if cy == self.size - 1:
+            level.append((Wall, [(x2, y2), (x1, y2)]))
+
+        for _ in range(self.walls):
+            start = random_pos(4)
+            angle = rand.uniform(0, 2 * math.pi)
+            length = rand.uniform(3, 8)
+            end = (
+                min(max(start[0] + length * math.cos(angle), x1 + 1), x2 - 1),
+                min(max(start[1] + length * math.sin(angle), y1 + 1), y2 - 1),
+            )
+            level.append((Wall, [start, end]))
+        for _ in range(self.bumpers):
+            level.append((Bumper, dict(
+                pos=random_pos(4),
+                radius=rand.uniform(1, 3),
+            )))
+        for _ in range(self.particles):
+            level.append((Particle, dict(
+                pos=random_pos(2),
+                mass=rand.uniform(.25, 5),
+            )))
+        return level
+
+    def player_level(self, count=2):
+        """Place the players in the clearing at the center of the world."""
+        level = []
+        for i in range(count):
+            angle = 2 * math.pi * (i / count + 1 / 8)
+            level.append((Player, dict(
+                pos=(6 * math.cos(angle), 6 * math.sin(angle)),
+                heading=angle + math.pi,
+                mass=1.0,
+                radius=1.0,
+            )))
+        return level
+
+
+class Chunk(object):
+    """The objects belonging to one chunk of a World."""
+    def __init__(self, key, objects):
+        self.key = key
+        self.walls = [o for o in objects if isinstance(o, Wall)]
+        self.particles = [o for o in objects if isinstance(o, Particle)]
+        self.generated = [(p, p.pos) for p in self.particles]
+
+    @property
+    def pristine(self):
+        """Whether the chunk is still exactly as it was generated."""
+        return (
+            len(self.particles) == len(self.generated) and
+            all(
+                p is q and p.pos == pos and p.velocity == (0, 0)
+                for p, (q, pos) in zip(self.particles, self.generated)
+            )
+        )
+
+
+class ChunkStreamer(object):
+    """
+    Keeps only the chunks of a World near the players in an Environment.
+
+    The particles of chunks within radius chunks of a player are simulated.
+    The walls of one more ring of chunks are loaded too, so that particles at
+    the edge of the simulated area still hit the walls past it. Everything
+    farther away is frozen: its objects are taken out of the environment,
+    keeping their state, until a player comes near again.
+
+    Frozen chunks that are still as they were generated are thrown away, and
+    generated again when needed, so that memory grows only with the parts of
+    the world that were disturbed, and the cost of a tick stays the same no
+    matter how big the world is.
+
+    Call update() after every tick. The chunks are checked every interval
+    ticks, which is plenty, since a player at top speed takes many ticks to
+    cross a chunk.
+    """
+    def __init__(self, env, world, radius=1, interval=15):
+        self.env = env
+        self.world = world
+        self.radius = radius
+        self.interval = interval
+        self.chunks = {}
+        self.active = set()
+        self.wall_chunks = set()
+        self.loaded = set()
+        self.ticks = 0
+        self.refresh()
+
+    def chunk(self, key):
+        if key not in self.chunks:
+            self.chunks[key] = Chunk(key, make_objects(self.world.chunk_level(key)))
+        return self.chunks[key]
+
+    def update(self):
+        self.ticks += 1
+        if self.ticks % self.interval == 0:
+            self.refresh()
+
+    def refresh(self):
+        """Load the chunks near the players, and freeze the rest."""
+        world = self.world
+        active = set()
+        wall_chunks = set()
+        for p in self.env.players:
+            if p.dead:
+                continue
+            key = world.chunk_of(p.pos)
+            active |= world.chunks_near(key, self.radius)
+            wall_chunks |= world.chunks_near(key, self.radius + 1)
+        if active == self.active and wall_chunks == self.wall_chunks:
+            return
+
+        # Particles belong to the chunk they are in now, which may not be the
+        # one they started in.
+        for key in self.active:
+            self.chunks[key].particles = []
+        for p in self.env.particles:
+            if p in self.loaded:
+                self.chunk(world.chunk_of(p.pos)).particles.append(p)
+
+        wanted = []
+        for key in sorted(wall_chunks):
+            wanted.extend(self.chunk(key).walls)
+        for key in sorted(active):
+            wanted.extend(self.chunk(key).particles)
+        wanted_set = set(wanted)
+        removed = [o for o in self.loaded if o not in wanted_set]
+        added = [o for o in wanted if o not in self.loaded]
+        if removed:
+            self.env.remove_objects(removed)
+        if added:
+            self.env.add_objects(added)
+        self.loaded = wanted_set
+        self.active = active
+        self.wall_chunks = wall_chunks
+
+        for key in list(self.chunks):
+            if key not in wall_chunks and self.chunks[key].pristine:
+                del self.chunks[key]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--size', type=int, default=64, help='chunks across')
+    parser.add_argument('--ticks', type=int, default=c.physics_fps * 60)
+    parser.add_argument('--radius', type=int, default=1)
+    args = parser.parse_args()
+
+    world = World(seed=args.seed, size=args.size)
+    rand = random.Random(args.seed)
+    inputs = [ScriptedInput(batch.random_script(rand, args.ticks)) for _ in range(2)]
+    env = Environment(inputs)
+    env.load_level(world.player_level(len(inputs)))
+    streamer = ChunkStreamer(env, world, radius=args.radius)
+
+    start = time.time()
+    for tick in range(args.ticks):
+        for inp in inputs:
+            inp.update(tick)
+        env.update(c.physics_tick_ms)
+        streamer.update()
+    seconds = time.time() - start
+
+    print('{} ticks in {:.3f} seconds, {:.0f} ticks per second'.format(
+        args.ticks, seconds, args.ticks / seconds,
+    ))
+    print('world of {0}x{0} chunks, {1} kept in memory, {2} active'.format(
+        world.size, len(streamer.chunks), len(streamer.active),
+    ))
+    print('{} particles and {} walls loaded'.format(
+        len(env.particles), len(env.walls),
+    ))
+
+
+if __name__ == '__main__':
+    main()